@@ -0,0 +1,407 @@
+"""
+An in-process stand-in for the EC2, SSM and S3 APIs used by start-ec2.py.
+
+FakeAws answers calls from real boto3 clients by hooking the session's `before-call` event,
+the same mechanism botocore's Stubber uses, so the script runs unchanged. Instances move
+through pending, running, SSM online and status checks ok on a configurable timeline, and
+every call can be delayed, refused for lack of capacity or throttled. S3 objects are kept
+on disk, and SSM commands run locally with bash, so a sync can be followed end to end.
+"""
+import datetime
+import io
+import itertools
+import os
+import subprocess
+import threading
+import time
+import uuid
+
+from botocore.awsrequest import AWSResponse
+from botocore.response import StreamingBody
+
+class BootProfile:
+    """Seconds from a launch or start until each readiness stage is reached."""
+
+    def __init__(self, running: float, ssm_online: float, status_ok: float):
+        self.running = running
+        self.ssm_online = ssm_online
+        self.status_ok = status_ok
+
+class FakeInstance:
+    def __init__(self, instance_id: str, zone: str, instance_type: str, tags: list, state: str, spot_request_id: str = None,
+                 spot_type: str = 'one-time'):
+        self.instance_id = instance_id
+        self.zone = zone
+        self.instance_type = instance_type
+        self.tags = tags
+        self.spot_request_id = spot_request_id
+        self.spot_type = spot_type
+        self._state = state
+        self._since = time.monotonic()
+        self._profile = None
+        self.state_reason = None
+        self.spot_status = 'fulfilled'
+
+    def boot(self, profile: BootProfile) -> None:
+        self._state = 'pending'
+        self._since = time.monotonic()
+        self._profile = profile
+
+    def stop(self, hibernate: bool = False) -> None:
+        self._state = 'stopped'
+        self._profile = None
+        self.state_reason = 'Client.UserInitiatedHibernate' if hibernate else 'Client.UserInitiatedShutdown'
+
+    def terminate(self) -> None:
+        self._state = 'terminated'
+        self._profile = None
+
+    def _elapsed(self) -> float:
+        return time.monotonic() - self._since
+
+    @property
+    def state(self) -> str:
+        if self._state == 'pending' and self._elapsed() >= self._profile.running:
+            return 'running'
+        return self._state
+
+    @property
+    def ssm_online(self) -> bool:
+        if self.state != 'running':
+            return False
+        return self._profile is None or self._elapsed() >= self._profile.ssm_online
+
+    @property
+    def status_ok(self) -> bool:
+        if self.state != 'running':
+            return False
+        return self._profile is None or self._elapsed() >= self._profile.status_ok
+
+    def describe(self) -> dict:
+        return {
+            'InstanceId': self.instance_id,
+            'InstanceType': self.instance_type,
+            'State': {'Code': 0, 'Name': self.state},
+            'Placement': {'AvailabilityZone': self.zone},
+            'Tags': self.tags,
+            'PrivateIpAddress': '10.0.0.10',
+            **({'StateReason': {'Code': self.state_reason}} if self.state_reason else {}),
+            **({'SpotInstanceRequestId': self.spot_request_id} if self.spot_request_id else {}),
+        }
+
+class FakeAwsError(Exception):
+    def __init__(self, code: str, status: int = 400, message: str = None):
+        super().__init__(code)
+        self.code = code
+        self.status = status
+        self.message = message or f"Fake {code}"
+
+class FakeAws:
+    """
+    Fake EC2 and SSM backend.
+
+    Args:
+        latency: Seconds every call takes, unless `latencies` has an entry for the operation.
+        latencies: Per-operation latency, keyed by API name such as 'RunInstances'.
+        launch_profile: Timeline of freshly launched instances.
+        start_profile: Timeline of stopped instances being started.
+        no_capacity: 'zone|instance_type' pools that answer RunInstances with InsufficientInstanceCapacity.
+        spot_prices: Spot price per 'zone|instance_type' pool.
+        throttle_every: Throttle every n-th call when set.
+        s3_root: Directory holding the S3 objects, one subdirectory per bucket.
+        data_channel: WebSocket URL handed out by StartSession, normally a FakeDataChannel's.
+    """
+
+    def __init__(self, latency: float = 0.05, latencies: dict = None, launch_profile: BootProfile = None,
+                 start_profile: BootProfile = None, no_capacity: set = (), spot_prices: dict = None,
+                 throttle_every: int = 0, s3_root: str = None, data_channel: str = None):
+        self.latency = latency
+        self.latencies = latencies or {}
+        self.launch_profile = launch_profile or BootProfile(running=1.5, ssm_online=3.0, status_ok=4.0)
+        self.start_profile = start_profile or BootProfile(running=0.8, ssm_online=2.0, status_ok=3.0)
+        self.no_capacity = set(no_capacity)
+        self.spot_prices = spot_prices or {}
+        self.throttle_every = throttle_every
+        self.s3_root = s3_root
+        self.data_channel = data_channel
+        self.uploads = {}
+        self.fast_snapshot_restores = {}
+        self.commands = {}
+        self.instances = {}
+        self.calls = {}
+        self.throttled = 0
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def add_instance(self, tags: list, state: str = 'stopped', zone: str = 'eu-north-1c',
+                     instance_type: str = 'g5.4xlarge', hibernated: bool = False, spot: bool = False,
+                     spot_type: str = 'one-time') -> str:
+        instance_id = f"i-{uuid.uuid4().hex[:17]}"
+        self.instances[instance_id] = FakeInstance(instance_id, zone, instance_type, tags, state,
+                                                   f"sir-{uuid.uuid4().hex[:8]}" if spot else None, spot_type)
+        if hibernated:
+            self.instances[instance_id].state_reason = 'Client.UserInitiatedHibernate'
+        return instance_id
+
+    def interrupt(self, instance_id: str, notice: float = 120) -> None:
+        """Issue a spot interruption notice for `instance_id` and reclaim it `notice` seconds later."""
+        instance = self.instances[instance_id]
+        instance.spot_status = 'marked-for-termination'
+
+        def reclaim():
+            with self._lock:
+                if instance.state != 'terminated':
+                    instance.terminate()
+                    instance.spot_status = 'instance-terminated-by-price'
+        timer = threading.Timer(notice, reclaim)
+        timer.daemon = True
+        timer.start()
+
+    def install(self, session) -> None:
+        """Answer every call made by clients created from `session` from now on."""
+        session.events.register('before-parameter-build', self._capture_params)
+        session.events.register('before-call', self._answer)
+
+    def _capture_params(self, params, model, context, **kwargs) -> None:
+        context['fake_aws_params'] = dict(params)
+
+    def _answer(self, model, context, **kwargs):
+        operation = model.name
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            call_number = next(self._counter)
+        time.sleep(self.latencies.get(operation, self.latency))
+        request_id = str(uuid.uuid4())
+        try:
+            if self.throttle_every and call_number % self.throttle_every == 0:
+                self.throttled += 1
+                raise FakeAwsError('RequestLimitExceeded' if model.service_model.service_name == 'ec2'
+                                   else 'ThrottlingException', 503)
+            handler = getattr(self, f"_{operation}", None)
+            if handler is None:
+                raise FakeAwsError('UnsupportedOperation')
+            with self._lock:
+                parsed = handler(context.get('fake_aws_params', {}))
+            status = 200
+        except FakeAwsError as e:
+            parsed = {'Error': {'Code': e.code, 'Message': e.message}}
+            status = e.status
+        parsed['ResponseMetadata'] = {'RequestId': request_id, 'HTTPStatusCode': status, 'RetryAttempts': 0}
+        return AWSResponse(None, status, {}, None), parsed
+
+    # EC2
+
+    def _RunInstances(self, params: dict) -> dict:
+        zone = params.get('Placement', {}).get('AvailabilityZone')
+        instance_type = params.get('InstanceType')
+        if f"{zone}|{instance_type}" in self.no_capacity:
+            raise FakeAwsError('InsufficientInstanceCapacity')
+        spot_options = params.get('InstanceMarketOptions', {}).get('SpotOptions', {})
+        spot_type = spot_options.get('SpotInstanceType', 'one-time')
+        if spot_type == 'persistent' and spot_options.get('InstanceInterruptionBehavior', 'terminate') == 'terminate':
+            # EC2 only terminates interrupted instances of one-time requests
+            raise FakeAwsError('InvalidParameterCombination')
+        tags = next((spec['Tags'] for spec in params.get('TagSpecifications', [])
+                     if spec['ResourceType'] == 'instance'), [])
+        launched = []
+        for _ in range(params['MaxCount']):
+            instance_id = f"i-{uuid.uuid4().hex[:17]}"
+            instance = FakeInstance(instance_id, zone, instance_type, tags, 'pending', f"sir-{uuid.uuid4().hex[:8]}",
+                                    spot_type)
+            instance.boot(self.launch_profile)
+            self.instances[instance_id] = instance
+            launched.append(instance.describe())
+        return {'Instances': launched}
+
+    def _matching_instances(self, params: dict) -> list:
+        instances = [self.instances[instance_id] for instance_id in params.get('InstanceIds', [])
+                     if instance_id in self.instances] if params.get('InstanceIds') else list(self.instances.values())
+        for query in params.get('Filters', []):
+            if query['Name'].startswith('tag:'):
+                key = query['Name'][4:]
+                instances = [instance for instance in instances
+                             if any(tag['Key'] == key and tag['Value'] in query['Values'] for tag in instance.tags)]
+            elif query['Name'] == 'instance-state-name':
+                instances = [instance for instance in instances if instance.state in query['Values']]
+        return instances
+
+    def _DescribeInstances(self, params: dict) -> dict:
+        instances = self._matching_instances(params)
+        return {'Reservations': [{'Instances': [instance.describe() for instance in instances]}] if instances else []}
+
+    def _DescribeInstanceStatus(self, params: dict) -> dict:
+        statuses = []
+        for instance in self._matching_instances(params):
+            check = 'not-applicable' if instance.state != 'running' else ('ok' if instance.status_ok else 'initializing')
+            statuses.append({
+                'InstanceId': instance.instance_id,
+                'InstanceState': {'Code': 0, 'Name': instance.state},
+                'InstanceStatus': {'Status': check},
+                'SystemStatus': {'Status': check},
+            })
+        return {'InstanceStatuses': statuses}
+
+    def _StartInstances(self, params: dict) -> dict:
+        changes = []
+        for instance in self._matching_instances(params):
+            previous = instance.state
+            if previous == 'stopped':
+                instance.boot(self.start_profile)
+            changes.append({'InstanceId': instance.instance_id, 'PreviousState': {'Code': 0, 'Name': previous},
+                            'CurrentState': {'Code': 0, 'Name': instance.state}})
+        return {'StartingInstances': changes}
+
+    def _StopInstances(self, params: dict) -> dict:
+        instances = self._matching_instances(params)
+        if any(instance.spot_request_id and instance.spot_type == 'one-time' for instance in instances):
+            # Instances of one-time spot requests can only be terminated
+            raise FakeAwsError('UnsupportedOperation')
+        for instance in instances:
+            instance.stop(params.get('Hibernate', False))
+        return {'StoppingInstances': []}
+
+    def _TerminateInstances(self, params: dict) -> dict:
+        for instance in self._matching_instances(params):
+            instance.terminate()
+        return {'TerminatingInstances': []}
+
+    def _CancelSpotInstanceRequests(self, params: dict) -> dict:
+        return {'CancelledSpotInstanceRequests': [
+            {'SpotInstanceRequestId': request_id, 'State': 'cancelled'} for request_id in params['SpotInstanceRequestIds']
+        ]}
+
+    def _DescribeSpotInstanceRequests(self, params: dict) -> dict:
+        wanted = set(params.get('SpotInstanceRequestIds', []))
+        unknown = wanted - {instance.spot_request_id for instance in self.instances.values()}
+        if unknown:
+            raise FakeAwsError('InvalidSpotInstanceRequestID.NotFound',
+                               message=f"The spot instance request ID '{sorted(unknown)[0]}' does not exist")
+        return {'SpotInstanceRequests': [
+            {'SpotInstanceRequestId': instance.spot_request_id, 'InstanceId': instance.instance_id,
+             'Type': instance.spot_type, 'State': 'active' if instance.state != 'terminated' else 'closed',
+             'Status': {'Code': instance.spot_status}}
+            for instance in self.instances.values()
+            if instance.spot_request_id and (not wanted or instance.spot_request_id in wanted)
+        ]}
+
+    def _DescribeImages(self, params: dict) -> dict:
+        return {'Images': [{'ImageId': image_id, 'BlockDeviceMappings': [
+            {'DeviceName': '/dev/sda1', 'Ebs': {'SnapshotId': f"snap-{image_id[4:]}"}}
+        ]} for image_id in params.get('ImageIds', [])]}
+
+    def _DescribeFastSnapshotRestores(self, params: dict) -> dict:
+        return {'FastSnapshotRestores': [
+            {'SnapshotId': snapshot_id, 'AvailabilityZone': zone, 'State': state}
+            for (snapshot_id, zone), state in self.fast_snapshot_restores.items()
+        ]}
+
+    def _EnableFastSnapshotRestores(self, params: dict) -> dict:
+        successful = []
+        for snapshot_id in params['SourceSnapshotIds']:
+            for zone in params['AvailabilityZones']:
+                self.fast_snapshot_restores[(snapshot_id, zone)] = 'enabling'
+                successful.append({'SnapshotId': snapshot_id, 'AvailabilityZone': zone, 'State': 'enabling'})
+        return {'Successful': successful, 'Unsuccessful': []}
+
+    def _DescribeSpotPriceHistory(self, params: dict) -> dict:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return {'SpotPriceHistory': [
+            {'AvailabilityZone': pool.split('|')[0], 'InstanceType': pool.split('|')[1],
+             'ProductDescription': 'Linux/UNIX', 'SpotPrice': str(price), 'Timestamp': now}
+            for pool, price in self.spot_prices.items()
+        ]}
+
+    # SSM
+
+    def _DescribeInstanceInformation(self, params: dict) -> dict:
+        wanted = next((query['Values'] for query in params.get('Filters', []) if query['Key'] == 'InstanceIds'), None)
+        return {'InstanceInformationList': [
+            {'InstanceId': instance.instance_id, 'PingStatus': 'Online'}
+            for instance in self.instances.values()
+            if instance.ssm_online and (wanted is None or instance.instance_id in wanted)
+        ]}
+
+    def _DescribeSessions(self, params: dict) -> dict:
+        # Sessions are opened by the fake aws binary in another process, so none are visible here
+        return {'Sessions': []}
+
+    def _StartSession(self, params: dict) -> dict:
+        if self.data_channel is None:
+            raise FakeAwsError('UnsupportedOperation')
+        session_id = f"bench-{uuid.uuid4().hex[:17]}"
+        return {'SessionId': session_id, 'TokenValue': uuid.uuid4().hex, 'StreamUrl': f"{self.data_channel}/{session_id}"}
+
+    def _TerminateSession(self, params: dict) -> dict:
+        return {'SessionId': params['SessionId']}
+
+    def _SendCommand(self, params: dict) -> dict:
+        command_id = str(uuid.uuid4())
+        self.commands[command_id] = {'Status': 'InProgress'}
+        threading.Thread(target=self._run_command, args=(command_id, params['Parameters']['commands']), daemon=True).start()
+        return {'Command': {'CommandId': command_id, 'Status': 'Pending'}}
+
+    def _run_command(self, command_id: str, commands: list) -> None:
+        # Runs on this machine in place of the instance, with the fake aws binary on the PATH
+        result = subprocess.run(['bash', '-c', "\n".join(commands)], capture_output=True, text=True,
+                                env=dict(os.environ, FAKE_S3_ROOT=self.s3_root or ''))
+        self.commands[command_id] = {
+            'Status': 'Success' if result.returncode == 0 else 'Failed',
+            # SSM truncates the output it returns
+            'StandardOutputContent': result.stdout[:24000],
+            'StandardErrorContent': result.stderr[:8000],
+        }
+
+    def _GetCommandInvocation(self, params: dict) -> dict:
+        if params['CommandId'] not in self.commands:
+            raise FakeAwsError('InvocationDoesNotExist')
+        return {'CommandId': params['CommandId'], 'InstanceId': params['InstanceId'], **self.commands[params['CommandId']]}
+
+    # S3
+
+    def _object_path(self, params: dict) -> str:
+        return os.path.join(self.s3_root, params['Bucket'], params['Key'])
+
+    def _write_object(self, params: dict, data: bytes) -> None:
+        path = self._object_path(params)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    @staticmethod
+    def _body(params: dict) -> bytes:
+        body = params.get('Body', b'')
+        return body if isinstance(body, bytes) else body.read()
+
+    def _HeadObject(self, params: dict) -> dict:
+        if not os.path.exists(self._object_path(params)):
+            raise FakeAwsError('404', 404)
+        return {'ContentLength': os.path.getsize(self._object_path(params)), 'ETag': '"fake"'}
+
+    def _GetObject(self, params: dict) -> dict:
+        if not os.path.exists(self._object_path(params)):
+            raise FakeAwsError('NoSuchKey', 404)
+        with open(self._object_path(params), 'rb') as f:
+            data = f.read()
+        return {'Body': StreamingBody(io.BytesIO(data), len(data)), 'ContentLength': len(data), 'ETag': '"fake"'}
+
+    def _PutObject(self, params: dict) -> dict:
+        self._write_object(params, self._body(params))
+        return {'ETag': '"fake"'}
+
+    def _CreateMultipartUpload(self, params: dict) -> dict:
+        upload_id = uuid.uuid4().hex
+        self.uploads[upload_id] = {}
+        return {'Bucket': params['Bucket'], 'Key': params['Key'], 'UploadId': upload_id}
+
+    def _UploadPart(self, params: dict) -> dict:
+        self.uploads[params['UploadId']][params['PartNumber']] = self._body(params)
+        return {'ETag': f'"part-{params["PartNumber"]}"'}
+
+    def _CompleteMultipartUpload(self, params: dict) -> dict:
+        parts = self.uploads.pop(params['UploadId'])
+        self._write_object(params, b''.join(parts[number] for number in sorted(parts)))
+        return {'Bucket': params['Bucket'], 'Key': params['Key'], 'ETag': '"fake"'}
+
+    def _AbortMultipartUpload(self, params: dict) -> dict:
+        self.uploads.pop(params['UploadId'], None)
+        return {}
@@ -0,0 +1,241 @@
+"""
+A stand-in for the Session Manager data channel, so the benchmarks can run native tunnels.
+
+FakeDataChannel plays the agent's side of the WebSocket protocol spoken by SsmPortForwarder:
+the token message, the handshake, sequence numbers and acknowledgements, and the port
+forwarding payloads. In 'smux' mode it reports an agent version that multiplexes every local
+connection as its own smux stream; in 'basic' mode an older one that carries one connection at
+a time. Each forwarded connection is relayed to a small HTTP server standing in for the app on
+the instance, which answers `ok <path>`. With `kms` the handshake asks for KMS encryption,
+which the script does not implement, so its fallback to the aws CLI can be followed.
+"""
+import asyncio
+import hashlib
+import http.server
+import json
+import struct
+import threading
+import time
+import uuid
+
+import websockets
+
+# The framing and constants are written out here rather than taken from start-ec2.py, so that
+# a mistake in the script's encoding shows up as a failed benchmark
+MESSAGE_HEADER = struct.Struct('>I32sIQqQ16s32sII')
+SMUX_HEADER = struct.Struct('<BBHI')
+SMUX_SYN, SMUX_FIN, SMUX_PSH, SMUX_NOP = 0, 1, 2, 3
+PAYLOAD_OUTPUT = 1
+PAYLOAD_HANDSHAKE_REQUEST = 5
+PAYLOAD_HANDSHAKE_RESPONSE = 6
+PAYLOAD_HANDSHAKE_COMPLETE = 7
+PAYLOAD_FLAG = 10
+FLAG_DISCONNECT_TO_PORT = 1
+AGENT_VERSIONS = {'smux': '3.2.582.0', 'basic': '3.0.161.0'}
+
+def encode_message(message_type: str, sequence_number: int, payload: bytes, payload_type: int = 0,
+                   flags: int = 0) -> bytes:
+    message_id = uuid.uuid4().bytes
+    return MESSAGE_HEADER.pack(
+        MESSAGE_HEADER.size - 4, message_type.ljust(32).encode(), 1, int(time.time() * 1000), sequence_number,
+        flags, message_id[8:] + message_id[:8], hashlib.sha256(payload).digest(), payload_type, len(payload),
+    ) + payload
+
+def decode_message(data: bytes) -> dict:
+    (header_length, message_type, _, _, sequence_number, _, id_bytes,
+     digest, payload_type, payload_length) = MESSAGE_HEADER.unpack_from(data)
+    payload = data[header_length + 4:header_length + 4 + payload_length]
+    if hashlib.sha256(payload).digest() != digest:
+        raise ValueError("payload digest mismatch")
+    return {
+        'message_type': message_type.decode().strip(),
+        'sequence_number': sequence_number,
+        'message_id': str(uuid.UUID(bytes=id_bytes[8:] + id_bytes[:8])),
+        'payload_type': payload_type,
+        'payload': payload,
+    }
+
+class AppHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = f"ok {self.path}".encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class AgentSession:
+    """The agent's end of one data channel."""
+
+    def __init__(self, channel: 'FakeDataChannel', websocket):
+        self.channel = channel
+        self.websocket = websocket
+        self.out_sequence = 0
+        self.in_sequence = 0
+        self.smux_buffer = b''
+        self.streams = {}
+        self.basic = None
+        self.tasks = set()
+
+    async def run(self) -> None:
+        opening = json.loads(await self.websocket.recv())
+        if not opening.get('TokenValue'):
+            await self.websocket.close(1008, "missing token")
+            return
+        actions = [{'ActionType': 'SessionType',
+                    'ActionParameters': {'SessionType': 'Port', 'Properties': {'portNumber': '8188'}}}]
+        if self.channel.kms:
+            actions.append({'ActionType': 'KMSEncryption', 'ActionParameters': {'KMSKeyId': 'alias/bench'}})
+        await self.send_output(json.dumps({'AgentVersion': AGENT_VERSIONS[self.channel.mode],
+                                           'RequestedClientActions': actions}).encode(), PAYLOAD_HANDSHAKE_REQUEST)
+        try:
+            async for raw in self.websocket:
+                if isinstance(raw, str):
+                    continue
+                message = decode_message(raw)
+                if message['message_type'] != 'input_stream_data':
+                    continue  # Acknowledgements of our output
+                # Anything older than the next expected message is a resend; it only needs acknowledging again
+                if message['sequence_number'] >= self.in_sequence:
+                    self.in_sequence = message['sequence_number'] + 1
+                    if not await self.handle(message):
+                        return
+                await self.acknowledge(message)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            for task in self.tasks:
+                task.cancel()
+            for writer in list(self.streams.values()) + ([self.basic] if self.basic else []):
+                writer.close()
+
+    async def send_output(self, payload: bytes, payload_type: int = PAYLOAD_OUTPUT) -> None:
+        message = encode_message('output_stream_data', self.out_sequence, payload, payload_type)
+        self.out_sequence += 1
+        await self.websocket.send(message)
+
+    async def acknowledge(self, message: dict) -> None:
+        await self.websocket.send(encode_message('acknowledge', 0, json.dumps({
+            'AcknowledgedMessageType': message['message_type'],
+            'AcknowledgedMessageId': message['message_id'],
+            'AcknowledgedMessageSequenceNumber': message['sequence_number'],
+            'IsSequentialMessage': True,
+        }).encode(), flags=3))
+
+    async def handle(self, message: dict) -> bool:
+        """Act on one client message. Returns False once the channel is closed."""
+        payload_type, payload = message['payload_type'], message['payload']
+        if payload_type == PAYLOAD_HANDSHAKE_RESPONSE:
+            response = json.loads(payload)
+            if response.get('Errors'):
+                self.channel.refused += 1
+                await self.websocket.send(encode_message('channel_closed', 0, json.dumps({
+                    'MessageType': 'channel_closed', 'SchemaVersion': 1,
+                    'Output': f"Session refused: {'; '.join(response['Errors'])}",
+                }).encode()))
+                await self.websocket.close()
+                return False
+            await self.send_output(json.dumps({'HandshakeTimeToComplete': 1, 'CustomerMessage': ''}).encode(),
+                                   PAYLOAD_HANDSHAKE_COMPLETE)
+        elif payload_type == PAYLOAD_OUTPUT and self.channel.mode == 'smux':
+            await self.feed_smux(payload)
+        elif payload_type == PAYLOAD_OUTPUT:
+            if self.basic is None:
+                self.basic = await self.open_app(lambda data: self.send_output(data))
+            self.basic.write(payload)
+        elif payload_type == PAYLOAD_FLAG and struct.unpack('>I', payload[:4])[0] == FLAG_DISCONNECT_TO_PORT:
+            if self.basic is not None:
+                self.basic.close()
+                self.basic = None
+        return True
+
+    async def feed_smux(self, data: bytes) -> None:
+        self.smux_buffer += data
+        while len(self.smux_buffer) >= SMUX_HEADER.size:
+            _, command, length, stream_id = SMUX_HEADER.unpack_from(self.smux_buffer)
+            if len(self.smux_buffer) < SMUX_HEADER.size + length:
+                return
+            body = self.smux_buffer[SMUX_HEADER.size:SMUX_HEADER.size + length]
+            self.smux_buffer = self.smux_buffer[SMUX_HEADER.size + length:]
+            if command == SMUX_SYN:
+                self.streams[stream_id] = await self.open_app(
+                    lambda data, stream_id=stream_id: self.send_output(SMUX_HEADER.pack(1, SMUX_PSH, len(data), stream_id) + data),
+                    lambda stream_id=stream_id: self.send_output(SMUX_HEADER.pack(1, SMUX_FIN, 0, stream_id)))
+            elif command == SMUX_PSH and stream_id in self.streams:
+                self.streams[stream_id].write(body)
+            elif command == SMUX_FIN and stream_id in self.streams:
+                writer = self.streams.pop(stream_id)
+                if writer.can_write_eof() and not writer.is_closing():
+                    writer.write_eof()
+
+    async def open_app(self, on_data, on_eof=None) -> asyncio.StreamWriter:
+        """Connect to the app and relay what it sends back through `on_data`, then `on_eof`."""
+        self.channel.connections += 1
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.channel.app_port)
+
+        async def relay():
+            try:
+                while True:
+                    data = await reader.read(16384)
+                    if not data:
+                        break
+                    await on_data(data)
+                if on_eof is not None:
+                    await on_eof()
+            except (ConnectionError, websockets.exceptions.ConnectionClosed):
+                pass
+            finally:
+                writer.close()
+        task = asyncio.create_task(relay())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return writer
+
+class FakeDataChannel:
+    """
+    Serves data channels on a local WebSocket port; FakeAws hands out `url` from StartSession.
+
+    Args:
+        mode: 'smux' for an agent that multiplexes connections, 'basic' for one connection at a time.
+        kms: Ask for KMS encryption in the handshake, which the script refuses.
+    """
+
+    def __init__(self, mode: str = 'smux', kms: bool = False):
+        self.mode = mode
+        self.kms = kms
+        self.url = None
+        self.app_port = None
+        self.sessions = 0
+        self.connections = 0
+        self.refused = 0
+        self._app = None
+        self._loop = None
+        self._server = None
+
+    def start(self) -> 'FakeDataChannel':
+        self._app = http.server.ThreadingHTTPServer(('127.0.0.1', 0), AppHandler)
+        self.app_port = self._app.server_address[1]
+        threading.Thread(target=self._app.serve_forever, daemon=True).start()
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+
+        async def _serve():
+            return await websockets.serve(self._session, '127.0.0.1', 0, max_size=None)
+        self._server = asyncio.run_coroutine_threadsafe(_serve(), self._loop).result()
+        self.url = f"ws://127.0.0.1:{self._server.sockets[0].getsockname()[1]}/v1/data-channel"
+        return self
+
+    def stop(self) -> None:
+        async def _close():
+            self._server.close()
+            await self._server.wait_closed()
+        asyncio.run_coroutine_threadsafe(_close(), self._loop).result(timeout=10)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._app.shutdown()
+        self._app.server_close()
+
+    async def _session(self, websocket) -> None:
+        self.sessions += 1
+        await AgentSession(self, websocket).run()
@@ -0,0 +1,604 @@
+"""
+Offline benchmarks for start-ec2.py.
+
+Each scenario runs the script's own flow against FakeAws (see fake_aws.py) and the fake
+`aws` binary in benchmarks/bin, in a throwaway working and home directory, and reads the
+timings back from the script's trace spans. Native tunnels talk to the data channel
+stand-in in fake_data_channel.py. Results are compared with baseline.json and the
+run fails if a scenario got slower or made more API calls than the tolerance allows.
+
+    python benchmarks/run.py                       # all scenarios, compared with the baseline
+    python benchmarks/run.py cold_launch fleet     # selected scenarios
+    python benchmarks/run.py --update-baseline     # record the current numbers as the baseline
+    python benchmarks/run.py --throttle-every 7    # throttle every 7th API call
+"""
+import argparse
+import filecmp
+import importlib.util
+import json
+import logging
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+from fake_aws import FakeAws
+from fake_data_channel import FakeDataChannel
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+BASELINE_PATH = os.path.join(BENCH_DIR, 'baseline.json')
+TAGS = [{'Key': 'sd', 'Value': 'sd'}]
+
+def load_script(workdir: str, overrides: dict):
+    """Load a fresh copy of start-ec2.py configured by config.yaml plus `overrides`."""
+    with open(os.path.join(REPO_DIR, 'config.yaml')) as f:
+        config = yaml.safe_load(f)
+    config.update({
+        'tag_key': 'sd',
+        'tag_value': 'sd',
+        'port_forwarding_backend': 'cli',
+        'ports': [{'name': 'app', 'remote': 8188, 'local': 28188, 'probe': '/'}],
+        'tunnel_health': {'probe_interval': 0.5},
+    })
+    config.update(overrides)
+    with open(os.path.join(workdir, 'config.yaml'), 'w') as f:
+        yaml.safe_dump(config, f)
+
+    os.chdir(workdir)
+    os.environ['HOME'] = workdir  # Keeps the state and price caches out of the real ~/.cache
+    spec = importlib.util.spec_from_file_location('start_ec2_bench', os.path.join(REPO_DIR, 'start-ec2.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.load_config('config.yaml')
+    module.tracer.prometheus_path = None
+    return module
+
+def patch_script(module, fake: FakeAws) -> None:
+    """Route the script's AWS session to `fake` and answer its prompts."""
+    get_aws_session = module.get_aws_session
+
+    def fake_session():
+        session = get_aws_session()
+        fake.install(session)
+        return session
+
+    module.get_aws_session = fake_session
+    module.input = lambda prompt='': 'no'
+
+def span_metrics(module) -> dict:
+    """Time to connect, its API calls and the slowest span of every phase, from the script's tracer."""
+    phases = {}
+    total = None
+    for span in module.tracer.finished:
+        phases[span.name] = round(max(phases.get(span.name, 0), span.seconds), 3)
+        if span.name == 'time_to_connect':
+            total = span
+    if total is None or total.status != 'ok':
+        raise RuntimeError(f"the run did not connect ({total.status if total else 'no time_to_connect span'})")
+    return {'seconds': round(total.seconds, 3), 'api_calls': total.api_calls, 'phases': phases}
+
+def run_main(module, fake: FakeAws) -> dict:
+    patch_script(module, fake)
+    module.main()
+    return span_metrics(module)
+
+# Scenarios: each gets a fresh working directory and returns its metrics
+
+def cold_launch(workdir: str, fake_options: dict) -> dict:
+    """No instance exists; one is launched, waited on and forwarded."""
+    return run_main(load_script(workdir, {}), FakeAws(**fake_options))
+
+def warm_restart(workdir: str, fake_options: dict) -> dict:
+    """A stopped tagged instance is found and started."""
+    fake = FakeAws(**fake_options)
+    fake.add_instance(TAGS, 'stopped')
+    return run_main(load_script(workdir, {}), fake)
+
+def stop_on_exit(workdir: str, fake_options: dict) -> dict:
+    """A cold launch with lifecycle.on_exit set to stop, which needs a persistent spot request; the instance is stopped at the end."""
+    fake = FakeAws(**fake_options)
+    metrics = run_main(load_script(workdir, {'lifecycle': {'on_exit': 'stop'}}), fake)
+    states = [(instance.spot_type, instance.state) for instance in fake.instances.values()]
+    if states != [('persistent', 'stopped')]:
+        raise RuntimeError(f"expected one stopped instance from a persistent request, got {states}")
+    return metrics
+
+def stuck_stopping(workdir: str, fake_options: dict) -> dict:
+    """The only tagged instance never finishes stopping; after `stopping_timeout` a new one is launched instead."""
+    fake = FakeAws(**fake_options)
+    stuck_id = fake.add_instance(TAGS, 'stopping')
+    module = load_script(workdir, {'lifecycle': {'stopping_timeout': 2}})
+    metrics = run_main(module, fake)
+    waits = [span.status for span in module.tracer.finished if span.name == 'stopping_wait']
+    if waits != ['timeout'] or len(fake.instances) != 2 or fake.instances[stuck_id].state != 'stopping':
+        raise RuntimeError(f"stopping waits {waits}, {len(fake.instances)} instance(s); expected one timeout and a launch")
+    return metrics
+
+def capacity_fallback(workdir: str, fake_options: dict) -> dict:
+    """
+    The cheapest pool has no capacity, so the next two are raced. The type is not offered in a fourth
+    zone, which has no spot price; ranking the pools again within the cache TTL must not look prices up again.
+    """
+    zones = ['eu-north-1a', 'eu-north-1b', 'eu-north-1c']
+    fake = FakeAws(spot_prices={f"{zone}|g5.4xlarge": 0.5 + index * 0.05 for index, zone in enumerate(zones)},
+                   no_capacity={'eu-north-1a|g5.4xlarge'}, **fake_options)
+    module = load_script(workdir, {'placement': {'availability_zones': zones + ['eu-north-1d'],
+                                                 'instance_types': ['g5.4xlarge']}})
+    metrics = run_main(module, fake)
+    ec2_client, _ = module.get_ec2_resources(module.get_aws_session(), module.aws_region)
+    module.rank_spot_pools(ec2_client)
+    if fake.calls.get('DescribeSpotPriceHistory') != 1:
+        raise RuntimeError(f"spot prices were looked up {fake.calls.get('DescribeSpotPriceHistory')} times "
+                           f"within the cache TTL, not once")
+    return metrics
+
+def fleet(workdir: str, fake_options: dict) -> dict:
+    """Three instances: one stopped, two launched."""
+    fake = FakeAws(**fake_options)
+    fake.add_instance(TAGS, 'stopped')
+    return run_main(load_script(workdir, {'fleet_size': 3}), fake)
+
+def reconnect(workdir: str, fake_options: dict, kills: int = 5) -> dict:
+    """A running tunnel's session process is killed; time until it is forwarding again."""
+    fake = FakeAws(**fake_options)
+    instance_id = fake.add_instance(TAGS, 'running')
+    module = load_script(workdir, {})
+    patch_script(module, fake)
+    ec2_client, ssm = module.get_ec2_resources(module.get_aws_session(), module.aws_region)
+    supervisor = module.start_tunnels(ssm, [instance_id], module.aws_region)
+    latencies = []
+    try:
+        for kill in range(kills):
+            tunnel = supervisor.status()[0]
+            if tunnel['state'] != 'ready':
+                raise RuntimeError(f"tunnel is {tunnel['state']} before kill {kill + 1}")
+            killed_at = time.monotonic()
+            os.kill(tunnel['pid'], signal.SIGKILL)
+            deadline = killed_at + 30
+            while time.monotonic() < deadline:
+                stats = supervisor.status()[0]
+                if stats['reconnects'] > tunnel['reconnects'] and stats['state'] == 'ready':
+                    break
+                time.sleep(0.02)
+            else:
+                raise RuntimeError(f"tunnel did not reconnect within 30s after kill {kill + 1}")
+            latencies.append(time.monotonic() - killed_at)
+    finally:
+        supervisor.stop()
+    return {'seconds': round(statistics.mean(latencies), 3), 'api_calls': sum(fake.calls.values()),
+            'phases': {'max_reconnect': round(max(latencies), 3)}}
+
+def interruption(workdir: str, fake_options: dict) -> dict:
+    """A spot instance gets its two-minute notice; time until its tunnel forwards to a replacement."""
+    fake = FakeAws(**fake_options)
+    instance_id = fake.add_instance(TAGS, 'running', spot=True)
+    module = load_script(workdir, {'interruption': {'poll_interval': 0.5}})
+    patch_script(module, fake)
+    ec2_client, ssm = module.get_ec2_resources(module.get_aws_session(), module.aws_region)
+    state_store = module.StateStore(os.path.join(workdir, 'state.json'), module.STATE_PROFILE)
+    supervisor = module.start_tunnels(ssm, [instance_id], module.aws_region)
+    watcher = module.start_interruption_watcher(ec2_client, ssm, state_store, [instance_id], supervisor)
+    try:
+        calls_before = sum(fake.calls.values())
+        noticed_at = time.monotonic()
+        fake.interrupt(instance_id)
+        while instance_id not in watcher.notices and time.monotonic() < noticed_at + 30:
+            time.sleep(0.02)
+        replacement_id = watcher.wait_for_replacement(instance_id, timeout=60)
+        if replacement_id is None:
+            raise RuntimeError("no replacement was launched")
+        tunnel = supervisor.status()[0]
+        if tunnel['instance_id'] != replacement_id or tunnel['state'] != 'ready':
+            raise RuntimeError(f"tunnel is {tunnel['state']} on {tunnel['instance_id']} after the replacement")
+        seconds = time.monotonic() - noticed_at
+    finally:
+        watcher.stop()
+        supervisor.stop()
+    return {'seconds': round(seconds, 3), 'api_calls': sum(fake.calls.values()) - calls_before,
+            'phases': {span.name: round(span.seconds, 3) for span in module.tracer.finished
+                       if span.name in ('interruption_replacement', 'fulfilment')}}
+
+def idle_stop(workdir: str, fake_options: dict, requests: int = 20) -> dict:
+    """Requests pass through the metered proxy and then stop; time from the last one until the idle instance is stopped."""
+    fake = FakeAws(**fake_options)
+    instance_id = fake.add_instance(TAGS, 'running')
+    module = load_script(workdir, {'metering': {'idle_minutes': 0.05, 'check_interval': 0.1}})
+    patch_script(module, fake)
+    ec2_client, ssm = module.get_ec2_resources(module.get_aws_session(), module.aws_region)
+    supervisor = module.start_tunnels(ssm, [instance_id], module.aws_region)
+    monitor = module.start_idle_monitor(ec2_client, supervisor)
+    try:
+        port = supervisor.status()[0]['local_port']
+        for _ in range(requests):
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=5) as response:
+                response.read()
+        tunnel = supervisor.status()[0]
+        if tunnel['requests'] != requests:
+            raise RuntimeError(f"the proxy counted {tunnel['requests']} of {requests} requests")
+        last_request_at = time.monotonic()
+        while instance_id not in monitor.stopped:
+            if time.monotonic() > last_request_at + 30:
+                raise RuntimeError("the idle instance was not stopped within 30s")
+            time.sleep(0.02)
+        seconds = time.monotonic() - last_request_at
+        if fake.instances[instance_id].state != 'stopped' or supervisor.status():
+            raise RuntimeError("the instance was not stopped or its tunnel is still open")
+    finally:
+        monitor.stop()
+        supervisor.stop()
+    return {'seconds': round(seconds, 3), 'api_calls': sum(fake.calls.values()),
+            'phases': {'request_p50': tunnel['latency_ms_p50'] / 1000, 'request_p95': tunnel['latency_ms_p95'] / 1000}}
+
+def native_tunnel(workdir: str, fake_options: dict, mode: str, kms: bool = False, requests: int = 20) -> dict:
+    """Forward a port over the data channel stand-in and fetch `requests` pages through it, four at a time."""
+    channel = FakeDataChannel(mode, kms).start()
+    fake = FakeAws(data_channel=channel.url, **fake_options)
+    instance_id = fake.add_instance(TAGS, 'running')
+    module = load_script(workdir, {'port_forwarding_backend': 'native'})
+    patch_script(module, fake)
+    _, ssm = module.get_ec2_resources(module.get_aws_session(), module.aws_region)
+    started = time.monotonic()
+    supervisor = module.start_tunnels(ssm, [instance_id], module.aws_region)
+    try:
+        tunnel = supervisor.status()[0]
+        if tunnel['state'] != 'ready':
+            raise RuntimeError(f"tunnel is {tunnel['state']} ({tunnel['error']})")
+        ready = time.monotonic() - started
+
+        def fetch(index: int) -> None:
+            with urllib.request.urlopen(f"http://127.0.0.1:{tunnel['local_port']}/item/{index}", timeout=5) as response:
+                body = response.read()
+            # The fake aws binary the CLI fallback runs answers every request with a plain 'ok'
+            expected = b'ok' if kms else f"ok /item/{index}".encode()
+            if body != expected:
+                raise RuntimeError(f"request {index} got {body!r}")
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            list(pool.map(fetch, range(requests)))
+        seconds = time.monotonic() - started
+
+        handle = supervisor.tunnels[0].handle
+        if kms:
+            if supervisor.backend != 'cli' or not channel.refused:
+                raise RuntimeError("the refused native session did not fall back to the aws CLI")
+        elif not isinstance(handle, module.SsmPortForwarder) or handle.multiplexed != (mode == 'smux'):
+            raise RuntimeError(f"the tunnel did not forward natively in {mode} mode")
+        elif channel.sessions != 1 or handle.connection_count < requests:
+            raise RuntimeError(f"{channel.sessions} session(s) carried {handle.connection_count} connection(s)")
+    finally:
+        supervisor.stop()
+        channel.stop()
+    return {'seconds': round(seconds, 3), 'api_calls': sum(fake.calls.values()),
+            'phases': {'tunnel_ready': round(ready, 3), 'requests': round(seconds - ready, 3)}}
+
+def native_smux(workdir: str, fake_options: dict) -> dict:
+    """Native tunnel to an agent that carries every connection as its own smux stream."""
+    return native_tunnel(workdir, fake_options, 'smux')
+
+def native_basic(workdir: str, fake_options: dict) -> dict:
+    """Native tunnel to an older agent that carries one connection at a time."""
+    return native_tunnel(workdir, fake_options, 'basic')
+
+def native_kms_fallback(workdir: str, fake_options: dict) -> dict:
+    """The agent asks for KMS encryption, which the native client refuses; the tunnel falls back to the aws CLI."""
+    return native_tunnel(workdir, fake_options, 'smux', kms=True)
+
+def sync(workdir: str, fake_options: dict, file_size: int = 24 * 1024 * 1024, small_files: int = 250) -> dict:
+    """
+    Three model files are synced to a running instance that already has `small_files` small ones, then one
+    model file changes and is synced again. Last, the locally cached manifest is dropped and a third sync
+    reads the instance's one. Both manifests read from the instance are longer than the 24,000 characters
+    of command output SSM returns.
+    """
+    local_dir = os.path.join(workdir, 'models')
+    remote_dir = os.path.join(workdir, 'instance', 'models')
+    os.makedirs(os.path.join(local_dir, 'loras'))
+    for name in ('a.safetensors', 'b.safetensors', 'loras/c.safetensors'):
+        with open(os.path.join(local_dir, name), 'wb') as f:
+            f.write(os.urandom(file_size))
+    # As if baked into the AMI: present on both sides, so only hashed on the instance, never copied
+    for directory in (local_dir, remote_dir):
+        os.makedirs(os.path.join(directory, 'tokenizers', 'shared'))
+        for index in range(small_files):
+            with open(os.path.join(directory, 'tokenizers', 'shared', f"vocabulary-merges-{index:04d}.json"), 'w') as f:
+                f.write('{}')
+    fake = FakeAws(s3_root=os.path.join(workdir, 's3'), **fake_options)
+    instance_id = fake.add_instance(TAGS, 'running')
+    module = load_script(workdir, {'sync': {'bucket': 'bench', 'chunk_size_mb': 8,
+                                            'directories': [{'local': local_dir, 'remote': remote_dir}]}})
+    patch_script(module, fake)
+    session = module.get_aws_session()
+    _, ssm = module.get_ec2_resources(session, module.aws_region)
+
+    started = time.monotonic()
+    report = module.sync_directories(session, ssm, [instance_id])
+    full = time.monotonic() - started
+    if report[0]['instances'][instance_id]['changed_files'] != 3:
+        raise RuntimeError(f"the full sync copied {report[0]['instances'][instance_id]['changed_files']} files")
+    with open(os.path.join(local_dir, 'a.safetensors'), 'r+b') as f:
+        f.write(os.urandom(4096))
+    started = time.monotonic()
+    report = module.sync_directories(session, ssm, [instance_id])
+    incremental = time.monotonic() - started
+    if report[0]['instances'][instance_id]['changed_files'] != 1:
+        raise RuntimeError(f"the incremental sync copied {report[0]['instances'][instance_id]['changed_files']} files")
+
+    state_store = module.StateStore(os.path.join(module.CACHE_DIR, 'state.json'), module.STATE_PROFILE)
+    state_store.delete(f"sync_manifest:{instance_id}:{remote_dir}")
+    started = time.monotonic()
+    report = module.sync_directories(session, ssm, [instance_id])
+    uncached = time.monotonic() - started
+    if report[0]['instances'][instance_id]['changed_files'] != 0:
+        raise RuntimeError(f"the sync without a cached manifest copied {report[0]['instances'][instance_id]['changed_files']} "
+                           f"files")
+
+    for name in ['a.safetensors', 'b.safetensors', 'loras/c.safetensors', 'tokenizers/shared/vocabulary-merges-0000.json']:
+        if not filecmp.cmp(os.path.join(local_dir, name), os.path.join(remote_dir, name), shallow=False):
+            raise RuntimeError(f"{name} differs on the instance after the sync")
+    return {'seconds': round(full + incremental, 3), 'api_calls': sum(fake.calls.values()),
+            'phases': {'full_sync': round(full, 3), 'incremental_sync': round(incremental, 3),
+                       'uncached_sync': round(uncached, 3)}}
+
+def warm_up(workdir: str, fake_options: dict, file_size: int = 24 * 1024 * 1024) -> dict:
+    """A freshly launched instance pre-reads its model directory; time until the warm-up has finished."""
+    model_dir = os.path.join(workdir, 'instance', 'models')
+    os.makedirs(model_dir)
+    for index in range(4):
+        with open(os.path.join(model_dir, f"model-{index}.safetensors"), 'wb') as f:
+            f.write(os.urandom(file_size))
+    fake = FakeAws(**fake_options)
+    instance_id = fake.add_instance(TAGS, 'running')
+    module = load_script(workdir, {'warm_up': {'directories': [model_dir], 'progress_interval': 0.2}})
+    patch_script(module, fake)
+    _, ssm = module.get_ec2_resources(module.get_aws_session(), module.aws_region)
+
+    started = time.monotonic()
+    module.start_warm_up(ssm, [instance_id])
+    while time.monotonic() < started + 60:
+        span = next((span for span in module.tracer.finished if span.name == 'warm_up'), None)
+        if span is not None:
+            break
+        time.sleep(0.05)
+    else:
+        raise RuntimeError("the warm-up did not finish within 60s")
+    if span.status != 'ok' or span.attributes.get('bytes_read') != 4 * file_size:
+        raise RuntimeError(f"the warm-up ended {span.status} after reading {span.attributes.get('bytes_read')} bytes")
+    return {'seconds': round(time.monotonic() - started, 3), 'api_calls': sum(fake.calls.values()),
+            'phases': {'warm_up': round(span.seconds, 3)}}
+
+def check_token_bucket(module) -> None:
+    """A full bucket serves `burst` calls at once, then one per 1/rate seconds, and refills to `burst` at most."""
+    rate, burst = 20.0, 5
+    bucket = module.TokenBucket(rate, burst)
+    waits = [bucket.acquire() for _ in range(burst)]
+    if any(waits):
+        raise RuntimeError(f"a full bucket made calls wait: {waits}")
+    if not 0.8 / rate <= bucket.acquire() <= 1.2 / rate:
+        raise RuntimeError("the call after the burst did not wait for one token to refill")
+    time.sleep(3 * burst / rate)  # Long enough to refill three bursts' worth
+    waits = [bucket.acquire() for _ in range(burst + 1)]
+    if any(waits[:burst]) or not waits[burst]:
+        raise RuntimeError(f"the bucket did not refill to exactly {burst} tokens: {waits}")
+    started = time.monotonic()
+    for _ in range(10):
+        bucket.acquire()
+    if not 0.8 * 10 / rate <= time.monotonic() - started <= 1.5 * 10 / rate:
+        raise RuntimeError(f"10 calls on an empty bucket took {time.monotonic() - started:.3f}s at {rate}/s")
+
+def check_batched_lookups(module, fake: FakeAws, ec2_client, lookups: int = 8) -> None:
+    """Lookups made while a describe_instances call is in flight go out together in one call, each getting its own IDs."""
+    instance_ids = [fake.add_instance(TAGS, 'running') for _ in range(lookups)]
+    fake.latencies['DescribeInstances'] = 0.3
+    wanted = [[instance_ids[index], instance_ids[(index + 1) % lookups]] for index in range(lookups)]
+    wanted[-1] = [instance_ids[-1], 'i-00000000000000000']  # Unknown IDs are left out of the result
+    with ThreadPoolExecutor(max_workers=lookups) as pool:
+        first = pool.submit(module.describe_instances_by_id, ec2_client, [instance_ids[0]])
+        while not fake.calls.get('DescribeInstances'):
+            time.sleep(0.005)
+        merged = [pool.submit(module.describe_instances_by_id, ec2_client, ids) for ids in wanted]
+        results = [first.result()] + [future.result() for future in merged]
+    if fake.calls['DescribeInstances'] != 2:
+        raise RuntimeError(f"{lookups + 1} lookups made {fake.calls['DescribeInstances']} describe_instances calls, not 2")
+    for ids, instances in zip([[instance_ids[0]]] + wanted, results):
+        if [instance['InstanceId'] for instance in instances] != [instance_id for instance_id in ids
+                                                                  if instance_id in fake.instances]:
+            raise RuntimeError(f"a lookup of {ids} got {[instance['InstanceId'] for instance in instances]}")
+
+def check_batch_errors(module, lookups: int = 5) -> None:
+    """When a merged call fails every lookup in it gets the error, and the batcher still serves later lookups."""
+    in_flight, release, calls = threading.Event(), threading.Event(), []
+
+    def fetch(ids: list) -> dict:
+        calls.append(ids)
+        if len(calls) == 1:
+            in_flight.set()
+            release.wait()
+        elif len(calls) == 2:
+            raise RuntimeError("merged call failed")
+        return {key: key.upper() for key in ids}
+
+    batcher = module.LookupBatcher(fetch)
+    with ThreadPoolExecutor(max_workers=lookups + 1) as pool:
+        first = pool.submit(batcher.lookup, ['a'])
+        in_flight.wait()
+        merged = [pool.submit(batcher.lookup, [f"b{index}"]) for index in range(lookups)]
+        while len(batcher._queue) < lookups:
+            time.sleep(0.005)
+        release.set()
+        if first.result() != {'a': 'A'}:
+            raise RuntimeError(f"the call before the failure returned {first.result()}")
+        errors = [future.exception() for future in merged]
+    if len(calls) != 2 or any(not isinstance(error, RuntimeError) for error in errors):
+        raise RuntimeError(f"{len(calls)} calls; the merged lookups got {errors}")
+    if batcher.lookup(['c']) != {'c': 'C'}:
+        raise RuntimeError("the batcher did not recover after a failed call")
+
+def call_layer(workdir: str, fake_options: dict) -> dict:
+    """Focused checks of the token bucket and the describe batching, timed as a whole."""
+    fake = FakeAws(**fake_options)
+    module = load_script(workdir, {})
+    patch_script(module, fake)
+    ec2_client, _ = module.get_ec2_resources(module.get_aws_session(), module.aws_region)
+    phases = {}
+    for name, check in (('token_bucket', lambda: check_token_bucket(module)),
+                        ('batched_lookups', lambda: check_batched_lookups(module, fake, ec2_client)),
+                        ('batch_errors', lambda: check_batch_errors(module))):
+        started = time.monotonic()
+        check()
+        phases[name] = round(time.monotonic() - started, 3)
+    return {'seconds': round(sum(phases.values()), 3), 'api_calls': sum(fake.calls.values()), 'phases': phases}
+
+def status_no_daemon(workdir: str, fake_options: dict, runs: int = 5, budget: float = 0.2) -> dict:
+    """`start-ec2.py status` with no daemon and a cached instance; answered from the cache without boto3."""
+    fake = FakeAws(**fake_options)
+    instance_id = fake.add_instance(TAGS, 'running')
+    module = load_script(workdir, {})
+    state_store = module.StateStore(os.path.join(module.CACHE_DIR, 'state.json'), module.STATE_PROFILE)
+    module.remember_instances(state_store, [fake.instances[instance_id].describe()])
+    state_store.put('tunnels', [{'name': 'app', 'instance_id': instance_id, 'remote_port': '8188',
+                                 'local_port': 28188, 'session_id': 'bench-recorded', 'pid': None}])
+    command = [sys.executable, os.path.join(REPO_DIR, 'start-ec2.py'), 'status']
+
+    def timed(args: list) -> float:
+        started = time.monotonic()
+        result = subprocess.run(args, cwd=workdir, capture_output=True, text=True)
+        if result.returncode:
+            raise RuntimeError(f"{' '.join(args[1:])} exited with status {result.returncode}: {result.stderr.strip()}")
+        return time.monotonic() - started
+
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + command[1:], cwd=workdir,
+                            capture_output=True, text=True)
+    if f"{instance_id}: running (cached)" not in result.stdout:
+        raise RuntimeError(f"status did not show the cached instance: {result.stdout.strip()}")
+    if 'boto3' in result.stderr or 'botocore' in result.stderr:
+        raise RuntimeError("status imported boto3 without a daemon or --refresh")
+    # The interpreter's own start-up is outside the script's control and is reported separately
+    interpreter = statistics.median(timed([sys.executable, '-c', 'pass']) for _ in range(runs))
+    seconds = statistics.median(timed(command) for _ in range(runs))
+    if seconds - interpreter > budget:
+        raise RuntimeError(f"status took {seconds - interpreter:.3f}s beyond interpreter start-up, budget {budget}s")
+    return {'seconds': round(seconds, 3), 'api_calls': sum(fake.calls.values()),
+            'phases': {'interpreter': round(interpreter, 3), 'script': round(seconds - interpreter, 3)}}
+
+SCENARIOS = {
+    'cold_launch': cold_launch,
+    'warm_restart': warm_restart,
+    'stop_on_exit': stop_on_exit,
+    'stuck_stopping': stuck_stopping,
+    'capacity_fallback': capacity_fallback,
+    'fleet': fleet,
+    'reconnect': reconnect,
+    'interruption': interruption,
+    'idle_stop': idle_stop,
+    'native_smux': native_smux,
+    'native_basic': native_basic,
+    'native_kms_fallback': native_kms_fallback,
+    'sync': sync,
+    'warm_up': warm_up,
+    'status_no_daemon': status_no_daemon,
+    'call_layer': call_layer,
+}
+
+def run_scenario(name: str, repeat: int, fake_options: dict) -> dict:
+    """Median seconds and API calls over `repeat` runs."""
+    runs = []
+    for _ in range(repeat):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory(prefix=f"start-ec2-bench-{name}-") as workdir:
+            try:
+                runs.append(SCENARIOS[name](workdir, fake_options))
+            finally:
+                os.chdir(cwd)
+    return {
+        'seconds': round(statistics.median(run['seconds'] for run in runs), 3),
+        'api_calls': int(statistics.median(run['api_calls'] for run in runs)),
+        'phases': runs[len(runs) // 2]['phases'],
+        'runs': [run['seconds'] for run in runs],
+    }
+
+def find_regressions(name: str, result: dict, baseline: dict, tolerance: float, slack: float) -> list:
+    expected = baseline.get(name)
+    if not expected:
+        return []
+    regressions = []
+    if result['seconds'] > expected['seconds'] * (1 + tolerance) + slack:
+        regressions.append(f"{name}: {result['seconds']}s, baseline {expected['seconds']}s")
+    if result['api_calls'] > expected['api_calls'] * (1 + tolerance):
+        regressions.append(f"{name}: {result['api_calls']} API calls, baseline {expected['api_calls']}")
+    return regressions
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark start-ec2.py against a fake EC2/SSM backend.")
+    parser.add_argument('scenarios', nargs='*', help=f"Scenarios to run (default: all of {', '.join(SCENARIOS)})")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per scenario; the median is reported")
+    parser.add_argument('--latency', type=float, default=0.05, help="Seconds every fake API call takes")
+    parser.add_argument('--throttle-every', type=int, default=0, help="Throttle every n-th API call")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed relative slowdown before failing")
+    parser.add_argument('--slack', type=float, default=0.25, help="Allowed absolute slowdown in seconds")
+    parser.add_argument('--update-baseline', action='store_true', help="Write the results to baseline.json")
+    parser.add_argument('--output', help="Also write the results to this JSON file")
+    parser.add_argument('--verbose', action='store_true', help="Show the script's log output")
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+
+    os.environ['PATH'] = os.path.join(BENCH_DIR, 'bin') + os.pathsep + os.environ['PATH']
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    if args.verbose:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    else:
+        logging.disable(logging.CRITICAL)
+
+    fake_options = {
+        'latency': args.latency,
+        'latencies': {'RunInstances': 0.3, 'StartInstances': 0.2},
+        'throttle_every': args.throttle_every,
+    }
+    baseline = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+
+    results, regressions, failures = {}, [], []
+    for name in args.scenarios or list(SCENARIOS):
+        try:
+            result = run_scenario(name, args.repeat, fake_options)
+        except Exception as e:
+            failures.append(f"{name}: {e}")
+            print(f"{name:<20} FAILED: {e}")
+            continue
+        results[name] = result
+        expected = baseline.get(name, {})
+        print(f"{name:<20} {result['seconds']:>7.2f}s (baseline {expected.get('seconds', '-')}) "
+              f"{result['api_calls']:>4} calls (baseline {expected.get('api_calls', '-')})  "
+              + " ".join(f"{phase}={seconds}" for phase, seconds in sorted(result['phases'].items())))
+        regressions += find_regressions(name, result, baseline, args.tolerance, args.slack)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.update_baseline:
+        baseline.update({name: {'seconds': result['seconds'], 'api_calls': result['api_calls']}
+                         for name, result in results.items()})
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Baseline written to {BASELINE_PATH}")
+        return 1 if failures else 0
+
+    for problem in failures + regressions:
+        print(f"REGRESSION {problem}")
+    return 1 if failures or regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,69 +1,149 @@
 # MIT License
 # Copyright (c) 2024 Cavit Erginsoy
 
-import boto3
 import logging
 import sys
 import yaml
 import subprocess
 import time
 import shutil
-import botocore.config
 import threading
-import requests
-import base64
 import traceback
 import socket
+import shlex
+import os
+import json
+import datetime
+import uuid
+import asyncio
+import struct
+import hashlib
+import functools
+import random
+import re
+import argparse
+import statistics
+import bisect
+import socketserver
+import contextlib
+import importlib.util
+import logging.handlers
 
-from botocore.exceptions import NoCredentialsError, ClientError
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s %(message)s',
-    handlers=[
-        logging.FileHandler('start-ec2.log'),
-        logging.StreamHandler(sys.stdout)  # This will output to the console
-    ]
-)
-
-# Load the configuration file
-try:
-    with open('config.yaml', 'r') as f:
-        config = yaml.safe_load(f)
-        user_data = base64.b64encode(config['user_data'].encode()).decode()
-except FileNotFoundError:
-    logging.error("Configuration file not found. Please ensure 'config.yaml' exists.")
-    raise SystemExit("Exiting due to missing configuration file.")
-
-# Use the configuration values
-REMOTE_PORT_NUMBER = config['remote_port']
-LOCAL_PORT_NUMBER = config['local_port']
-aws_region = config['region']
-aws_key_name = config['key_name']
-aws_ami = config['ami']
-aws_availability_zone = config['availability_zone']
-aws_tag_key = config['tag_key']
-aws_tag_value = config['tag_value']
-aws_iam_instance_profile = config['iam_instance_profile']
-aws_instance_type = config['instance_type']
-aws_availability_zone = config['availability_zone']
-aws_security_groups = config['security_groups']
-aws_max_spot_price = config['max_spot_price']
-
-# Ask for user confirmation before proceeding
-#confirmation = input("Press Enter to continue or type q to exit: ")
-#if confirmation:
-#    logging.info("Exiting...")
-#    raise SystemExit("User chose to exit.")
-
-ready_event = threading.Event()
+# botocore is imported along with boto3 by get_aws_session(). Until then these stand in for its
+# exceptions in except clauses; nothing can raise a botocore error before a session exists.
+class BotocoreNotImported(Exception):
+    pass
+
+ClientError = BotocoreNotImported
+EndpointConnectionError = BotocoreNotImported
+
+def import_botocore_exceptions() -> None:
+    global ClientError, EndpointConnectionError
+    from botocore.exceptions import ClientError, EndpointConnectionError
+
+# Imported by import_websockets() the first time a native tunnel starts
+websockets = None
+
+def import_websockets():
+    """The websockets module, or None if it is not installed and only the aws CLI can forward ports."""
+    global websockets
+    if websockets is None:
+        try:
+            import websockets
+        except ImportError:
+            return None
+    return websockets
+
+def setup_logging() -> None:
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(message)s',
+        handlers=[
+            # Rotated so that a machine used every day does not grow the log without bound
+            logging.handlers.RotatingFileHandler('start-ec2.log', maxBytes=5 * 1024 * 1024, backupCount=3),
+            logging.StreamHandler(sys.stdout)  # This will output to the console
+        ]
+    )
+
+# Settings from config.yaml, filled in by load_config()
+config = {}
+config_path = 'config.yaml'
+REMOTE_PORT_NUMBER = LOCAL_PORT_NUMBER = None
+aws_region = aws_key_name = aws_ami = aws_availability_zone = None
+aws_tag_key = aws_tag_value = aws_iam_instance_profile = aws_instance_type = None
+aws_security_groups = aws_max_spot_price = user_data = None
+aws_fleet_size = FLEET_PORT_STRIDE = 1
+# One dict per section: a chained `a = b = {}` would make every section the same object
+placement_config, launch_template_config, tunnel_health_config, metrics_config = {}, {}, {}, {}
+lifecycle_config, interruption_config, app_readiness_config = {}, {}, {}
+sync_config, warm_up_config, metering_config, aws_calls_config = {}, {}, {}, {}
+PORT_FORWARDING_BACKEND = None
+STATE_PROFILE = None
+STATE_TTL = 12 * 3600
+
+CACHE_DIR = os.path.expanduser(os.path.join('~', '.cache', 'start-ec2'))
+
+def load_config(path: str = 'config.yaml') -> dict:
+    """Read the configuration file into the module-level settings. Nothing is read at import time."""
+    global config, config_path, REMOTE_PORT_NUMBER, LOCAL_PORT_NUMBER, aws_region, aws_key_name, aws_ami
+    global aws_availability_zone, aws_tag_key, aws_tag_value, aws_iam_instance_profile, aws_instance_type
+    global aws_security_groups, aws_max_spot_price, aws_fleet_size, FLEET_PORT_STRIDE, placement_config
+    global launch_template_config, user_data, PORT_FORWARDING_BACKEND, tunnel_health_config
+    global STATE_PROFILE, STATE_TTL, metrics_config, lifecycle_config, interruption_config, app_readiness_config
+    global sync_config, warm_up_config, metering_config, aws_calls_config
 
+    try:
+        with open(path, 'r') as f:
+            config = yaml.safe_load(f)
+    except FileNotFoundError:
+        logging.error(f"Configuration file not found. Please ensure '{path}' exists.")
+        raise SystemExit("Exiting due to missing configuration file.")
+    config_path = os.path.abspath(path)
+
+    REMOTE_PORT_NUMBER = config['remote_port']
+    LOCAL_PORT_NUMBER = config['local_port']
+    aws_region = config['region']
+    aws_key_name = config.get('key_name')
+    aws_ami = config.get('ami')
+    aws_availability_zone = config['availability_zone']
+    aws_tag_key = config['tag_key']
+    aws_tag_value = config['tag_value']
+    aws_iam_instance_profile = config.get('iam_instance_profile')
+    aws_instance_type = config['instance_type']
+    aws_security_groups = config.get('security_groups')
+    aws_max_spot_price = config['max_spot_price']
+    aws_fleet_size = int(config.get('fleet_size') or 1)
+    FLEET_PORT_STRIDE = int(config.get('fleet_port_stride') or 1)
+    placement_config = config.get('placement') or {}
+    launch_template_config = config.get('launch_template') or {}
+    user_data = config.get('user_data')
+    PORT_FORWARDING_BACKEND = config.get('port_forwarding_backend') or ('native' if importlib.util.find_spec('websockets') else 'cli')
+    tunnel_health_config = config.get('tunnel_health') or {}
+    app_readiness_config = config.get('app_readiness') or {}
+    lifecycle_config = config.get('lifecycle') or {}
+    interruption_config = config.get('interruption') or {}
+    sync_config = config.get('sync') or {}
+    warm_up_config = config.get('warm_up') or {}
+    metering_config = config.get('metering') or {}
+    # Cached state is kept separately for every region and tag, so several configs can share the cache
+    STATE_PROFILE = config.get('profile') or f"{aws_region}/{aws_tag_key}={aws_tag_value}"
+    STATE_TTL = float(config.get('state_ttl') or 12 * 3600)
+    metrics_config = config.get('metrics') or {}
+    tracer.path = metrics_config.get('trace_file', 'start-ec2-trace.jsonl')
+    tracer.prometheus_path = metrics_config.get('prometheus_textfile')
+    aws_calls_config = config.get('aws_calls') or {}
+    api_calls.configure(aws_calls_config)
+    return config
 
 def is_connected(host="8.8.8.8", port=53, timeout=3):
     """
     Check if the internet connection is available by attempting to connect to a DNS server.
-    
+
+    Only used to explain a failed AWS call, so a working connection is never probed.
+
     Args:
         host (str): The host to connect to. Default is Google's public DNS server.
         port (int): The port to connect to. Default is 53.
@@ -73,282 +153,3134 @@ def is_connected(host="8.8.8.8", port=53, timeout=3):
         bool: True if the connection is successful, False otherwise.
     """
     try:
-        socket.setdefaulttimeout(timeout)
-        socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect((host, port))
+        socket.create_connection((host, port), timeout=timeout).close()
         return True
-    except socket.error:
+    except OSError:
         return False
 
-ec2_client = boto3.client('ec2')
-
-# Create a new instance 
-def create_spot_instance_request(ec2_client) -> dict:
-    try:
-        response = ec2_client.request_spot_instances(
-            SpotPrice=aws_max_spot_price,
-            InstanceCount=1,
-            Type="one-time",
-            LaunchSpecification={
-                'ImageId': aws_ami,
-                'KeyName': aws_key_name,
-                'SecurityGroupIds': aws_security_groups,
-                'InstanceType': aws_instance_type,
-                'Placement': {
-                    'AvailabilityZone': aws_availability_zone,
-                },
-                'IamInstanceProfile': {
-                    'Arn': aws_iam_instance_profile
-                },
-            }
-        )[0]
-        return response
+# Phase timing
+
+# Error codes AWS uses when it throttles a caller
+THROTTLE_ERROR_CODES = {
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestLimitExceeded',
+    'TooManyRequestsException', 'RequestThrottled', 'RequestThrottledException',
+}
+
+class Span:
+    """One timed phase, with the AWS API calls that completed while it was open."""
+
+    def __init__(self, tracer, name: str, attributes: dict):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.start_time = time.time()
+        self.started = time.monotonic()
+        self.seconds = None
+        self.status = None
+        self.api_calls = 0
+        self.retries = 0
+        self.errors = 0
+        self.throttles = 0
+        self.operations = {}
+
+    def end(self, status: str = 'ok', **attributes) -> None:
+        """Close the span and write it out. Only the first call has any effect."""
+        self.tracer._end(self, status, attributes)
+
+    def record(self) -> dict:
+        return {
+            'run_id': self.tracer.run_id,
+            'profile': STATE_PROFILE,
+            'span': self.name,
+            'start': datetime.datetime.fromtimestamp(self.start_time, datetime.timezone.utc).isoformat(),
+            'seconds': round(self.seconds, 3),
+            'status': self.status,
+            'api_calls': self.api_calls,
+            'retries': self.retries,
+            'errors': self.errors,
+            'throttles': self.throttles,
+            'operations': self.operations,
+            **self.attributes,
+        }
+
+class Tracer:
+    """
+    Records how long each phase of bringing up an instance takes.
+
+    Phases are spans that can overlap and be opened on any thread. Every AWS API call made
+    through an instrumented boto3 session is counted against all spans open when it completes,
+    together with its retries, errors and throttles. Finished spans are appended to a JSON
+    lines file; `write_prometheus` exports the slowest run of each phase for node_exporter.
+    """
+
+    def __init__(self, path: str = None, prometheus_path: str = None):
+        self.run_id = uuid.uuid4().hex[:12]
+        self.path = path
+        self.prometheus_path = prometheus_path
+        self.finished = []
+        self._open = []
+        self._lock = threading.Lock()
+
+    def new_run(self) -> None:
+        """Start a new run ID, so that long-lived processes export each connect separately."""
+        with self._lock:
+            self.run_id = uuid.uuid4().hex[:12]
+            self.finished = []
+
+    def start(self, name: str, **attributes) -> Span:
+        span = Span(self, name, attributes)
+        with self._lock:
+            self._open.append(span)
+        return span
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes):
+        """Time the enclosed block; an exception ends the span with status 'error'."""
+        span = self.start(name, **attributes)
+        try:
+            yield span
+        except BaseException as e:
+            span.end('error', error=str(e) or type(e).__name__)
+            raise
+        span.end()
+
+    def instrument(self, session) -> None:
+        """Count the API calls of every client later created from this boto3 session."""
+        session.events.register('after-call', self._on_after_call)
+        session.events.register('after-call-error', self._on_after_call_error)
+
+    def _on_after_call(self, http_response, parsed, model, context, **kwargs) -> None:
+        error_code = parsed.get('Error', {}).get('Code') if http_response.status_code >= 300 else None
+        self._count(model.name, parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0), error_code,
+                    count_throttles(context, error_code))
+
+    def _on_after_call_error(self, exception, event_name, context, **kwargs) -> None:
+        # after-call-error carries no operation model; the event name ends with the operation
+        self._count(event_name.rsplit('.', 1)[-1], 0, type(exception).__name__, count_throttles(context))
+
+    def _count(self, operation: str, retries: int, error_code: str, throttles: int = 0) -> None:
+        with self._lock:
+            for span in self._open:
+                span.api_calls += 1
+                span.retries += retries
+                span.throttles += throttles
+                span.operations[operation] = span.operations.get(operation, 0) + 1
+                if error_code:
+                    span.errors += 1
+
+    def _end(self, span: Span, status: str, attributes: dict) -> None:
+        with self._lock:
+            if span not in self._open:
+                return
+            self._open.remove(span)
+            span.seconds = time.monotonic() - span.started
+            span.status = status
+            span.attributes.update(attributes)
+            self.finished.append(span)
+            line = json.dumps(span.record())
+        if self.path:
+            try:
+                if os.path.exists(self.path) and os.path.getsize(self.path) > 5 * 1024 * 1024:
+                    os.replace(self.path, f"{self.path}.1")
+                with open(self.path, 'a') as f:
+                    f.write(line + "\n")
+            except OSError as e:
+                logging.error(f"Could not write trace span to {self.path}: {e}")
+
+    def close(self) -> None:
+        """End the spans that never completed, for example when the run was interrupted."""
+        with self._lock:
+            spans = list(self._open)
+        for span in spans:
+            span.end('incomplete')
+        self.write_prometheus()
+
+    def write_prometheus(self) -> None:
+        """Write the phase durations and API counts of this run as a node_exporter textfile."""
+        if not self.prometheus_path:
+            return
+        with self._lock:
+            spans = list(self.finished)
+        # Per-instance phases are reported by their slowest instance
+        phases = {}
+        for span in spans:
+            phase = phases.setdefault(span.name, {'seconds': 0.0, 'api_calls': 0, 'retries': 0, 'throttles': 0, 'ok': 1})
+            phase['seconds'] = max(phase['seconds'], span.seconds)
+            phase['api_calls'] += span.api_calls
+            phase['retries'] += span.retries
+            phase['throttles'] += span.throttles
+            phase['ok'] = min(phase['ok'], int(span.status == 'ok'))
+        profile = STATE_PROFILE.replace('\\', '\\\\').replace('"', '\\"')
+        metrics = [
+            ('start_ec2_phase_seconds', 'seconds', 'Duration of each start-up phase in the last run.'),
+            ('start_ec2_phase_api_calls', 'api_calls', 'AWS API calls made during each phase in the last run.'),
+            ('start_ec2_phase_retries', 'retries', 'AWS API retries during each phase in the last run.'),
+            ('start_ec2_phase_throttles', 'throttles', 'Throttled AWS API attempts during each phase in the last run.'),
+            ('start_ec2_phase_ok', 'ok', 'Whether every span of the phase completed successfully in the last run.'),
+        ]
+        lines = []
+        for metric, key, description in metrics:
+            lines += [f"# HELP {metric} {description}", f"# TYPE {metric} gauge"]
+            lines += [f'{metric}{{profile="{profile}",phase="{name}"}} {round(phase[key], 3)}'
+                      for name, phase in sorted(phases.items())]
+        lines += ["# HELP start_ec2_last_run_timestamp_seconds When the last run finished.",
+                  "# TYPE start_ec2_last_run_timestamp_seconds gauge",
+                  f'start_ec2_last_run_timestamp_seconds{{profile="{profile}"}} {round(time.time(), 3)}']
+        lines += api_calls.prometheus_lines(profile)
+        # node_exporter may read the file at any moment, so it is replaced atomically
+        tmp_path = f"{self.prometheus_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(tmp_path, self.prometheus_path)
+        except OSError as e:
+            logging.error(f"Could not write Prometheus textfile {self.prometheus_path}: {e}")
+
+tracer = Tracer()
+
+# AWS call layer: one rate limit, retry policy and set of timeouts for every EC2 and SSM call
+
+# Upper bounds of the API call latency histogram, in seconds
+API_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Services whose calls go through the shared rate limit; S3 transfers have far higher limits of their own
+RATE_LIMITED_SERVICES = ('ec2', 'ssm')
+
+def count_throttles(context: dict, error_code: str = None) -> int:
+    """Throttled attempts of one call: the retried ones ApiCallLayer counted, plus a final throttling error."""
+    return context.get('throttled_attempts', 0) + (error_code in THROTTLE_ERROR_CODES and not context.get('last_attempt_throttled'))
+
+class TokenBucket:
+    """
+    A token bucket shared by every thread: `rate` calls per second on average, bursts of up to `burst`.
+
+    Callers reserve a token even when the bucket is empty and sleep until it would have refilled,
+    so waiting callers are served in order without polling.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Take one token, sleeping until it is available. Returns the seconds waited."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - 1
+            self.updated = now
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+class LookupBatcher:
+    """
+    Merges concurrent lookups by ID into multi-ID calls.
+
+    `fetch(ids)` makes one call for a list of IDs and returns a dict keyed by ID. A lookup made
+    while no call is in flight goes out straight away; lookups made while one is in flight wait
+    and go out together in the next call, so a lone caller never waits and N threads polling in
+    step cost two calls instead of N.
+    """
+
+    def __init__(self, fetch, max_ids: int = 100):
+        self.fetch = fetch
+        self.max_ids = max_ids
+        self.calls = 0
+        self.lookups = 0
+        self._queue = []
+        self._busy = False
+        self._lock = threading.Lock()
+
+    def lookup(self, ids: list) -> dict:
+        """The entries `fetch` returned for `ids`, as a dict; IDs it did not return are left out."""
+        waiter = {'ids': list(ids), 'wake': threading.Event(), 'done': False, 'result': None, 'error': None}
+        with self._lock:
+            self.lookups += 1
+            self._queue.append(waiter)
+            lead = not self._busy
+            self._busy = True
+        if not lead:
+            waiter['wake'].wait()
+        if not waiter['done']:
+            # First in line: make the call for everyone queued so far
+            self._run_batch()
+        if waiter['error'] is not None:
+            raise waiter['error']
+        return waiter['result']
+
+    def _run_batch(self) -> None:
+        with self._lock:
+            batch, ids = [], []
+            while self._queue and (not batch or len(set(ids + self._queue[0]['ids'])) <= self.max_ids):
+                waiter = self._queue.pop(0)
+                batch.append(waiter)
+                ids += [instance_id for instance_id in waiter['ids'] if instance_id not in ids]
+            self.calls += 1
+        try:
+            results, error = self.fetch(ids), None
+        except BaseException as e:
+            # Every caller in the batch sees the error, and the next batch still gets its turn
+            results, error = {}, e
+        for waiter in batch:
+            waiter['result'] = {key: results[key] for key in waiter['ids'] if key in results}
+            waiter['error'] = error
+            waiter['done'] = True
+            waiter['wake'].set()
+        with self._lock:
+            if self._queue:
+                # Hand the next call to the first waiter still queued
+                self._queue[0]['wake'].set()
+            else:
+                self._busy = False
+
+class ApiCallLayer:
+    """
+    What every EC2 and SSM call goes through: client settings, a shared rate limit, batching and metrics.
+
+    Clients use botocore's adaptive retry mode, which retries throttles and dropped connections
+    with backoff and slows a client down once it is throttled, and short timeouts instead of
+    waiting 15 minutes on a lost packet. On top of that, one TokenBucket paces the calls of all
+    clients and threads, LookupBatcher merges concurrent describe calls, and call counts,
+    throttled attempts, retries and a latency histogram are kept per operation.
+    """
+
+    def __init__(self):
+        self.limiter = None
+        self.settings = {}
+        self.operations = {}
+        self.limiter_wait = 0.0
+        self._batchers = {}
+        self._lock = threading.Lock()
+
+    def configure(self, settings: dict) -> None:
+        self.settings = settings
+        rate = float(settings.get('rate', 10))
+        self.limiter = TokenBucket(rate, float(settings.get('burst', 20))) if rate > 0 else None
+
+    def client_config(self):
+        import botocore.config
+        return botocore.config.Config(
+            connect_timeout=float(self.settings.get('connect_timeout', 5)),
+            read_timeout=float(self.settings.get('read_timeout', 20)),
+            retries={'mode': 'adaptive', 'total_max_attempts': int(self.settings.get('max_attempts', 6))},
+        )
+
+    def install(self, session) -> None:
+        """Apply the rate limit and keep metrics for every client later created from this boto3 session."""
+        # Registered first, so that the limit applies before anything else answers the call
+        session.events.register_first('before-call', self._on_before_call)
+        session.events.register('needs-retry', self._on_needs_retry)
+        session.events.register('after-call', self._on_after_call)
+        session.events.register('after-call-error', self._on_after_call_error)
+
+    def batcher(self, name: str, client, fetch, max_ids: int = 100) -> LookupBatcher:
+        """The LookupBatcher for `name` calls made with `client`, created on first use."""
+        with self._lock:
+            key = (name, id(client))
+            if key not in self._batchers:
+                self._batchers[key] = LookupBatcher(fetch, max_ids)
+            return self._batchers[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            operations = {name: dict(entry, buckets=list(entry['buckets'])) for name, entry in self.operations.items()}
+            batching = {}
+            for (name, _), batcher in self._batchers.items():
+                entry = batching.setdefault(name, {'lookups': 0, 'calls': 0})
+                entry['lookups'] += batcher.lookups
+                entry['calls'] += batcher.calls
+        return {
+            'calls': sum(entry['calls'] for entry in operations.values()),
+            'throttles': sum(entry['throttles'] for entry in operations.values()),
+            'retries': sum(entry['retries'] for entry in operations.values()),
+            'errors': sum(entry['errors'] for entry in operations.values()),
+            'rate_limit_wait_seconds': round(self.limiter_wait, 3),
+            'operations': {name: {
+                'calls': entry['calls'],
+                'throttles': entry['throttles'],
+                'retries': entry['retries'],
+                'errors': entry['errors'],
+                'mean_seconds': round(entry['seconds'] / entry['calls'], 3),
+                'max_seconds': round(entry['max_seconds'], 3),
+                'histogram': dict(zip([str(bound) for bound in API_LATENCY_BUCKETS] + ['+Inf'], entry['buckets'])),
+            } for name, entry in sorted(operations.items())},
+            'batching': batching,
+        }
+
+    def prometheus_lines(self, profile: str) -> list:
+        """The call metrics in the Prometheus text format, cumulative over the life of the process."""
+        stats = self.stats()
+        lines = ["# HELP start_ec2_api_call_duration_seconds AWS API call latency, retries included.",
+                 "# TYPE start_ec2_api_call_duration_seconds histogram"]
+        for name, entry in stats['operations'].items():
+            labels = f'profile="{profile}",operation="{name}"'
+            cumulative = 0
+            for bound, count in entry['histogram'].items():
+                cumulative += count
+                lines.append(f'start_ec2_api_call_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"start_ec2_api_call_duration_seconds_sum{{{labels}}} {round(entry['mean_seconds'] * entry['calls'], 3)}")
+            lines.append(f"start_ec2_api_call_duration_seconds_count{{{labels}}} {entry['calls']}")
+        for metric, key, description in (
+            ('start_ec2_api_throttles_total', 'throttles', 'Throttled AWS API attempts.'),
+            ('start_ec2_api_retries_total', 'retries', 'AWS API retries.'),
+            ('start_ec2_api_errors_total', 'errors', 'AWS API calls that failed.'),
+        ):
+            lines += [f"# HELP {metric} {description}", f"# TYPE {metric} counter"]
+            lines += [f'{metric}{{profile="{profile}",operation="{name}"}} {entry[key]}'
+                      for name, entry in stats['operations'].items()]
+        lines += ["# HELP start_ec2_api_rate_limit_wait_seconds_total Time calls waited for the shared rate limit.",
+                  "# TYPE start_ec2_api_rate_limit_wait_seconds_total counter",
+                  f'start_ec2_api_rate_limit_wait_seconds_total{{profile="{profile}"}} {stats["rate_limit_wait_seconds"]}']
+        return lines
+
+    def _on_before_call(self, model, context, **kwargs) -> None:
+        context['operation'] = model.name
+        if self.limiter is not None and model.service_model.service_name in RATE_LIMITED_SERVICES:
+            waited = self.limiter.acquire()
+            if waited:
+                with self._lock:
+                    self.limiter_wait += waited
+        context['started'] = time.monotonic()
+
+    def _on_needs_retry(self, response, request_dict, **kwargs) -> None:
+        # Called after every attempt, before the retry handler decides; the decision is left to it
+        context = request_dict.get('context', {})
+        error_code = response[1].get('Error', {}).get('Code') if response else None
+        throttled = error_code in THROTTLE_ERROR_CODES
+        context['throttled_attempts'] = context.get('throttled_attempts', 0) + throttled
+        context['last_attempt_throttled'] = throttled
+
+    def _on_after_call(self, http_response, parsed, model, context, **kwargs) -> None:
+        error_code = parsed.get('Error', {}).get('Code') if http_response.status_code >= 300 else None
+        self._record(model.name, context, parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0),
+                     error_code is not None, count_throttles(context, error_code))
+
+    def _on_after_call_error(self, exception, context, **kwargs) -> None:
+        self._record(context.get('operation', 'unknown'), context, 0, True, count_throttles(context))
+
+    def _record(self, operation: str, context: dict, retries: int, failed: bool, throttles: int) -> None:
+        seconds = time.monotonic() - context.get('started', time.monotonic())
+        with self._lock:
+            entry = self.operations.setdefault(operation, {
+                'calls': 0, 'throttles': 0, 'retries': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                'buckets': [0] * (len(API_LATENCY_BUCKETS) + 1),
+            })
+            entry['calls'] += 1
+            entry['throttles'] += throttles
+            entry['retries'] += retries
+            entry['errors'] += failed
+            entry['seconds'] += seconds
+            entry['max_seconds'] = max(entry['max_seconds'], seconds)
+            entry['buckets'][bisect.bisect_left(API_LATENCY_BUCKETS, seconds)] += 1
+
+api_calls = ApiCallLayer()
+
+# Instance bootstrap: updating git checkouts in parallel at first boot
+
+BOOTSTRAP_REPORT_PATH = '/var/log/start-ec2-bootstrap.json'
+
+# Body of the generated bootstrap script. It expects `repos`, `repo_dirs`, REPORT, PARALLELISM,
+# REPO_TIMEOUT and GIT_DEPTH to be set above it. Each checkout is pulled as its owner, because
+# git refuses to work in repositories owned by another user, and leaves one JSON line behind.
+BOOTSTRAP_PULL_SCRIPT = r'''
+WORK=$(mktemp -d)
+STARTED=$(date +%s.%N)
+for parent in "${repo_dirs[@]}"; do
+    for dir in "$parent"/*/; do
+        [ -e "$dir/.git" ] && repos+=("${dir%/}")
+    done
+done
+
+run_git() {
+    timeout "$REPO_TIMEOUT" sudo -u "$owner" -H git -C "$dir" -c http.lowSpeedLimit=1000 -c http.lowSpeedTime=30 "$@"
+}
+
+pull_repo() {
+    dir="$1"
+    entry="$WORK/$(printf '%s' "$dir" | md5sum | cut -c1-16)"
+    start=$(date +%s.%N)
+    before="" after="" error=""
+    if [ ! -e "$dir/.git" ]; then
+        status=missing
+    else
+        owner=$(stat -c %U "$dir")
+        before=$(run_git rev-parse --short HEAD 2>/dev/null)
+        if [ "$GIT_DEPTH" -gt 0 ]; then
+            run_git pull --ff-only --quiet --no-tags --depth "$GIT_DEPTH" > "$entry.log" 2>&1
+            code=$?
+            # A checkout more than GIT_DEPTH commits behind cannot fast-forward onto the shallow fetch
+            if [ $code -ne 0 ] && [ $code -ne 124 ] && grep -q 'fast-forward' "$entry.log"; then
+                unshallow=()
+                [ "$(run_git rev-parse --is-shallow-repository)" = true ] && unshallow=(--unshallow)
+                run_git pull --ff-only --quiet --no-tags "${unshallow[@]}" > "$entry.log" 2>&1
+                code=$?
+            fi
+        else
+            run_git pull --ff-only --quiet > "$entry.log" 2>&1
+            code=$?
+        fi
+        after=$(run_git rev-parse --short HEAD 2>/dev/null)
+        if [ $code -eq 124 ]; then
+            status=timeout
+        elif [ $code -ne 0 ]; then
+            status=failed
+            error=$( (grep -m 1 -E '^(fatal|error):' "$entry.log" || tail -n 1 "$entry.log") | tr -d '"\\\000-\037')
+        elif [ "$before" != "$after" ]; then
+            status=updated
+        else
+            status=unchanged
+        fi
+    fi
+    seconds=$(awk "BEGIN {printf \"%.2f\", $(date +%s.%N) - $start}")
+    printf '{"repo": "%s", "status": "%s", "seconds": %s, "before": "%s", "after": "%s", "error": "%s"}\n' \
+        "$dir" "$status" "$seconds" "$before" "$after" "$error" > "$entry.json"
+}
+export -f run_git pull_repo
+export WORK REPO_TIMEOUT GIT_DEPTH
+
+printf '%s\0' "${repos[@]}" | xargs -0 -r -n 1 -P "$PARALLELISM" bash -c 'pull_repo "$1"' _
+
+{
+    printf '{"started": %s, "seconds": %s, "parallelism": %s, "repos": [' \
+        "${STARTED%.*}" "$(awk "BEGIN {printf \"%.2f\", $(date +%s.%N) - $STARTED}")" "$PARALLELISM"
+    cat "$WORK"/*.json 2>/dev/null | paste -sd, -
+    printf ']}\n'
+} > "$REPORT.tmp" && mv "$REPORT.tmp" "$REPORT"
+rm -rf "$WORK"
+'''
+
+def build_bootstrap_script(bootstrap: dict) -> str:
+    """
+    The user data script for the `bootstrap` section of config.yaml.
+
+    Every checkout in `repos`, and every checkout directly inside one of `repo_dirs`, is pulled
+    `parallelism` at a time with a fetch depth of `depth` (0 pulls full history; a checkout
+    further behind falls back to a full fetch) and at most `timeout` seconds each. The outcome
+    and time of every pull is written as JSON to `report`, then `commands` run in order.
+    """
+    lines = [
+        "#!/bin/bash",
+        "# Generated by start-ec2.py from the bootstrap section of config.yaml",
+        f"REPORT={shlex.quote(bootstrap.get('report', BOOTSTRAP_REPORT_PATH))}",
+        f"PARALLELISM={int(bootstrap.get('parallelism', 8))}",
+        f"REPO_TIMEOUT={int(bootstrap.get('timeout', 120))}",
+        f"GIT_DEPTH={int(bootstrap.get('depth', 50))}",
+        "repos=(" + " ".join(shlex.quote(str(repo)) for repo in bootstrap.get('repos') or []) + ")",
+        "repo_dirs=(" + " ".join(shlex.quote(str(directory)) for directory in bootstrap.get('repo_dirs') or []) + ")",
+    ]
+    script = "\n".join(lines) + BOOTSTRAP_PULL_SCRIPT
+    for command in bootstrap.get('commands') or []:
+        script += command.rstrip() + "\n"
+    return script
+
+def get_user_data() -> str:
+    """User data for new instances: the generated bootstrap script if configured, otherwise `user_data` as written."""
+    bootstrap = config.get('bootstrap')
+    if not bootstrap:
+        return user_data
+    if user_data:
+        logging.warning("Both bootstrap and user_data are configured; using the script generated from bootstrap.")
+    return build_bootstrap_script(bootstrap)
+
+def fetch_bootstrap_report(ssm, instance_id: str) -> dict:
+    """The bootstrap report written on the instance, read over SSM, or None if the bootstrap has not finished."""
+    path = (config.get('bootstrap') or {}).get('report', BOOTSTRAP_REPORT_PATH)
+    result = run_ssm_command(ssm, instance_id, [f"cat {shlex.quote(path)} 2>/dev/null || true"])
+    try:
+        return json.loads(result['stdout']) if result['status'] == 'Success' and result['stdout'].strip() else None
+    except ValueError:
+        return None
+
+def summarize_bootstrap_report(report: dict) -> str:
+    counts = {}
+    for repo in report['repos']:
+        counts[repo['status']] = counts.get(repo['status'], 0) + 1
+    slowest = max(report['repos'], key=lambda repo: repo['seconds'], default=None)
+    started = datetime.datetime.fromtimestamp(report['started']).strftime('%Y-%m-%d %H:%M:%S')
+    return (f"{len(report['repos'])} repo(s) pulled in {report['seconds']}s, {report['parallelism']} at a time, "
+            f"started {started} (" + ", ".join(f"{count} {status}" for status, count in sorted(counts.items())) + ")"
+            + (f"; slowest {slowest['repo']} {slowest['seconds']}s" if slowest else ""))
+
+def watch_bootstrap_reports(ssm, instance_ids: list, timeout: float = 900, interval: float = 15) -> None:
+    """Log each instance's bootstrap report once it has been written. Runs on a background thread."""
+    pending = list(instance_ids)
+    deadline = time.monotonic() + timeout
+    while pending and time.monotonic() < deadline:
+        for instance_id in list(pending):
+            try:
+                report = fetch_bootstrap_report(ssm, instance_id)
+            except ClientError as e:
+                logging.warning(f"Could not read the bootstrap report of {instance_id}: {e}")
+                return
+            if report is not None:
+                pending.remove(instance_id)
+                logging.info(f"Bootstrap of {instance_id}: {summarize_bootstrap_report(report)}.")
+                for repo in report['repos']:
+                    if repo['status'] in ('failed', 'timeout', 'missing'):
+                        logging.warning(f"Bootstrap of {instance_id}: {repo['repo']} {repo['status']}"
+                                        + (f": {repo['error']}" if repo.get('error') else ""))
+        if pending:
+            time.sleep(interval)
+
+def start_bootstrap_report_watch(ssm, instance_ids: list) -> None:
+    if config.get('bootstrap'):
+        threading.Thread(target=watch_bootstrap_reports, args=(ssm, instance_ids), daemon=True).start()
+
+def print_bootstrap_report(instance_id: str, report: dict) -> None:
+    if report is None:
+        print(f"{instance_id}: no bootstrap report yet.")
+        return
+    print(f"{instance_id}: {summarize_bootstrap_report(report)}")
+    for repo in sorted(report['repos'], key=lambda repo: repo['seconds'], reverse=True):
+        change = f" ({repo['before']} -> {repo['after']})" if repo['status'] == 'updated' else ""
+        error = f"  {repo['error']}" if repo.get('error') else ""
+        print(f"  {repo['status']:<10} {repo['seconds']:>7.2f}s  {repo['repo']}{change}{error}")
+
+# EBS warm-up: volumes created from a snapshot fetch each block from S3 on its first read
+
+WARM_UP_DIR = '/var/tmp/start-ec2-warm-up'
+
+# Reads every file under the given directories once, PARALLELISM at a time, appending the size
+# of each finished file to $WORK/done so that progress can be read while it runs
+PRE_READ_SCRIPT = r'''WORK="$1"; PARALLELISM="$2"; shift 2
+find "$@" -type f -print0 2>/dev/null |
+    xargs -0 -r -n 1 -P "$PARALLELISM" sh -c 'dd if="$1" of=/dev/null bs=4M status=none; stat -c %s "$1" >> "$0/done"' "$WORK"
+date +%s.%N > "$WORK/finished"
+'''
+
+def get_ami_snapshot_ids(ec2_client, image_id: str) -> list:
+    images = ec2_client.describe_images(ImageIds=[image_id])['Images']
+    return [mapping['Ebs']['SnapshotId'] for image in images for mapping in image.get('BlockDeviceMappings', [])
+            if mapping.get('Ebs', {}).get('SnapshotId')]
+
+def ensure_fast_snapshot_restore(ec2_client, availability_zones: list) -> dict:
+    """
+    Enable fast snapshot restore for the AMI's snapshots in `availability_zones` and log its state.
+
+    Volumes created while it is 'enabled' are fully initialized at launch. Enabling takes minutes
+    to hours and is billed per snapshot and zone for as long as it stays on, so it is left on
+    for later launches. Returns the state keyed by 'snapshot_id|availability_zone'.
+    """
+    if not aws_ami:
+        logging.warning("Fast snapshot restore needs ami in config.yaml to find the snapshots.")
+        return {}
+    try:
+        snapshot_ids = get_ami_snapshot_ids(ec2_client, aws_ami)
+        states = {}
+        paginator = ec2_client.get_paginator('describe_fast_snapshot_restores')
+        for page in paginator.paginate(Filters=[{'Name': 'snapshot-id', 'Values': snapshot_ids},
+                                                {'Name': 'availability-zone', 'Values': availability_zones}]):
+            for restore in page['FastSnapshotRestores']:
+                states[f"{restore['SnapshotId']}|{restore['AvailabilityZone']}"] = restore['State']
+        missing = [(snapshot_id, zone) for snapshot_id in snapshot_ids for zone in availability_zones
+                   if states.get(f"{snapshot_id}|{zone}") in (None, 'disabling', 'disabled')]
+        if missing:
+            response = ec2_client.enable_fast_snapshot_restores(
+                AvailabilityZones=sorted({zone for _, zone in missing}),
+                SourceSnapshotIds=sorted({snapshot_id for snapshot_id, _ in missing}),
+            )
+            for restore in response.get('Successful', []):
+                states[f"{restore['SnapshotId']}|{restore['AvailabilityZone']}"] = restore['State']
+            for failure in response.get('Unsuccessful', []):
+                for error in failure.get('FastSnapshotRestoreStateErrors', []):
+                    logging.warning(f"Could not enable fast snapshot restore for {failure['SnapshotId']} in "
+                                    f"{error.get('AvailabilityZone')}: {error.get('Error', {}).get('Message')}")
     except ClientError as e:
-        logging.error(f"An AWS client error occurred while creating the instance: {e}")
-        logging.error(traceback.format_exc()) 
+        logging.warning(f"Could not set up fast snapshot restore: {e}")
+        return {}
+    for key, state in sorted(states.items()):
+        snapshot_id, zone = key.split('|')
+        logging.info(f"Fast snapshot restore for {snapshot_id} in {zone} is {state}"
+                     + ("." if state == 'enabled' else "; volumes launched now are still restored lazily."))
+    return states
+
+def start_pre_read(ssm, instance_id: str, directories: list, parallelism: int) -> None:
+    """Start reading every file under `directories` on the instance in the background, so that the reads hydrate its volume."""
+    script = [
+        f"WORK={WARM_UP_DIR}",
+        'rm -rf "$WORK" && mkdir -p "$WORK"',
+        "DIRS=(" + " ".join(shlex.quote(directory) for directory in directories) + ")",
+        "find \"${DIRS[@]}\" -type f -printf '%s\\n' 2>/dev/null | awk '{s += $1} END {print s + 0}' > \"$WORK/total\"",
+        'date +%s.%N > "$WORK/started"',
+        "cat > \"$WORK/pre-read.sh\" <<'EOF'",
+        *PRE_READ_SCRIPT.splitlines(),
+        "EOF",
+        f'setsid nohup bash "$WORK/pre-read.sh" "$WORK" {int(parallelism)} "${{DIRS[@]}}" < /dev/null > "$WORK/log" 2>&1 &',
+    ]
+    result = run_ssm_command(ssm, instance_id, script, timeout=300)
+    if result['status'] != 'Success':
+        raise RuntimeError(f"starting the warm-up on {instance_id} failed ({result['status']}): {result['stderr'].strip()}")
+
+def read_pre_read_progress(ssm, instance_id: str) -> dict:
+    """Bytes to read and read so far, and the start and finish times, of the instance's warm-up."""
+    script = [
+        f"cd {WARM_UP_DIR} || exit 1",
+        "printf '{\"total\": %s, \"read\": %s, \"started\": %s, \"finished\": %s}\\n' \"$(cat total)\" "
+        "\"$(cat done 2>/dev/null | awk '{s += $1} END {print s + 0}')\" \"$(cat started)\" \"$(cat finished 2>/dev/null || echo null)\"",
+    ]
+    result = run_ssm_command(ssm, instance_id, script)
+    if result['status'] != 'Success':
+        return None
+    try:
+        return json.loads(result['stdout'])
+    except ValueError:
+        return None
+
+def watch_pre_read(ssm, instance_id: str, interval: float, timeout: float = 6 * 3600) -> None:
+    """Log the progress and read throughput of the warm-up until it finishes. Runs on a background thread."""
+    state_store = StateStore(os.path.join(CACHE_DIR, 'state.json'), STATE_PROFILE)
+    deadline = time.monotonic() + timeout
+    with tracer.span('warm_up', instance_id=instance_id) as span:
+        while time.monotonic() < deadline:
+            time.sleep(interval)
+            try:
+                progress = read_pre_read_progress(ssm, instance_id)
+            except ClientError as e:
+                logging.warning(f"Could not read the warm-up progress of {instance_id}: {e}")
+                span.end('error', error=str(e))
+                return
+            if progress is None:
+                continue
+            finished = progress['finished'] is not None
+            seconds = (progress['finished'] if finished else time.time()) - progress['started']
+            progress['mb_per_second'] = megabytes_per_second(progress['read'], seconds)
+            progress['percent'] = round(100 * progress['read'] / progress['total']) if progress['total'] else 100
+            state_store.put(f"warm_up:{instance_id}", progress, ttl=24 * 3600)
+            if finished:
+                logging.info(f"Warm-up of {instance_id} finished: {progress['read'] / 1e9:.2f} GB read in {seconds:.0f}s "
+                             f"({progress['mb_per_second']} MB/s).")
+                span.end(bytes_read=progress['read'], mb_per_second=progress['mb_per_second'])
+                return
+            logging.info(f"Warm-up of {instance_id}: {progress['read'] / 1e9:.2f} of {progress['total'] / 1e9:.2f} GB "
+                         f"read ({progress['percent']}%), {progress['mb_per_second']} MB/s.")
+        span.end('timeout')
+
+def start_warm_up(ssm, instance_ids: list) -> None:
+    """Pre-read the `warm_up` directories on freshly launched instances, reporting progress in the background."""
+    directories = warm_up_config.get('directories')
+    if not directories:
+        return
+    for instance_id in instance_ids:
+        try:
+            start_pre_read(ssm, instance_id, directories, int(warm_up_config.get('parallelism', 8)))
+        except (ClientError, RuntimeError) as e:
+            logging.warning(f"Could not start the warm-up of {instance_id}: {e}")
+            continue
+        logging.info(f"Warm-up of {instance_id} started: pre-reading {', '.join(directories)}.")
+        threading.Thread(target=watch_pre_read, args=(ssm, instance_id, float(warm_up_config.get('progress_interval', 30))),
+                         daemon=True).start()
+
+# Create a new instance
+def build_run_instances_request(instance_count: int, availability_zone: str = None,
+                                instance_type: str = None) -> dict:
+    """
+    Build a RunInstances request that launches, tags and bootstraps spot instances in one call.
+
+    When a launch template is configured it provides the defaults and only the values set in
+    config.yaml are sent as overrides.
+    """
+    tags = [{'Key': aws_tag_key, 'Value': aws_tag_value}]
+    interruption_behavior = lifecycle_config.get('interruption_behavior', 'terminate')
+    # Only instances from a persistent spot request can be stopped and started again
+    keeps_stopped = (interruption_behavior != 'terminate' or lifecycle_config.get('warm_pool_size')
+                     or lifecycle_config.get('on_exit') in ('stop', 'hibernate'))
+    if keeps_stopped and interruption_behavior == 'terminate':
+        # EC2 refuses a persistent request whose instances are terminated on interruption
+        interruption_behavior = 'hibernate' if lifecycle_config.get('on_exit') == 'hibernate' else 'stop'
+    request = {
+        'MinCount': instance_count,
+        'MaxCount': instance_count,
+        # Makes a retried call return the original launch instead of starting a second one
+        'ClientToken': str(uuid.uuid4()),
+        'InstanceType': instance_type or aws_instance_type,
+        'Placement': {'AvailabilityZone': availability_zone or aws_availability_zone},
+        'InstanceMarketOptions': {
+            'MarketType': 'spot',
+            'SpotOptions': {
+                'MaxPrice': str(aws_max_spot_price),
+                'SpotInstanceType': 'persistent' if keeps_stopped else 'one-time',
+                'InstanceInterruptionBehavior': interruption_behavior,
+            },
+        },
+        'TagSpecifications': [
+            {'ResourceType': resource_type, 'Tags': tags}
+            for resource_type in ('instance', 'volume', 'spot-instances-request')
+        ],
+    }
+    if launch_template_config:
+        template = {'Version': str(launch_template_config.get('version', '$Latest'))}
+        if launch_template_config.get('id'):
+            template['LaunchTemplateId'] = launch_template_config['id']
+        else:
+            template['LaunchTemplateName'] = launch_template_config['name']
+        request['LaunchTemplate'] = template
+    if aws_ami:
+        request['ImageId'] = aws_ami
+    if aws_key_name:
+        request['KeyName'] = aws_key_name
+    if aws_security_groups:
+        request['SecurityGroupIds'] = aws_security_groups
+    if aws_iam_instance_profile:
+        request['IamInstanceProfile'] = {'Arn': aws_iam_instance_profile}
+    bootstrap_script = get_user_data()
+    if bootstrap_script:
+        # botocore base64-encodes UserData for RunInstances itself
+        request['UserData'] = bootstrap_script
+    if lifecycle_config.get('hibernation') or interruption_behavior == 'hibernate':
+        # Needs an encrypted root volume large enough to hold the instance's memory
+        request['HibernationOptions'] = {'Configured': True}
+    return request
+
+def create_instances(ec2_client, instance_count: int = 1, availability_zone: str = None,
+                     instance_type: str = None) -> list:
+    try:
+        with tracer.span('spot_request', availability_zone=availability_zone or aws_availability_zone,
+                         instance_type=instance_type or aws_instance_type, instance_count=instance_count):
+            response = ec2_client.run_instances(**build_run_instances_request(instance_count, availability_zone, instance_type))
+        return response['Instances']
+    except ClientError as e:
+        if not is_capacity_error(e):
+            logging.error(f"An AWS client error occurred while creating the instance: {e}")
+            logging.error(traceback.format_exc())
         raise
     except Exception as e:
         logging.error(f"An error occurred while creating the instance: {e}")
-        logging.error(traceback.format_exc())  
+        logging.error(traceback.format_exc())
         raise
 
-def add_tags_to_instance(ec2_client, instance_id: str):
+# RunInstances error codes that mean "try another pool"
+CAPACITY_ERROR_CODES = {
+    'InsufficientInstanceCapacity', 'InsufficientCapacity', 'SpotMaxPriceTooLow',
+    'MaxSpotInstanceCountExceeded', 'Unsupported',
+}
+
+class SpotCapacityError(Exception):
+    """Raised when a spot pool cannot satisfy a request and another pool should be tried."""
+
+def is_capacity_error(e: Exception) -> bool:
+    if isinstance(e, SpotCapacityError):
+        return True
+    return isinstance(e, ClientError) and e.response.get('Error', {}).get('Code') in CAPACITY_ERROR_CODES
+
+def launch_spot_instances(ec2_client, instance_count: int, availability_zone: str = None,
+                          instance_type: str = None, attempt: dict = None) -> list:
+    """
+    Launch `instance_count` tagged spot instances in one pool with a single RunInstances call.
+
+    The instance and spot request IDs are recorded in `attempt` so that a placement race can
+    release them if another pool wins. Fulfilment is then tracked by the readiness engine.
+    """
+    attempt = attempt if attempt is not None else {}
+    instances = create_instances(ec2_client, instance_count, availability_zone, instance_type)
+    attempt['instance_ids'] = [instance['InstanceId'] for instance in instances]
+    attempt['request_ids'] = [instance['SpotInstanceRequestId'] for instance in instances
+                              if instance.get('SpotInstanceRequestId')]
+    for instance in instances:
+        logging.info(f"Launched instance {instance['InstanceId']} ({instance['InstanceType']}, "
+                     f"spot request {instance.get('SpotInstanceRequestId', 'n/a')}), state {instance['State']['Name']}.")
+    return attempt['instance_ids']
+
+def load_spot_price_cache() -> dict:
     try:
-        ec2_client.create_tags(
-            Resources=[instance_id],
-            Tags=[
-                {
-                    'Key': aws_tag_key,
-                    'Value': aws_tag_value
-                },
-            ]
-        )
-        logging.info(f"Tags successfully added to the instance {instance_id}")
+        with open(os.path.join(CACHE_DIR, 'spot-prices.json'), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def save_spot_price_cache(cache: dict) -> None:
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(os.path.join(CACHE_DIR, 'spot-prices.json'), 'w') as f:
+            json.dump(cache, f)
+    except OSError as e:
+        logging.warning(f"Could not write the spot price cache: {e}")
+
+def get_spot_prices(ec2_client, availability_zones: list, instance_types: list, ttl: float = 900) -> dict:
+    """
+    Current spot price for every (availability zone, instance type) pool, cached on disk for `ttl` seconds.
+
+    Pools without a price, such as an instance type not offered in a zone, are left out of the
+    result; the cache remembers which pools were asked for, so they do not force a new lookup.
+
+    Returns:
+        dict: Price in USD/hour keyed by 'availability_zone|instance_type'.
+    """
+    wanted = {f"{zone}|{instance_type}" for zone in availability_zones for instance_type in instance_types}
+    cache = load_spot_price_cache()
+    entry = cache.get(aws_region, {})
+    if time.time() - entry.get('fetched_at', 0) < ttl and wanted <= set(entry.get('pools', [])):
+        logging.info("Using cached spot prices.")
+        return {pool: entry['prices'][pool] for pool in wanted if pool in entry['prices']}
+
+    prices, latest = {}, {}
+    paginator = ec2_client.get_paginator('describe_spot_price_history')
+    # With StartTime set to now the API returns just the price currently in effect for each pool
+    for page in paginator.paginate(
+        InstanceTypes=instance_types,
+        ProductDescriptions=['Linux/UNIX'],
+        StartTime=datetime.datetime.now(datetime.timezone.utc),
+    ):
+        for item in page['SpotPriceHistory']:
+            pool = f"{item['AvailabilityZone']}|{item['InstanceType']}"
+            if pool in wanted and (pool not in latest or item['Timestamp'] > latest[pool]):
+                latest[pool] = item['Timestamp']
+                prices[pool] = float(item['SpotPrice'])
+
+    cache[aws_region] = {'fetched_at': time.time(), 'pools': sorted(wanted), 'prices': prices}
+    save_spot_price_cache(cache)
+    return prices
+
+def rank_spot_pools(ec2_client) -> list:
+    """
+    Candidate (availability zone, instance type, price) pools, cheapest first.
+
+    Without a `placement` section in config.yaml this is just the configured zone and type.
+    Pools priced above `max_spot_price` are dropped.
+    """
+    availability_zones = placement_config.get('availability_zones') or [aws_availability_zone]
+    instance_types = placement_config.get('instance_types') or [aws_instance_type]
+    if len(availability_zones) == 1 and len(instance_types) == 1:
+        return [(availability_zones[0], instance_types[0], None)]
+
+    try:
+        prices = get_spot_prices(ec2_client, availability_zones, instance_types,
+                                 placement_config.get('price_cache_ttl', 900))
     except ClientError as e:
-        logging.error(f"Failed to add tags to the instance {instance_id}: {e}")
-        raise
+        logging.warning(f"Could not fetch spot prices, using the configured order instead: {e}")
+        prices = {}
 
-def wait_for_instance_status_ok(ec2_client, instance_id: str):
+    pools = []
+    for zone in availability_zones:
+        for instance_type in instance_types:
+            price = prices.get(f"{zone}|{instance_type}")
+            if price is not None and price > float(aws_max_spot_price):
+                logging.info(f"Skipping {instance_type} in {zone}: spot price {price} is above {aws_max_spot_price}.")
+                continue
+            pools.append((zone, instance_type, price))
+    # Pools without a price keep their configured order after the priced ones
+    pools.sort(key=lambda pool: pool[2] if pool[2] is not None else float('inf'))
+    return pools
+
+def release_placement_attempt(ec2_client, attempt: dict) -> None:
+    """Cancel the spot requests and terminate the instances of a losing placement attempt."""
     try:
-        waiter = ec2_client.get_waiter('instance_status_ok')
-        waiter.wait(InstanceIds=[instance_id])
-        logging.info(f"Instance {instance_id} has passed status checks.")
+        if attempt.get('request_ids'):
+            ec2_client.cancel_spot_instance_requests(SpotInstanceRequestIds=attempt['request_ids'])
+        if attempt.get('instance_ids'):
+            ec2_client.terminate_instances(InstanceIds=attempt['instance_ids'])
+            logging.info(f"Terminated instance(s) {', '.join(attempt['instance_ids'])} from a losing placement attempt.")
     except ClientError as e:
-        logging.error(f"An AWS client error occurred while waiting for the instance status: {e}")
-        raise
+        logging.error(f"Failed to release placement attempt {attempt}: {e}")
+
+def _launch_and_wait(ec2_client, ssm, instance_count: int, pool: tuple, attempt: dict,
+                     cancelled: threading.Event) -> list:
+    zone, instance_type, price = pool
+    logging.info(f"Trying {instance_type} in {zone}" + (f" at ${price}/h" if price is not None else "") + "...")
+    instance_ids = launch_spot_instances(ec2_client, instance_count, zone, instance_type, attempt)
+    if cancelled.is_set():
+        release_placement_attempt(ec2_client, attempt)
+        raise SpotCapacityError(f"{instance_type} in {zone} lost the placement race")
+    with ThreadPoolExecutor(max_workers=len(instance_ids)) as pool_:
+        results = list(pool_.map(lambda instance_id: wait_for_instance_ready(ec2_client, ssm, instance_id), instance_ids))
+    if any(result is None for result in results):
+        raise SpotCapacityError(f"Instance(s) in {zone} did not become ready")
+    return instance_ids
+
+def launch_with_placement(ec2_client, ssm, instance_count: int) -> list:
+    """
+    Launch `instance_count` instances in the best spot pool and wait until they are ready.
+
+    The cheapest pool is tried first. If it has no capacity, the next `race_width` pools are
+    requested at the same time; the first to become ready is kept and the others are cancelled.
+    Errors other than a lack of capacity end the search and are raised.
+
+    Returns:
+        list: The ready instance IDs, or None if no pool could provide them.
+    """
+    span = tracer.start('fulfilment', instance_count=instance_count)
+    pools = rank_spot_pools(ec2_client)
+    if not pools:
+        logging.error(f"No spot pool is priced at or below max_spot_price {aws_max_spot_price}.")
+        span.end('error', error="no spot pool within max_spot_price")
+        return None
+    if warm_up_config.get('fast_snapshot_restore'):
+        # Only helps once it is enabled, which takes longer than a launch, so it is not waited for
+        threading.Thread(target=ensure_fast_snapshot_restore, args=(ec2_client, sorted({pool[0] for pool in pools})),
+                         daemon=True).start()
+    race_width = int(placement_config.get('race_width', 2))
+    batches = [pools[:1]] + [pools[i:i + race_width] for i in range(1, len(pools), race_width)]
+
+    for batch in batches:
+        cancelled = threading.Event()
+        attempts = {pool: {} for pool in batch}
+        executor = ThreadPoolExecutor(max_workers=len(batch))
+        futures = {
+            executor.submit(_launch_and_wait, ec2_client, ssm, instance_count, pool, attempts[pool], cancelled): pool
+            for pool in batch
+        }
+        winner = None
+        pending = set(futures)
+        while pending and winner is None:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pool = futures[future]
+                try:
+                    instance_ids = future.result()
+                except Exception as e:
+                    release_placement_attempt(ec2_client, attempts[pool])
+                    if not is_capacity_error(e):
+                        # Anything else, such as missing permissions or a bad AMI, fails the same way in every pool
+                        logging.error(f"Launch in {pool[1]}/{pool[0]} failed: {e}")
+                        cancelled.set()
+                        for other in batch:
+                            if other != pool:
+                                release_placement_attempt(ec2_client, attempts[other])
+                        executor.shutdown(wait=False)
+                        span.end('error', error=str(e))
+                        raise
+                    logging.info(f"No capacity for {pool[1]} in {pool[0]}: {e}")
+                    continue
+                if winner is None:
+                    winner = (pool, instance_ids)
+                else:
+                    release_placement_attempt(ec2_client, attempts[pool])
+
+        if winner is not None:
+            cancelled.set()
+            for pool in batch:
+                if pool != winner[0]:
+                    release_placement_attempt(ec2_client, attempts[pool])
+            # Losing attempts notice the cancellation on their own; do not wait for them
+            executor.shutdown(wait=False)
+            logging.info(f"Placed {instance_count} instance(s) as {winner[0][1]} in {winner[0][0]}.")
+            span.end(availability_zone=winner[0][0], instance_type=winner[0][1])
+            return winner[1]
+        executor.shutdown(wait=False)
 
-def run_instance(ec2_client) -> str:
+    logging.error("No candidate spot pool could provide capacity.")
+    span.end('error', error="no capacity in any candidate pool")
+    return None
+
+def run_instance(ec2_client, ssm) -> str:
+    """Launch one instance. Errors other than a lack of capacity are raised for the caller to report."""
     logging.info("Creating a new instance...")
-    try:
-        response = create_spot_instance_request(ec2_client)
-        instance_id = response['SpotInstanceRequests'][0]['InstanceId']
-        add_tags_to_instance(ec2_client, instance_id)
-        wait_for_instance_status_ok(ec2_client, instance_id)
-        return instance_id
-    except Exception as e:
-        logging.error(f"An error occurred while running the instance: {e}")
-        logging.error(traceback.format_exc())  # Add this line
+    instance_ids = launch_with_placement(ec2_client, ssm, 1)
+    if not instance_ids:
         return None
-    
-def get_instance_id_by_tag(ec2_resource, tag_key: str, tag_value: str) -> str:
-    instances = ec2_resource.instances.filter(
-        Filters=[
-            {'Name': f'tag:{tag_key}', 'Values': [tag_value]},
-            {'Name': 'instance-state-name', 'Values': ['pending', 'running', 'stopping', 'stopped']}
-        ])
-    for instance in instances:
-        return instance.id
-    logging.info(f"No instances with tag key '{tag_key}' and value '{tag_value}' found.")
-    return ""
-
-def wait_for_instance(ec2_client, instance_id: str, status_type: str) -> None:
-    waiter = ec2_client.get_waiter(status_type)
-    waiter.wait(InstanceIds=[instance_id])
-    logging.info(f"Instance {instance_id} has passed {status_type.replace('_', ' ')}.")
-
-def start_instance_if_stopped(ec2_resource, ec2_client, instance_id: str) -> None:
-    instance = ec2_resource.Instance(instance_id)
-    if instance.state['Name'] != 'running':
-        logging.info(f"Starting instance {instance_id}...")
-        instance.start()
-        wait_for_instance(ec2_client, instance_id, 'instance_running')
-        wait_for_instance(ec2_client, instance_id, 'instance_status_ok')
-        wait_for_instance(ec2_client, instance_id, 'system_status_ok')
+    start_warm_up(ssm, instance_ids)
+    return instance_ids[0]
 
-def check_existing_ssm(ssm, instance_id: str, aws_region: str) -> dict:
+LIVE_INSTANCE_STATES = ('pending', 'running', 'stopping', 'stopped')
+
+class StateStore:
+    """
+    What earlier runs learned about this profile's instances and tunnels, kept in a JSON file.
+
+    Every entry carries its own expiry time. The cache is only a hint: callers confirm cached
+    instances with one cheap API call before trusting them.
+    """
+
+    def __init__(self, path: str, profile: str):
+        self.path = path
+        self.profile = profile
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _save(self, data: dict) -> None:
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temporary_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(temporary_path, 'w') as f:
+                json.dump(data, f, indent=1)
+            os.replace(temporary_path, self.path)
+        except OSError as e:
+            logging.warning(f"Could not write the state cache {self.path}: {e}")
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._load().get(self.profile, {}).get(key)
+        if entry is None or entry['expires'] < time.time():
+            return None
+        return entry['value']
+
+    def put(self, key: str, value, ttl: float = None) -> None:
+        ttl = STATE_TTL if ttl is None else ttl
+        with self._lock:
+            data = self._load()
+            profile = data.setdefault(self.profile, {})
+            now = time.time()
+            # Drop expired entries while the file is open anyway
+            for stale_key in [k for k, entry in profile.items() if entry['expires'] < now]:
+                del profile[stale_key]
+            profile[key] = {'value': value, 'expires': now + ttl, 'updated': now}
+            self._save(data)
+
+    def delete(self, *keys: str) -> None:
+        with self._lock:
+            data = self._load()
+            profile = data.get(self.profile, {})
+            for key in keys:
+                profile.pop(key, None)
+            self._save(data)
+
+def is_invalid_instance_id(e: ClientError) -> bool:
+    return e.response.get('Error', {}).get('Code', '').startswith('InvalidInstanceID')
+
+def _fetch_instances(ec2_client, instance_ids: list) -> dict:
     try:
-        response = ssm.describe_sessions(
-            Filters=[
-                {
-                    'key': 'Target',
-                    'value': instance_id
-                }
-            ]
-        )
-        sessions = response.get('Sessions', [])
-        shell_sessions = []
-        port_forwarding_sessions = []
-        for session in sessions:
-            if session['DocumentName'] == 'AWS-StartSSHSession':
-                shell_sessions.append(session)
-            elif session['DocumentName'] == 'AWS-StartPortForwardingSession':
-                port_forwarding_sessions.append(session)
-        
-        # Log the number of shell and port forwarding sessions
-        logging.info(f"Found {len(shell_sessions)} shell session(s) for instance {instance_id}.")
-        logging.info(f"Found {len(port_forwarding_sessions)} port forwarding session(s) for instance {instance_id}.")
+        response = ec2_client.describe_instances(InstanceIds=instance_ids)
+    except ClientError as e:
+        if not is_invalid_instance_id(e):
+            raise
+        # One unknown ID fails the whole call; look the others up on their own
+        if len(instance_ids) == 1:
+            return {}
+        return {instance_id: instance for single_id in instance_ids
+                for instance_id, instance in _fetch_instances(ec2_client, [single_id]).items()}
+    return {instance['InstanceId']: instance for reservation in response['Reservations']
+            for instance in reservation['Instances']}
 
-        return {
-            'shell_sessions': shell_sessions,
-            'port_forwarding_sessions': port_forwarding_sessions
-        }
+def describe_instances_by_id(ec2_client, instance_ids: list) -> list:
+    """
+    Describe specific instances; instances that no longer exist are simply left out.
+
+    Concurrent callers share describe_instances calls through a LookupBatcher.
+    """
+    batcher = api_calls.batcher('describe_instances', ec2_client,
+                                functools.partial(_fetch_instances, ec2_client), max_ids=200)
+    instances = batcher.lookup(instance_ids)
+    return [instances[instance_id] for instance_id in instance_ids if instance_id in instances]
+
+def get_instances_by_tag(ec2_client, tag_key: str, tag_value: str) -> list:
+    paginator = ec2_client.get_paginator('describe_instances')
+    instances = []
+    for page in paginator.paginate(Filters=[
+        {'Name': f'tag:{tag_key}', 'Values': [tag_value]},
+        {'Name': 'instance-state-name', 'Values': list(LIVE_INSTANCE_STATES)}
+    ]):
+        for reservation in page['Reservations']:
+            instances.extend(reservation['Instances'])
+    return instances
+
+def remember_instances(state_store: StateStore, instances: list) -> None:
+    """Record the instance IDs, spot requests, states and addresses of `instances`."""
+    for instance in instances:
+        state_store.put(f"instance:{instance['InstanceId']}", {
+            'state': instance['State']['Name'],
+            'instance_type': instance.get('InstanceType'),
+            'availability_zone': instance.get('Placement', {}).get('AvailabilityZone'),
+            'spot_request_id': instance.get('SpotInstanceRequestId'),
+            'private_ip': instance.get('PrivateIpAddress'),
+            'public_ip': instance.get('PublicIpAddress'),
+        }, ttl=3600)
+    state_store.put('instance_ids', [instance['InstanceId'] for instance in instances])
+
+def find_tagged_instances(ec2_client, state_store: StateStore, tag_key: str, tag_value: str) -> list:
+    """
+    The live instances carrying the configured tag.
+
+    Instance IDs cached by an earlier run are confirmed with a single describe_instances call;
+    the tag-filter scan only runs when there is no cache or the cached instances have gone.
+    """
+    cached_ids = state_store.get('instance_ids')
+    if cached_ids:
+        instances = [
+            instance for instance in describe_instances_by_id(ec2_client, cached_ids)
+            if instance['State']['Name'] in LIVE_INSTANCE_STATES
+            and {'Key': tag_key, 'Value': tag_value} in instance.get('Tags', [])
+        ]
+        if len(instances) == len(cached_ids):
+            logging.info(f"Using cached instance(s) {', '.join(cached_ids)}.")
+            remember_instances(state_store, instances)
+            return instances
+        logging.info("Cached instances are out of date; scanning by tag.")
+    instances = get_instances_by_tag(ec2_client, tag_key, tag_value)
+    if instances:
+        remember_instances(state_store, instances)
+    else:
+        state_store.delete('instance_ids')
+        logging.info(f"No instances with tag key '{tag_key}' and value '{tag_value}' found.")
+    return instances
+
+def describe_readiness(ec2_client, instance_id: str) -> dict:
+    """
+    Fetch the instance state and both status checks in a single call.
+
+    Returns:
+        dict: 'state', 'instance_status' and 'system_status', or an empty dict if
+        EC2 does not report the instance yet.
+    """
+    return describe_readiness_of_instances(ec2_client, [instance_id]).get(instance_id, {})
+
+def _fetch_readiness(ec2_client, instance_ids: list) -> dict:
+    try:
+        response = ec2_client.describe_instance_status(InstanceIds=instance_ids, IncludeAllInstances=True)
     except ClientError as e:
-        logging.error(f"Error checking for existing SSM sessions: {e}")
-        return {'shell_sessions': [], 'port_forwarding_sessions': []}
-    
-def initiate_ssm_session(ssm, instance_id: str, aws_region: str) -> bool:
-    logging.info("SSM agent is correctly configured. Attempting to start session...")
+        # A just-launched instance can be unknown for a moment; it is simply not reported yet
+        if not is_invalid_instance_id(e):
+            raise
+        if len(instance_ids) == 1:
+            return {}
+        return {instance_id: status for single_id in instance_ids
+                for instance_id, status in _fetch_readiness(ec2_client, [single_id]).items()}
+    return {
+        status['InstanceId']: {
+            'state': status['InstanceState']['Name'],
+            'instance_status': status['InstanceStatus']['Status'],
+            'system_status': status['SystemStatus']['Status'],
+        }
+        for status in response.get('InstanceStatuses', [])
+    }
+
+def describe_readiness_of_instances(ec2_client, instance_ids: list) -> dict:
+    """
+    describe_readiness for several instances, keyed by instance ID.
+
+    Concurrent callers, such as the readiness polls of a fleet, share describe_instance_status calls.
+    """
+    batcher = api_calls.batcher('describe_instance_status', ec2_client,
+                                functools.partial(_fetch_readiness, ec2_client), max_ids=100)
+    return batcher.lookup(instance_ids)
+
+def _update_readiness_stages(stages: dict, status: dict, ssm_online: bool, elapsed: float) -> bool:
+    """Record the first time each readiness stage is observed. Returns True if a stage was reached."""
+    reached = {
+        'running': status.get('state') == 'running',
+        'ssm_online': ssm_online,
+        'instance_status_ok': status.get('instance_status') == 'ok',
+        'system_status_ok': status.get('system_status') == 'ok',
+    }
+    progressed = False
+    for stage, ok in reached.items():
+        if ok and stage not in stages:
+            stages[stage] = round(elapsed, 1)
+            logging.info(f"Readiness stage '{stage}' reached after {elapsed:.1f}s.")
+            progressed = True
+    return progressed
+
+def _end_readiness_spans(spans: dict, stages: dict, status: str = None) -> None:
+    """End the trace span of every stage reached; with `status`, end the rest with that status."""
+    reached = {
+        'running': 'running' in stages,
+        'ssm_online': 'ssm_online' in stages,
+        'status_ok': 'instance_status_ok' in stages and 'system_status_ok' in stages,
+    }
+    for name, span in spans.items():
+        if reached[name]:
+            span.end()
+        elif status:
+            span.end(status)
+
+def wait_for_instance_ready(ec2_client, ssm, instance_id: str, timeout: float = 900,
+                            min_interval: float = 1.0, max_interval: float = 10.0) -> dict:
+    """
+    Poll EC2 status and SSM registration together until the SSM agent is online.
+
+    Both APIs are queried concurrently each round. The poll interval starts at
+    `min_interval`, grows by half each round nothing changes and drops back to
+    `min_interval` whenever a stage is reached. Once the SSM agent is online the
+    function returns so that sessions can be started straight away; the EC2
+    status checks keep being watched in a background thread and are added to the
+    returned dict when they pass.
+
+    Returns:
+        dict: Seconds from the start of the wait to each readiness stage, or None
+        if the instance went away or the timeout expired.
+    """
+    stages = {}
+    start = time.monotonic()
+    spans = {name: tracer.start(name, instance_id=instance_id) for name in ('running', 'ssm_online', 'status_ok')}
+    interval = min_interval
+    try:
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            while True:
+                status_future = pool.submit(describe_readiness, ec2_client, instance_id)
+                ssm_future = pool.submit(is_ssm_agent_configured, ssm, instance_id)
+                status, ssm_online = status_future.result(), ssm_future.result()
+                elapsed = time.monotonic() - start
+
+                state = status.get('state')
+                if state in ('shutting-down', 'terminated') or (state in ('stopping', 'stopped') and stages):
+                    logging.error(f"Instance {instance_id} entered state '{status['state']}' while waiting for it to become ready.")
+                    _end_readiness_spans(spans, stages, 'error')
+                    return None
+                if _update_readiness_stages(stages, status, ssm_online, elapsed):
+                    interval = min_interval
+                    _end_readiness_spans(spans, stages)
+                else:
+                    interval = min(interval * 1.5, max_interval)
+
+                if 'ssm_online' in stages:
+                    break
+                if elapsed + interval > timeout:
+                    logging.error(f"Instance {instance_id} did not become ready within {timeout}s.")
+                    _end_readiness_spans(spans, stages, 'timeout')
+                    return None
+                time.sleep(interval)
+    except BaseException:
+        _end_readiness_spans(spans, stages, 'error')
+        raise
+
+    if not ('instance_status_ok' in stages and 'system_status_ok' in stages):
+        threading.Thread(
+            target=watch_status_checks,
+            args=(ec2_client, instance_id, stages, start, timeout, max_interval, spans['status_ok']),
+            daemon=True
+        ).start()
+    log_readiness_report(instance_id, stages)
+    return stages
+
+def watch_status_checks(ec2_client, instance_id: str, stages: dict, start: float,
+                        timeout: float, max_interval: float, span: Span) -> None:
+    """Keep polling the EC2 status checks after hand-over and record when they pass."""
+    interval = max_interval / 2
+    while time.monotonic() - start < timeout:
+        time.sleep(interval)
+        try:
+            status = describe_readiness(ec2_client, instance_id)
+        except ClientError as e:
+            logging.error(f"Error polling status checks for instance {instance_id}: {e}")
+            continue
+        _update_readiness_stages(stages, status, True, time.monotonic() - start)
+        if 'instance_status_ok' in stages and 'system_status_ok' in stages:
+            span.end()
+            log_readiness_report(instance_id, stages)
+            return
+        interval = min(interval * 1.5, max_interval)
+    span.end('timeout')
+
+def log_readiness_report(instance_id: str, stages: dict) -> None:
+    report = ", ".join(f"{stage}={seconds}s" for stage, seconds in sorted(stages.items(), key=lambda item: item[1]))
+    logging.info(f"Readiness of instance {instance_id}: {report}")
+
+class InstanceStillStopping(TimeoutError):
+    """An instance did not finish stopping in time, so it cannot be started yet."""
+
+def wait_until_stopped(ec2_client, instance_id: str, timeout: float = 600,
+                       min_interval: float = 1.0, max_interval: float = 10.0) -> str:
+    """
+    Wait for a stopping instance to leave that state, polling with the backoff of wait_for_instance_ready.
+
+    EC2 occasionally leaves an instance stopping for a long time, so the wait gives up after
+    `timeout` seconds and raises InstanceStillStopping. Returns the state the instance reached.
+    """
+    logging.info(f"Waiting for instance {instance_id} to finish stopping...")
+    start = time.monotonic()
+    interval = min_interval
+    with tracer.span('stopping_wait', instance_id=instance_id) as span:
+        while True:
+            state = describe_readiness(ec2_client, instance_id).get('state')
+            if state != 'stopping':
+                span.end(state=state)
+                return state
+            if time.monotonic() - start + interval > timeout:
+                logging.error(f"Instance {instance_id} was still stopping after {timeout:g}s.")
+                span.end('timeout')
+                raise InstanceStillStopping(f"instance {instance_id} did not finish stopping within {timeout:g}s")
+            time.sleep(interval)
+            interval = min(interval * 1.5, max_interval)
+
+def start_instance_if_stopped(ec2_client, ssm, instance_id: str, state: str = None) -> dict:
+    if state is None:
+        state = describe_readiness(ec2_client, instance_id).get('state')
+    if state == 'stopping':
+        # An instance cannot be started until it has finished stopping
+        state = wait_until_stopped(ec2_client, instance_id, float(lifecycle_config.get('stopping_timeout', 600)))
+    if state != 'running':
+        logging.info(f"Starting instance {instance_id}...")
+        ec2_client.start_instances(InstanceIds=[instance_id])
+    return wait_for_instance_ready(ec2_client, ssm, instance_id)
+
+# Instance lifecycle: stopping or hibernating instances and resuming them later
+
+# Existing instances are preferred in this order, the quickest to connect to first
+RESUME_STATE_ORDER = {'running': 0, 'pending': 1, 'stopped': 2, 'stopping': 3}
+
+def is_hibernated(instance: dict) -> bool:
+    return instance.get('StateReason', {}).get('Code') == 'Client.UserInitiatedHibernate'
+
+def collect_warm_up_progress(state_store: StateStore, instance_ids: list) -> dict:
+    """The last recorded warm-up progress of each instance that has one."""
+    progress = {instance_id: state_store.get(f"warm_up:{instance_id}") for instance_id in instance_ids}
+    return {instance_id: entry for instance_id, entry in progress.items() if entry}
+
+def summarize_bring_up(history: list) -> dict:
+    """Median seconds and number of runs for each kind of bring-up ('cold', 'resume', 'resume_hibernated')."""
+    samples = {}
+    for entry in history:
+        samples.setdefault(entry['kind'], []).append(entry['seconds'])
+    return {kind: {'median_seconds': round(statistics.median(seconds), 1), 'runs': len(seconds)}
+            for kind, seconds in samples.items()}
+
+def record_bring_up(state_store: StateStore, kind: str, seconds: float, instance_ids: list) -> None:
+    """Remember how long a resume or cold launch took until SSM was online, and log it against the other kind."""
+    history = (state_store.get('bring_up_history') or []) + [
+        {'kind': kind, 'seconds': round(seconds, 1), 'instance_ids': instance_ids, 'at': round(time.time())}
+    ]
+    history = history[-100:]
+    state_store.put('bring_up_history', history, ttl=90 * 24 * 3600)
+    summary = summarize_bring_up(history)
+    comparison = ", ".join(f"{other} median {stats['median_seconds']}s over {stats['runs']} run(s)"
+                           for other, stats in sorted(summary.items()) if other != kind)
+    logging.info(f"Bring-up ({kind.replace('_', ' ')}) took {seconds:.1f}s" + (f"; {comparison}." if comparison else "."))
+
+def rank_for_resume(instances: list, state_store: StateStore) -> list:
+    """
+    Tagged instances ordered by how quickly each can be connected to, best first.
+
+    Running instances come first, then pending, stopped and stopping ones. Hibernated instances
+    resume faster than stopped ones, and remaining ties go to the instance that resumed fastest before.
+    """
+    history = state_store.get('bring_up_history') or []
+
+    def past_resume_seconds(instance: dict) -> float:
+        samples = [entry['seconds'] for entry in history
+                   if entry['kind'] != 'cold' and instance['InstanceId'] in entry['instance_ids']]
+        return statistics.median(samples) if samples else float('inf')
+
+    return sorted(instances, key=lambda instance: (
+        RESUME_STATE_ORDER.get(instance['State']['Name'], len(RESUME_STATE_ORDER)),
+        not is_hibernated(instance),
+        past_resume_seconds(instance),
+    ))
+
+def resume_instance(ec2_client, ssm, instance: dict, state_store: StateStore) -> dict:
+    """Start `instance` if it is stopped and wait until it is ready, recording how long a resume took."""
+    instance_id = instance['InstanceId']
+    state = instance['State']['Name']
+    if state not in ('stopping', 'stopped'):
+        return start_instance_if_stopped(ec2_client, ssm, instance_id, state)
+
+    kind = 'resume_hibernated' if is_hibernated(instance) else 'resume'
+    started = time.monotonic()
+    with tracer.span(kind, instance_id=instance_id) as span:
+        stages = start_instance_if_stopped(ec2_client, ssm, instance_id, state)
+        if stages is None:
+            span.end('error')
+            return None
+    record_bring_up(state_store, kind, time.monotonic() - started, [instance_id])
+    return stages
+
+def stop_instances(ec2_client, instance_ids: list, hibernate: bool = False) -> None:
+    """Stop or hibernate instances so that they can be resumed later. Falls back to stopping if hibernation fails."""
+    try:
+        ec2_client.stop_instances(InstanceIds=instance_ids, Hibernate=hibernate)
+    except ClientError as e:
+        if not hibernate:
+            raise
+        logging.warning(f"Could not hibernate instance(s) ({e}); stopping them instead.")
+        ec2_client.stop_instances(InstanceIds=instance_ids)
+        hibernate = False
+    logging.info(f"Instance(s) {', '.join(instance_ids)} being {'hibernated' if hibernate else 'stopped'}.")
+
+def terminate_instances(ec2_client, instance_ids: list) -> None:
+    """Terminate instances, cancelling their spot requests first so that persistent requests do not relaunch them."""
+    request_ids = [instance['SpotInstanceRequestId'] for instance in describe_instances_by_id(ec2_client, instance_ids)
+                   if instance.get('SpotInstanceRequestId')]
+    if request_ids:
+        ec2_client.cancel_spot_instance_requests(SpotInstanceRequestIds=request_ids)
+    ec2_client.terminate_instances(InstanceIds=instance_ids)
+    logging.info(f"Instance(s) {', '.join(instance_ids)} being terminated.")
+
+def stoppable_instances(ec2_client, instance_ids: list) -> list:
+    """The instances that can be stopped: on-demand ones and those of persistent spot requests."""
+    instances = describe_instances_by_id(ec2_client, instance_ids)
+    request_ids = [instance['SpotInstanceRequestId'] for instance in instances if instance.get('SpotInstanceRequestId')]
+    persistent = set()
+    if request_ids:
+        try:
+            response = ec2_client.describe_spot_instance_requests(SpotInstanceRequestIds=request_ids)
+        except ClientError as e:
+            logging.warning(f"Could not look up the spot requests of the instance(s): {e}")
+            return list(instance_ids)
+        persistent = {request['SpotInstanceRequestId'] for request in response['SpotInstanceRequests']
+                      if request.get('Type') == 'persistent'}
+    return [instance['InstanceId'] for instance in instances
+            if not instance.get('SpotInstanceRequestId') or instance['SpotInstanceRequestId'] in persistent]
+
+def trim_warm_pool(ec2_client, state_store: StateStore, pool_size: int) -> list:
+    """Terminate stopped instances beyond `pool_size`, keeping the ones quickest to resume. Returns the terminated IDs."""
+    stopped = [instance for instance in get_instances_by_tag(ec2_client, aws_tag_key, aws_tag_value)
+               if instance['State']['Name'] in ('stopping', 'stopped')]
+    extra = [instance['InstanceId'] for instance in rank_for_resume(stopped, state_store)[pool_size:]]
+    if extra:
+        logging.info(f"Warm pool holds {len(stopped)} stopped instance(s); keeping {pool_size}.")
+        terminate_instances(ec2_client, extra)
+        state_store.delete(*[f"instance:{instance_id}" for instance_id in extra])
+        state_store.put('instance_ids', [instance_id for instance_id in state_store.get('instance_ids') or []
+                                         if instance_id not in extra])
+    return extra
+
+# Spot interruption: the two-minute notice, and replacing the instance before it is reclaimed
+
+# Spot request status codes set with the two-minute notice, or once the instance has been reclaimed
+INTERRUPTION_STATUS_PREFIXES = ('marked-for-', 'instance-terminated-', 'instance-stopped-', 'instance-hibernated-')
+
+# Reads the spot instance-action notice from instance metadata (IMDSv2); prints nothing until one is issued
+IMDS_INSTANCE_ACTION_COMMANDS = [
+    'TOKEN=$(curl -s -X PUT http://169.254.169.254/latest/api/token -H "X-aws-ec2-metadata-token-ttl-seconds: 60")',
+    'curl -s -f -H "X-aws-ec2-metadata-token: $TOKEN" http://169.254.169.254/latest/meta-data/spot/instance-action || true',
+]
+
+def is_interruption_status(code: str) -> bool:
+    # '...-by-user' codes are our own stop or terminate calls, not interruptions
+    return code.startswith(INTERRUPTION_STATUS_PREFIXES) and not code.endswith('-by-user')
+
+def run_ssm_command(ssm, instance_id: str, commands: list, timeout: float = 30) -> dict:
+    """
+    Run shell `commands` on the instance with AWS-RunShellScript and wait for them to finish.
+
+    The invocation is polled with a growing interval, from a quarter of a second up to ten
+    seconds. Returns its status, standard output and standard error; SSM cuts the output
+    at 24,000 characters.
+    """
+    command_id = ssm.send_command(
+        InstanceIds=[instance_id],
+        DocumentName='AWS-RunShellScript',
+        Parameters={'commands': commands, 'executionTimeout': [str(max(30, int(timeout)))]},
+        TimeoutSeconds=max(30, int(timeout)),
+    )['Command']['CommandId']
+    deadline = time.monotonic() + timeout
+    delay = 0.25
+    while True:
+        time.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+        # Quick commands are picked up promptly; an hour-long copy is not polled twice a second
+        delay = min(delay * 1.5, 10)
+        try:
+            invocation = ssm.get_command_invocation(CommandId=command_id, InstanceId=instance_id)
+        except ClientError as e:
+            # The invocation is not visible for a moment after send_command
+            if e.response.get('Error', {}).get('Code') != 'InvocationDoesNotExist':
+                raise
+            invocation = {'Status': 'Pending'}
+        if invocation['Status'] not in ('Pending', 'InProgress', 'Delayed'):
+            break
+        if time.monotonic() > deadline:
+            invocation['Status'] = 'TimedOut'
+            break
+    return {
+        'status': invocation['Status'],
+        'stdout': invocation.get('StandardOutputContent', ''),
+        'stderr': invocation.get('StandardErrorContent', ''),
+    }
+
+def read_instance_action(ssm, instance_id: str) -> dict:
+    """The spot instance-action notice from the instance's metadata, e.g. {'action': 'terminate', 'time': ...}, or None."""
+    result = run_ssm_command(ssm, instance_id, IMDS_INSTANCE_ACTION_COMMANDS, timeout=20)
+    output = result['stdout'].strip()
+    if result['status'] != 'Success' or not output:
+        return None
+    try:
+        return json.loads(output)
+    except ValueError:
+        return None
+
+class InterruptionWatcher:
+    """
+    Watches spot instances for the two-minute interruption notice and replaces them before they are reclaimed.
+
+    One describe_spot_instance_requests call every `poll_interval` seconds covers every watched
+    instance; with `imds_via_ssm` the notice is also read from each instance's metadata over SSM.
+    On a notice a replacement is launched through run_instance() straight away, and once it is
+    ready the supervisor moves the interrupted instance's tunnels to it on the same local ports.
+    Instances of persistent spot requests are not replaced: EC2 stops or hibernates them and
+    starts them again itself, which would leave two instances running.
+    """
+
+    def __init__(self, ec2_client, ssm, state_store: StateStore, supervisor=None):
+        self.ec2_client = ec2_client
+        self.ssm = ssm
+        self.state_store = state_store
+        self.supervisor = supervisor
+        self.poll_interval = float(interruption_config.get('poll_interval', 10))
+        self.replace = interruption_config.get('replace', True)
+        self.imds_via_ssm = bool(interruption_config.get('imds_via_ssm'))
+        self.spot_requests = {}  # Spot request ID -> instance ID
+        self.persistent = set()  # Instance IDs whose spot request is persistent
+        self.notices = {}  # Instance ID -> reason
+        self.replacements = {}  # Interrupted instance ID -> replacement ID, or None if launching it failed
+        self._replaced = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def watch(self, instance_ids: list) -> int:
+        """Start watching the spot instances among `instance_ids`. Returns how many are watched."""
+        for instance in describe_instances_by_id(self.ec2_client, instance_ids):
+            if instance.get('SpotInstanceRequestId'):
+                self.spot_requests[instance['SpotInstanceRequestId']] = instance['InstanceId']
+        return len(self.spot_requests)
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='interruption-watcher', daemon=True)
+        self._thread.start()
+        logging.info(f"Watching {len(self.spot_requests)} spot instance(s) for interruption notices.")
+
+    def stop(self) -> None:
+        self._stop.set()
+        with self._replaced:
+            self._replaced.notify_all()
+
+    def current_instance(self, instance_id: str) -> str:
+        """The instance now standing in for `instance_id`, following replacements of replacements."""
+        with self._replaced:
+            while self.replacements.get(instance_id):
+                instance_id = self.replacements[instance_id]
+        return instance_id
+
+    def wait_for_replacement(self, instance_id: str, timeout: float = 900) -> str:
+        """
+        If `instance_id` received an interruption notice, wait for its replacement and return it.
+
+        Returns None when there was no notice, replacing is disabled or the replacement failed.
+        """
+        with self._replaced:
+            if instance_id not in self.notices or not self.replace:
+                return None
+            self._replaced.wait_for(lambda: instance_id in self.replacements or self._stop.is_set(), timeout)
+            return self.replacements.get(instance_id)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.poll()
+            except ClientError as e:
+                logging.error(f"Error checking for spot interruptions: {e}")
+
+    def poll(self) -> None:
+        """Check every watched instance once and act on new interruption notices."""
+        with self._replaced:
+            watched = {request_id: instance_id for request_id, instance_id in self.spot_requests.items()
+                       if instance_id not in self.notices}
+        if not watched:
+            return
+        requests = self._describe_requests(list(watched))
+        with self._replaced:
+            self.persistent.update(watched[request['SpotInstanceRequestId']] for request in requests
+                                   if request.get('Type') == 'persistent')
+        for request in requests:
+            code = request.get('Status', {}).get('Code', '')
+            if is_interruption_status(code):
+                self._on_notice(watched[request['SpotInstanceRequestId']], code)
+        if self.imds_via_ssm:
+            for request_id, instance_id in watched.items():
+                if instance_id in self.notices or request_id not in self.spot_requests:
+                    continue
+                try:
+                    action = read_instance_action(self.ssm, instance_id)
+                except ClientError as e:
+                    logging.warning(f"Could not read the instance-action notice of {instance_id}: {e}")
+                    continue
+                if action:
+                    self._on_notice(instance_id, f"instance-action {action.get('action')} at {action.get('time')}")
+
+    def _describe_requests(self, request_ids: list) -> list:
+        """Describe the spot requests `request_ids`, dropping the ones that no longer exist from the watched set."""
+        try:
+            return self.ec2_client.describe_spot_instance_requests(SpotInstanceRequestIds=request_ids)['SpotInstanceRequests']
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'InvalidSpotInstanceRequestID.NotFound':
+                raise
+            unknown = [request_id for request_id in request_ids if request_id in e.response['Error'].get('Message', '')]
+        # The error names the unknown IDs; without that, look the others up on their own
+        if not unknown and len(request_ids) == 1:
+            unknown = request_ids
+        with self._replaced:
+            for request_id in unknown:
+                logging.warning(f"Spot request {request_id} no longer exists; "
+                                f"no longer watching instance {self.spot_requests.pop(request_id, None)}.")
+        if unknown:
+            remaining = [request_id for request_id in request_ids if request_id not in unknown]
+            return self._describe_requests(remaining) if remaining else []
+        return [request for request_id in request_ids for request in self._describe_requests([request_id])]
+
+    def _on_notice(self, instance_id: str, reason: str) -> None:
+        with self._replaced:
+            if instance_id in self.notices:
+                return
+            self.notices[instance_id] = reason
+            if instance_id in self.persistent:
+                # Nothing will move the tunnels, so waiters get no replacement
+                self.replacements[instance_id] = None
+                self._replaced.notify_all()
+        logging.warning(f"Spot interruption notice for instance {instance_id} ({reason}).")
+        if instance_id in self.persistent:
+            logging.info(f"Instance {instance_id} comes from a persistent spot request; EC2 will stop or hibernate it "
+                         f"and start it again when capacity returns, so no replacement is launched.")
+        elif self.replace:
+            threading.Thread(target=self._replace, args=(instance_id,), name=f"replace-{instance_id}", daemon=True).start()
+
+    def _replace(self, instance_id: str) -> None:
+        """Launch a replacement for `instance_id` and move its tunnels over once it is ready."""
+        started = time.monotonic()
+        replacement_id = None
+        with tracer.span('interruption_replacement', instance_id=instance_id) as span:
+            try:
+                replacement_id = run_instance(self.ec2_client, self.ssm)
+                if replacement_id is None:
+                    logging.error(f"Could not launch a replacement for interrupted instance {instance_id}.")
+                    span.end('error')
+                    return
+                record_bring_up(self.state_store, 'cold', time.monotonic() - started, [replacement_id])
+                if self.supervisor:
+                    self.supervisor.replace_instance(instance_id, replacement_id)
+                span.end(replacement_id=replacement_id)
+                logging.info(f"Replaced interrupted instance {instance_id} with {replacement_id} "
+                             f"{time.monotonic() - started:.1f}s after the notice.")
+            except Exception as e:
+                logging.error(f"Error replacing interrupted instance {instance_id}: {e}")
+                span.end('error', error=str(e))
+            finally:
+                with self._replaced:
+                    self.replacements[instance_id] = replacement_id
+                    self._replaced.notify_all()
+        if replacement_id is None:
+            return
+
+        self.watch([replacement_id])
+        current_ids = [self.current_instance(instance_id) for instance_id in self.state_store.get('instance_ids') or []]
+        remember_instances(self.state_store, describe_instances_by_id(self.ec2_client, current_ids or [replacement_id]))
+
+def start_interruption_watcher(ec2_client, ssm, state_store: StateStore, instance_ids: list, supervisor=None):
+    """Watch the spot instances among `instance_ids` for interruption. Returns the watcher, or None if there is nothing to watch."""
+    if interruption_config.get('enabled', True) is False:
+        return None
+    watcher = InterruptionWatcher(ec2_client, ssm, state_store, supervisor)
+    try:
+        if not watcher.watch(instance_ids):
+            return None
+    except ClientError as e:
+        logging.error(f"Could not look up spot requests to watch for interruptions: {e}")
+        return None
+    watcher.start()
+    return watcher
+
+# Idle auto-stop: stopping instances nobody has sent traffic to for a while
+
+class IdleMonitor:
+    """
+    Stops or hibernates instances once nothing has passed through their metered ports for `idle_minutes`.
+
+    Idle time is read from the supervisor's MeteredProxy counters every `check_interval` seconds,
+    taking the most recently used port of each instance; an instance without a metered port is
+    never stopped. The tunnels of a stopped instance are closed and `on_stopped` is called with its ID.
+    """
+
+    def __init__(self, ec2_client, supervisor, on_stopped=None):
+        self.ec2_client = ec2_client
+        self.supervisor = supervisor
+        self.on_stopped = on_stopped
+        self.idle_seconds = float(metering_config.get('idle_minutes', 0)) * 60
+        self.action = metering_config.get('idle_action', 'stop')
+        self.check_interval = float(metering_config.get('check_interval', 60))
+        self.stopped = {}  # Instance ID -> when it was stopped or hibernated
+        self.failed = set()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name='idle-monitor', daemon=True)
+        self._thread.start()
+        logging.info(f"Instances with no traffic for {self.idle_seconds / 60:g} minute(s) will be "
+                     f"{'hibernated' if self.action == 'hibernate' else 'stopped'}.")
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def idle_times(self) -> dict:
+        """Seconds since the last traffic through any metered port of each instance."""
+        idle = {}
+        for stats in self.supervisor.status():
+            if stats.get('idle_seconds') is not None:
+                idle[stats['instance_id']] = min(idle.get(stats['instance_id'], float('inf')), stats['idle_seconds'])
+        return idle
+
+    def status(self) -> dict:
+        return {
+            'idle_minutes': self.idle_seconds / 60,
+            'action': self.action,
+            'idle_seconds': self.idle_times(),
+            'stopped': {instance_id: datetime.datetime.fromtimestamp(at).isoformat(timespec='seconds')
+                        for instance_id, at in self.stopped.items()},
+        }
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.check_interval):
+            try:
+                self.check()
+            except Exception as e:
+                logging.error(f"Error checking for idle instances: {e}")
+
+    def check(self) -> list:
+        """Stop or hibernate every instance idle for longer than `idle_minutes`. Returns their IDs."""
+        stopped = []
+        for instance_id, seconds in self.idle_times().items():
+            if seconds < self.idle_seconds or instance_id in self.stopped or instance_id in self.failed:
+                continue
+            logging.warning(f"No traffic to instance {instance_id} for {seconds / 60:.1f} minute(s); "
+                            f"{'hibernating' if self.action == 'hibernate' else 'stopping'} it.")
+            try:
+                stop_instances(self.ec2_client, [instance_id], hibernate=self.action == 'hibernate')
+            except ClientError as e:
+                # One-time spot instances cannot be stopped; leave them to the user rather than terminating them
+                logging.error(f"Could not stop idle instance {instance_id}: {e}")
+                self.failed.add(instance_id)
+                continue
+            self.supervisor.remove_instance(instance_id)
+            self.stopped[instance_id] = time.time()
+            if self.on_stopped:
+                self.on_stopped(instance_id)
+            stopped.append(instance_id)
+        return stopped
+
+def start_idle_monitor(ec2_client, supervisor, on_stopped=None):
+    """Watch the metered ports for idleness. Returns the monitor, or None if no idle window is configured."""
+    if supervisor is None or not supervisor.metered or not metering_config.get('idle_minutes'):
+        return None
+    monitor = IdleMonitor(ec2_client, supervisor, on_stopped)
+    monitor.start()
+    return monitor
+
+# Sessions in these states can no longer carry traffic
+STALE_SESSION_STATUSES = ('Disconnected', 'Failed', 'Terminating')
+
+def _fetch_active_sessions(ssm, instance_ids: list) -> dict:
+    """Active sessions by target: filtered for one instance, otherwise one listing split by target."""
+    paginator = ssm.get_paginator('describe_sessions')
+    filters = {'Filters': [{'key': 'Target', 'value': instance_ids[0]}]} if len(instance_ids) == 1 else {}
+    sessions = {instance_id: [] for instance_id in instance_ids}
+    for page in paginator.paginate(State='Active', **filters):
+        for session in page.get('Sessions', []):
+            if session.get('Target') in sessions:
+                sessions[session['Target']].append(session)
+    return sessions
+
+def check_existing_ssm(ssm, instance_id: str, aws_region: str) -> dict:
+    try:
+        # The tunnels of a fleet are set up together; their lookups share describe_sessions calls
+        batcher = api_calls.batcher('describe_sessions', ssm, functools.partial(_fetch_active_sessions, ssm))
+        sessions = batcher.lookup([instance_id]).get(instance_id, [])
+        shell_sessions = []
+        port_forwarding_sessions = []
+        stale_sessions = []
+        for session in sessions:
+            is_port_forwarding = 'PortForwarding' in (session.get('DocumentName') or '')
+            if is_port_forwarding and session.get('Status') in STALE_SESSION_STATUSES:
+                stale_sessions.append(session)
+            elif is_port_forwarding:
+                port_forwarding_sessions.append(session)
+            else:
+                shell_sessions.append(session)
+
+        # Log the number of shell and port forwarding sessions
+        logging.info(f"Found {len(shell_sessions)} shell session(s) for instance {instance_id}.")
+        logging.info(f"Found {len(port_forwarding_sessions)} live and {len(stale_sessions)} stale port forwarding session(s) for instance {instance_id}.")
+
+        return {
+            'shell_sessions': shell_sessions,
+            'port_forwarding_sessions': port_forwarding_sessions,
+            'stale_sessions': stale_sessions,
+        }
+    except ClientError as e:
+        logging.error(f"Error checking for existing SSM sessions: {e}")
+        return {'shell_sessions': [], 'port_forwarding_sessions': [], 'stale_sessions': []}
+
+def initiate_ssm_session(ssm, instance_id: str, aws_region: str) -> bool:
+    logging.info("SSM agent is correctly configured. Attempting to start session...")
+
+    # Check if AWS CLI is installed
+    if not shutil.which("aws"):
+        logging.error("AWS CLI is not installed or not found in PATH.")
+        return False
+
+    # Use the AWS CLI 'aws ssm start-session' command to start an interactive shell session
+    start_session_command = [
+        "aws",
+        "ssm",
+        "start-session",
+        "--target",
+        instance_id,
+        "--region",
+        aws_region
+    ]
+
+    logging.info(f"Running command: {' '.join(start_session_command)}")
+
+    try:
+        logging.info("About to start the SSM session...")
+        result = subprocess.run(start_session_command, stderr=subprocess.PIPE, check=True)
+        logging.info("SSM session started.")
+        
+        if result.returncode != 0:
+            logging.error(f"Failed to start SSM session: {result.stderr}")
+            return False
+
+        logging.info(f"SSM session started successfully.")
+        return True
+
+    except subprocess.TimeoutExpired:
+        logging.error("SSM session command timed out.")
+        return False
+
+    except subprocess.CalledProcessError as e:
+        logging.error(f"An error occurred while starting the SSM session: {e}")
+        return False
+
+    except Exception as e:
+        logging.error(f"An unexpected error occurred: {e}")
+        return False
+        
+def ensure_ssm_session(ssm, instance_id: str, aws_region: str) -> dict:
+    """
+    Look up the existing sessions for `instance_id` so that live ones can be adopted.
+
+    Only stale port forwarding sessions are terminated. Live sessions, including shells and
+    tunnels opened from other terminals or by teammates, are left running; the tunnel
+    supervisor reuses those that another run of this script recorded (see find_adoptable_tunnels).
+    """
+    existing_sessions = check_existing_ssm(ssm, instance_id, aws_region)
+    for session in existing_sessions['stale_sessions']:
+        terminate_ssm_session(ssm, session['SessionId'])
+    return existing_sessions
+
+def _fetch_ping_status(ssm, instance_ids: list) -> dict:
+    # Filters (unlike InstanceInformationFilterList) returns an empty list rather than
+    # an error for instances that have not registered with SSM yet.
+    paginator = ssm.get_paginator('describe_instance_information')
+    return {info['InstanceId']: info.get('PingStatus')
+            for page in paginator.paginate(Filters=[{'Key': 'InstanceIds', 'Values': instance_ids}])
+            for info in page['InstanceInformationList']}
+
+def is_ssm_agent_configured(ssm, instance_id: str) -> bool:
+    try:
+        batcher = api_calls.batcher('describe_instance_information', ssm,
+                                    functools.partial(_fetch_ping_status, ssm), max_ids=50)
+        return batcher.lookup([instance_id]).get(instance_id) == 'Online'
+    except ClientError as e:
+        logging.error(f"ClientError occurred while checking SSM agent configuration: {e}")
+        raise
+
+def start_ssm_shell_session(instance_id: str, aws_region: str) -> subprocess.Popen:
+    logging.info("Attempting to start an SSM shell session...")
+    shell_session_command = [
+        "aws", "ssm", "start-session",
+        "--target", instance_id,
+        "--region", aws_region
+    ]
+
+    try:
+        process = subprocess.Popen(shell_session_command)
+        logging.info(f"SSM session started successfully.")
+        return process
+    except Exception as e:
+        logging.error(f"An unexpected error occurred: {e}")
+        return None
+
+
+# Native port forwarding over the Session Manager data channel
+
+SSM_CLIENT_VERSION = "1.2.0.0"
+# Agents newer than this multiplex several TCP connections over one session using smux
+SSM_MUX_AGENT_VERSION = (3, 0, 196, 0)
+
+# Payload types and flag values used by the Session Manager data channel protocol
+PAYLOAD_OUTPUT = 1
+PAYLOAD_HANDSHAKE_REQUEST = 5
+PAYLOAD_HANDSHAKE_RESPONSE = 6
+PAYLOAD_HANDSHAKE_COMPLETE = 7
+PAYLOAD_FLAG = 10
+FLAG_DISCONNECT_TO_PORT = 1
+FLAG_TERMINATE_SESSION = 2
+FLAG_CONNECT_TO_PORT_ERROR = 3
+
+# smux v1 frame commands
+SMUX_SYN, SMUX_FIN, SMUX_PSH, SMUX_NOP = 0, 1, 2, 3
+SMUX_HEADER = struct.Struct('<BBHI')
+SMUX_MAX_FRAME = 32768
+
+# Data channel message header: header length, message type, schema version, created date,
+# sequence number, flags, message ID, payload digest, payload type, payload length
+CLIENT_MESSAGE_HEADER = struct.Struct('>I32sIQqQ16s32sII')
+CLIENT_MESSAGE_HEADER_LENGTH = CLIENT_MESSAGE_HEADER.size - 4
+
+def encode_client_message(message_type: str, sequence_number: int, payload: bytes, payload_type: int = 0,
+                          flags: int = 0, message_id: uuid.UUID = None) -> bytes:
+    """Serialise a data channel message in the agent's binary framing."""
+    message_id = message_id or uuid.uuid4()
+    # The agent stores UUIDs with the least significant half first
+    id_bytes = message_id.bytes[8:] + message_id.bytes[:8]
+    header = CLIENT_MESSAGE_HEADER.pack(
+        CLIENT_MESSAGE_HEADER_LENGTH,
+        message_type.ljust(32).encode(),
+        1,
+        int(time.time() * 1000),
+        sequence_number,
+        flags,
+        id_bytes,
+        hashlib.sha256(payload).digest(),
+        payload_type,
+        len(payload),
+    )
+    return header + payload
+
+def decode_client_message(data: bytes) -> dict:
+    """Parse a binary data channel message. Raises ValueError if it is malformed."""
+    if len(data) < CLIENT_MESSAGE_HEADER.size:
+        raise ValueError(f"Data channel message too short ({len(data)} bytes)")
+    (header_length, message_type, _, created, sequence_number, flags, id_bytes,
+     digest, payload_type, payload_length) = CLIENT_MESSAGE_HEADER.unpack_from(data)
+    payload_start = header_length + 4
+    payload = data[payload_start:payload_start + payload_length]
+    if len(payload) != payload_length or hashlib.sha256(payload).digest() != digest:
+        raise ValueError("Data channel message payload does not match its length or digest")
+    return {
+        'message_type': message_type.decode().strip().strip('\x00'),
+        'created': created,
+        'sequence_number': sequence_number,
+        'flags': flags,
+        'message_id': uuid.UUID(bytes=id_bytes[8:] + id_bytes[:8]),
+        'payload_type': payload_type,
+        'payload': payload,
+    }
+
+def parse_agent_version(version: str) -> tuple:
+    try:
+        return tuple(int(part) for part in version.split('.'))
+    except (AttributeError, ValueError):
+        return ()
+
+class ForwardedConnection:
+    """A local TCP connection carried over the data channel, with its throughput counters."""
+
+    def __init__(self, stream_id: int, writer: asyncio.StreamWriter):
+        self.stream_id = stream_id
+        self.writer = writer
+        self.peer = writer.get_extra_info('peername')
+        self.opened_at = time.monotonic()
+        self.remote_closed = asyncio.Event()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def stats(self) -> dict:
+        elapsed = max(time.monotonic() - self.opened_at, 1e-6)
+        return {
+            'stream_id': self.stream_id,
+            'peer': f"{self.peer[0]}:{self.peer[1]}" if self.peer else None,
+            'seconds': round(elapsed, 1),
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'send_rate': round(self.bytes_sent / elapsed),
+            'receive_rate': round(self.bytes_received / elapsed),
+        }
+
+class NativeForwardingUnavailable(RuntimeError):
+    """Raised when a session cannot be forwarded in-process and the aws CLI has to be used instead."""
+
+class SsmPortForwarder:
+    """
+    In-process replacement for `aws ssm start-session --document-name AWS-StartPortForwardingSession`.
+
+    Opens the Session Manager data channel from the `start_session` stream URL and token and
+    forwards connections accepted on `local_port` to `remote_port` on the instance. With recent
+    agents every local connection becomes its own smux stream over the one session; older agents
+    get one connection at a time. `ready` is an asyncio future that resolves once the handshake
+    has completed and the local port is listening. It fails with NativeForwardingUnavailable if
+    the agent asks for something this client cannot do, such as KMS encryption.
+
+    It also exposes `terminate`, `wait` and `poll` so callers can treat it like the CLI's Popen.
+    """
+
+    def __init__(self, ssm, instance_id: str, remote_port, local_port, session: dict = None,
+                 host: str = '127.0.0.1'):
+        self.ssm = ssm
+        self.instance_id = instance_id
+        self.remote_port = str(remote_port)
+        self.local_port = int(local_port)
+        self.host = host
+        self.session = session
+        self.loop = None
+        self.ready = None
+        self.closed = None
+        self.websocket = None
+        self.server = None
+        self.agent_version = None
+        self.multiplexed = False
+        self.connections = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.connection_count = 0
+        self._tasks = []
+        self._send_lock = None
+        self._can_send = None
+        self._basic_lock = None
+        self._out_sequence = 0
+        self._in_sequence = 0
+        self._pending_output = {}
+        self._unacknowledged = {}
+        self._smux_buffer = b''
+        self._next_stream_id = 1
+
+    @property
+    def session_id(self):
+        return self.session.get('SessionId') if self.session else None
+
+    async def start(self):
+        """Open the data channel and start listening locally. Readiness is signalled through `ready`."""
+        if import_websockets() is None:
+            raise NativeForwardingUnavailable("the 'websockets' package is not installed")
+        self.loop = asyncio.get_running_loop()
+        self.ready = self.loop.create_future()
+        self.closed = self.loop.create_future()
+        self._send_lock = asyncio.Lock()
+        self._basic_lock = asyncio.Lock()
+        self._can_send = asyncio.Event()
+        self._can_send.set()
+
+        if self.session is None:
+            self.session = await self.loop.run_in_executor(None, functools.partial(
+                self.ssm.start_session,
+                Target=self.instance_id,
+                DocumentName='AWS-StartPortForwardingSession',
+                Parameters={'portNumber': [self.remote_port], 'localPortNumber': [str(self.local_port)]},
+            ))
+        logging.info(f"Port forwarding session {self.session_id} has started.")
+
+        self.server = await asyncio.start_server(self._accept, self.host, self.local_port)
+        # Frequent pings let the supervisor notice a dead network path within seconds
+        self.websocket = await websockets.connect(self.session['StreamUrl'], max_size=None,
+                                                  ping_interval=5, ping_timeout=10)
+        await self.websocket.send(json.dumps({
+            'MessageSchemaVersion': '1.0',
+            'RequestId': str(uuid.uuid4()),
+            'TokenValue': self.session['TokenValue'],
+            'ClientId': str(uuid.uuid4()),
+            'ClientVersion': SSM_CLIENT_VERSION,
+        }))
+        self._tasks = [
+            asyncio.create_task(self._read_loop()),
+            asyncio.create_task(self._resend_loop()),
+        ]
+        return self
+
+    async def close(self, terminate_session: bool = True) -> None:
+        if self.closed is None or self.closed.done():
+            return
+        for task in self._tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+        if self.server is not None:
+            self.server.close()
+        for connection in list(self.connections.values()):
+            connection.writer.close()
+        if self.websocket is not None:
+            await self.websocket.close()
+        if terminate_session and self.session_id:
+            try:
+                await self.loop.run_in_executor(None, functools.partial(
+                    self.ssm.terminate_session, SessionId=self.session_id))
+            except ClientError as e:
+                logging.error(f"Error terminating SSM session {self.session_id}: {e}")
+        if not self.ready.done():
+            self.ready.set_exception(ConnectionError("Data channel closed before the session was ready"))
+            self.ready.exception()
+        logging.info(f"Port forwarding session {self.session_id} has ended "
+                     f"({self.connection_count} connection(s), {self.bytes_sent} bytes sent, "
+                     f"{self.bytes_received} bytes received).")
+        self.closed.set_result(True)
+
+    def stats(self) -> dict:
+        return {
+            'session_id': self.session_id,
+            'instance_id': self.instance_id,
+            'remote_port': self.remote_port,
+            'local_port': self.local_port,
+            'multiplexed': self.multiplexed,
+            'connections': self.connection_count,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'open_connections': [connection.stats() for connection in self.connections.values()],
+        }
+
+    # Popen-style interface used by the session clean-up code
+
+    def terminate(self) -> None:
+        if self.loop is not None and not self.loop.is_closed():
+            asyncio.run_coroutine_threadsafe(self.close(), self.loop)
+
+    def wait(self, timeout: float = None) -> int:
+        try:
+            asyncio.run_coroutine_threadsafe(asyncio.wait_for(asyncio.shield(self.closed), timeout), self.loop).result()
+        except (asyncio.TimeoutError, TimeoutError):
+            raise subprocess.TimeoutExpired("ssm-port-forwarder", timeout)
+        return 0
+
+    def poll(self):
+        return 0 if self.closed is not None and self.closed.done() else None
+
+    def wait_ready(self, timeout: float = None) -> bool:
+        """Block the calling (non event loop) thread until the tunnel is ready."""
+        async def _wait():
+            await asyncio.wait_for(asyncio.shield(self.ready), timeout)
+        try:
+            asyncio.run_coroutine_threadsafe(_wait(), self.loop).result()
+            return True
+        except (asyncio.TimeoutError, TimeoutError, ConnectionError, NativeForwardingUnavailable):
+            return False
+
+    # Data channel
+
+    async def _send_message(self, message_type: str, payload: bytes, payload_type: int = 0,
+                            flags: int = 0, sequenced: bool = False) -> None:
+        if sequenced:
+            # Only stream data is held back while the agent has paused publication
+            await self._can_send.wait()
+        async with self._send_lock:
+            sequence_number = 0
+            if sequenced:
+                sequence_number = self._out_sequence
+                self._out_sequence += 1
+            message = encode_client_message(message_type, sequence_number, payload, payload_type, flags)
+            if sequenced:
+                self._unacknowledged[sequence_number] = [message, time.monotonic()]
+            await self.websocket.send(message)
+
+    async def _send_input(self, payload: bytes, payload_type: int = PAYLOAD_OUTPUT) -> None:
+        await self._send_message('input_stream_data', payload, payload_type, sequenced=True)
+
+    async def _acknowledge(self, message: dict) -> None:
+        payload = json.dumps({
+            'AcknowledgedMessageType': message['message_type'],
+            'AcknowledgedMessageId': str(message['message_id']),
+            'AcknowledgedMessageSequenceNumber': message['sequence_number'],
+            'IsSequentialMessage': True,
+        }).encode()
+        await self._send_message('acknowledge', payload, flags=3)
+
+    async def _read_loop(self) -> None:
+        try:
+            async for raw in self.websocket:
+                if isinstance(raw, str):
+                    continue
+                try:
+                    message = decode_client_message(raw)
+                except ValueError as e:
+                    logging.warning(f"Dropping malformed data channel message: {e}")
+                    continue
+                await self._dispatch(message)
+        except websockets.exceptions.ConnectionClosed as e:
+            logging.info(f"Data channel for session {self.session_id} closed: {e}")
+        except Exception as e:
+            logging.error(f"An error occurred while reading the data channel: {e}")
+            logging.error(traceback.format_exc())
+        await self.close(terminate_session=False)
+
+    async def _dispatch(self, message: dict) -> None:
+        message_type = message['message_type']
+        if message_type == 'output_stream_data':
+            await self._acknowledge(message)
+            sequence_number = message['sequence_number']
+            if sequence_number < self._in_sequence:
+                return  # A retransmission we have already handled
+            self._pending_output[sequence_number] = message
+            while self._in_sequence in self._pending_output:
+                await self._handle_output(self._pending_output.pop(self._in_sequence))
+                self._in_sequence += 1
+        elif message_type == 'acknowledge':
+            acknowledged = json.loads(message['payload'])
+            self._unacknowledged.pop(acknowledged.get('AcknowledgedMessageSequenceNumber'), None)
+        elif message_type == 'pause_publication':
+            self._can_send.clear()
+        elif message_type == 'start_publication':
+            self._can_send.set()
+        elif message_type == 'channel_closed':
+            output = json.loads(message['payload']).get('Output', '')
+            logging.info(f"Session {self.session_id} closed by the agent. {output}".strip())
+            await self.close(terminate_session=False)
+
+    async def _handle_output(self, message: dict) -> None:
+        payload_type, payload = message['payload_type'], message['payload']
+        if payload_type == PAYLOAD_HANDSHAKE_REQUEST:
+            await self._handshake(json.loads(payload))
+        elif payload_type == PAYLOAD_HANDSHAKE_COMPLETE:
+            if self.multiplexed:
+                self._tasks.append(asyncio.create_task(self._keepalive_loop()))
+            if not self.ready.done():
+                self.ready.set_result(True)
+            logging.info(f"Port forwarding session {self.session_id} is ready on {self.host}:{self.local_port}"
+                         f"{' (multiplexed)' if self.multiplexed else ''}.")
+        elif payload_type == PAYLOAD_OUTPUT:
+            if self.multiplexed:
+                await self._feed_smux(payload)
+            else:
+                connection = self.connections.get(0)
+                if connection is not None:
+                    connection.bytes_received += len(payload)
+                    self.bytes_received += len(payload)
+                    connection.writer.write(payload)
+                    await connection.writer.drain()
+        elif payload_type == PAYLOAD_FLAG and len(payload) >= 4:
+            if struct.unpack('>I', payload[:4])[0] == FLAG_CONNECT_TO_PORT_ERROR:
+                logging.error(f"The agent could not connect to port {self.remote_port} on {self.instance_id}.")
+                connection = self.connections.get(0)
+                if connection is not None:
+                    connection.writer.close()
+
+    async def _handshake(self, request: dict) -> None:
+        self.agent_version = request.get('AgentVersion')
+        processed, errors = [], []
+        for action in request.get('RequestedClientActions', []):
+            if action.get('ActionType') == 'SessionType':
+                processed.append({'ActionType': 'SessionType', 'ActionStatus': 1})
+            else:
+                # KMS encryption is not implemented; the agent will refuse the session
+                processed.append({'ActionType': action.get('ActionType'), 'ActionStatus': 2,
+                                  'Error': f"{action.get('ActionType')} is not supported by this client"})
+                errors.append(f"Unsupported client action {action.get('ActionType')}")
+        self.multiplexed = parse_agent_version(self.agent_version) > SSM_MUX_AGENT_VERSION
+        await self._send_input(json.dumps({
+            'ClientVersion': SSM_CLIENT_VERSION,
+            'ProcessedClientActions': processed,
+            'Errors': errors,
+        }).encode(), PAYLOAD_HANDSHAKE_RESPONSE)
+        if errors and not self.ready.done():
+            self.ready.set_exception(NativeForwardingUnavailable("; ".join(errors)))
+
+    async def _resend_loop(self) -> None:
+        while True:
+            await asyncio.sleep(0.5)
+            now = time.monotonic()
+            for entry in list(self._unacknowledged.values()):
+                if now - entry[1] > 1.5:
+                    entry[1] = now
+                    async with self._send_lock:
+                        await self.websocket.send(entry[0])
+
+    async def _keepalive_loop(self) -> None:
+        while True:
+            await asyncio.sleep(10)
+            await self._send_input(SMUX_HEADER.pack(1, SMUX_NOP, 0, 0))
+
+    # smux streams
+
+    async def _feed_smux(self, data: bytes) -> None:
+        self._smux_buffer += data
+        while len(self._smux_buffer) >= SMUX_HEADER.size:
+            _, command, length, stream_id = SMUX_HEADER.unpack_from(self._smux_buffer)
+            if len(self._smux_buffer) < SMUX_HEADER.size + length:
+                return
+            body = self._smux_buffer[SMUX_HEADER.size:SMUX_HEADER.size + length]
+            self._smux_buffer = self._smux_buffer[SMUX_HEADER.size + length:]
+            connection = self.connections.get(stream_id)
+            if connection is None:
+                continue
+            if command == SMUX_PSH:
+                connection.bytes_received += len(body)
+                self.bytes_received += len(body)
+                connection.writer.write(body)
+                await connection.writer.drain()
+            elif command == SMUX_FIN:
+                connection.remote_closed.set()
+                connection.writer.close()
+
+    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            await asyncio.shield(self.ready)
+        except (ConnectionError, NativeForwardingUnavailable):
+            writer.close()
+            return
+        if self.multiplexed:
+            self._next_stream_id += 2
+            stream_id = self._next_stream_id
+            await self._pump(stream_id, reader, writer)
+        else:
+            # Without smux the session carries a single connection at a time
+            async with self._basic_lock:
+                await self._pump(0, reader, writer)
+
+    async def _pump(self, stream_id: int, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        connection = ForwardedConnection(stream_id, writer)
+        self.connections[stream_id] = connection
+        self.connection_count += 1
+        try:
+            if self.multiplexed:
+                await self._send_input(SMUX_HEADER.pack(1, SMUX_SYN, 0, stream_id))
+            while True:
+                data = await reader.read(SMUX_MAX_FRAME)
+                if not data:
+                    break
+                connection.bytes_sent += len(data)
+                self.bytes_sent += len(data)
+                if self.multiplexed:
+                    data = SMUX_HEADER.pack(1, SMUX_PSH, len(data), stream_id) + data
+                await self._send_input(data)
+            if self.multiplexed:
+                await self._send_input(SMUX_HEADER.pack(1, SMUX_FIN, 0, stream_id))
+                # Keep delivering the response to a half-closed client until the remote side finishes
+                await asyncio.wait_for(connection.remote_closed.wait(), 60)
+            else:
+                await self._send_input(struct.pack('>I', FLAG_DISCONNECT_TO_PORT), PAYLOAD_FLAG)
+        except (ConnectionError, asyncio.TimeoutError, websockets.exceptions.ConnectionClosed) as e:
+            logging.info(f"Forwarded connection {stream_id} on port {self.local_port} ended: {e}")
+        finally:
+            self.connections.pop(stream_id, None)
+            writer.close()
+            logging.info(f"Connection closed on port {self.local_port}: {connection.stats()}")
+
+_forwarding_loop = None
+
+def get_forwarding_loop() -> asyncio.AbstractEventLoop:
+    """The event loop that runs every native tunnel, started on a daemon thread on first use."""
+    global _forwarding_loop
+    if _forwarding_loop is None:
+        _forwarding_loop = asyncio.new_event_loop()
+        if sys.platform == 'linux' and sys.version_info < (3, 12):
+            # The default child watcher starts a thread per subprocess; pidfd watches them from the loop itself
+            try:
+                watcher = asyncio.PidfdChildWatcher()
+                asyncio.set_child_watcher(watcher)
+                watcher.attach_loop(_forwarding_loop)
+            except (AttributeError, OSError):
+                pass
+        threading.Thread(target=_forwarding_loop.run_forever, name='port-forwarding', daemon=True).start()
+    return _forwarding_loop
+
+def get_port_mappings() -> list:
+    """
+    The ports to forward, from the `ports:` list in config.yaml.
+
+    Falls back to the single `remote_port`/`local_port` pair when no list is configured.
+    """
+    mappings = []
+    for index, entry in enumerate(config.get('ports') or []):
+        mappings.append({
+            'name': str(entry.get('name') or f"port-{entry['remote']}"),
+            'remote_port': str(entry['remote']),
+            'local_port': str(entry.get('local') or entry['remote']),
+            'probe': entry.get('probe'),
+            'probe_command': entry.get('probe_command'),
+            'check_listening': bool(entry.get('check_listening')),
+        })
+    if not mappings and REMOTE_PORT_NUMBER and LOCAL_PORT_NUMBER:
+        mappings.append({'name': 'default', 'remote_port': str(REMOTE_PORT_NUMBER), 'local_port': str(LOCAL_PORT_NUMBER),
+                         'probe': config.get('probe'), 'probe_command': config.get('probe_command'),
+                         'check_listening': bool(config.get('check_listening'))})
+    return mappings
+
+def is_local_port_free(port: int, host: str = '127.0.0.1') -> bool:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        # Like the listeners themselves, ignore connections of a closed tunnel lingering in TIME_WAIT
+        probe.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            probe.bind((host, port))
+            return True
+        except OSError:
+            return False
+
+def find_free_port(host: str = '127.0.0.1') -> int:
+    """A port the OS has no listener on right now, for listeners that only this script connects to."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind((host, 0))
+        return probe.getsockname()[1]
+
+async def probe_tcp(port: int, timeout: float = 2, host: str = '127.0.0.1') -> bool:
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    return True
+
+async def probe_http(port: int, path: str = '/', timeout: float = 3, host: str = '127.0.0.1') -> int:
+    """GET `path` on a forwarded port and return the HTTP status code, or None if nothing answered."""
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return None
+    try:
+        writer.write(f"GET {path} HTTP/1.0\r\nHost: {host}:{port}\r\nConnection: close\r\n\r\n".encode())
+        await writer.drain()
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        parts = status_line.decode(errors='replace').split()
+        return int(parts[1]) if len(parts) >= 2 and parts[1].isdigit() else None
+    except (OSError, asyncio.TimeoutError):
+        return None
+    finally:
+        writer.close()
+
+# Metered local proxy: counting what passes through a forwarded port
+
+# A chunk from the client that starts with one of these is counted as an HTTP request
+HTTP_REQUEST_METHODS = (b'GET ', b'POST ', b'PUT ', b'PATCH ', b'DELETE ', b'HEAD ', b'OPTIONS ')
+
+class MeteredProxy:
+    """
+    Listens on a tunnel's local port and relays every connection to the port the tunnel itself listens on.
+
+    It counts connections, bytes in each direction and HTTP requests, and times each exchange from
+    the client's first bytes to the first byte of the reply, which covers the round trip over the
+    tunnel plus the app's own response time. The supervisor's probes go to the tunnel directly, so
+    `last_activity` only moves for real traffic. The proxy outlives reconnects of its tunnel.
+    """
+
+    def __init__(self, local_port: int, target_port: int, host: str = '127.0.0.1'):
+        self.local_port = local_port
+        self.target_port = target_port
+        self.host = host
+        self.server = None
+        self.connections = 0
+        self.requests = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latencies = deque(maxlen=200)
+        self.last_activity = time.monotonic()
+        self._writers = set()
+
+    async def start(self) -> 'MeteredProxy':
+        self.server = await asyncio.start_server(self._accept, self.host, self.local_port)
+        return self
+
+    async def close(self) -> None:
+        if self.server is None:
+            return
+        self.server.close()
+        for writer in list(self._writers):
+            writer.close()
+        await self.server.wait_closed()
+        self.server = None
+
+    def stats(self) -> dict:
+        latencies = sorted(self.latencies)
+        return {
+            'connections': self.connections,
+            'requests': self.requests,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'latency_ms_p50': round(latencies[len(latencies) // 2] * 1000, 1) if latencies else None,
+            'latency_ms_p95': round(latencies[int(len(latencies) * 0.95)] * 1000, 1) if latencies else None,
+            'idle_seconds': round(time.monotonic() - self.last_activity, 1),
+        }
+
+    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            upstream_reader, upstream_writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.target_port), 10)
+        except (OSError, asyncio.TimeoutError) as e:
+            logging.warning(f"Proxy on port {self.local_port} could not reach its tunnel on port {self.target_port}: {e}")
+            writer.close()
+            return
+        self.connections += 1
+        self.last_activity = time.monotonic()
+        self._writers.update((writer, upstream_writer))
+        exchange = {'sent_at': None}  # When the client last sent something the reply to which has not started yet
+        try:
+            await asyncio.gather(self._relay(reader, upstream_writer, exchange, outbound=True),
+                                 self._relay(upstream_reader, writer, exchange, outbound=False))
+        finally:
+            for stream_writer in (writer, upstream_writer):
+                stream_writer.close()
+                self._writers.discard(stream_writer)
+
+    async def _relay(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, exchange: dict,
+                     outbound: bool) -> None:
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                now = time.monotonic()
+                self.last_activity = now
+                if outbound:
+                    self.bytes_sent += len(data)
+                    if data.startswith(HTTP_REQUEST_METHODS):
+                        self.requests += 1
+                    if exchange['sent_at'] is None:
+                        exchange['sent_at'] = now
+                else:
+                    self.bytes_received += len(data)
+                    if exchange['sent_at'] is not None:
+                        self.latencies.append(now - exchange['sent_at'])
+                        exchange['sent_at'] = None
+                writer.write(data)
+                await writer.drain()
+            # Pass the half-close on, so that the other direction can still finish
+            if writer.can_write_eof():
+                writer.write_eof()
+        except (ConnectionError, OSError):
+            writer.close()
+
+# Kinds of SessionEvent
+SESSION_STARTED = 'started'
+SESSION_PORT_OPENED = 'port_opened'
+SESSION_WAITING = 'waiting_for_connections'
+SESSION_CONNECTION_ACCEPTED = 'connection_accepted'
+SESSION_EXITED = 'exited'
+SESSION_OUTPUT = 'output'
+
+# How many recent session events the supervisor keeps for diagnostics
+SESSION_EVENT_BUFFER = 500
+
+class SessionEvent:
+    """Something a port forwarding session reported, parsed from the Session Manager plugin's output."""
+
+    def __init__(self, kind: str, tunnel: str, instance_id: str, session_id: str = None, detail: str = None):
+        self.time = time.time()
+        self.kind = kind
+        self.tunnel = tunnel
+        self.instance_id = instance_id
+        self.session_id = session_id
+        self.detail = detail
+
+    @classmethod
+    def parse(cls, line: str, tunnel: str, instance_id: str):
+        """The event for one line of `aws ssm start-session` output."""
+        patterns = (
+            (SESSION_STARTED, r"Starting session with SessionId: (\S+)"),
+            (SESSION_PORT_OPENED, r"Port (\d+) opened for sessionId (\S+?)\.?$"),
+            (SESSION_WAITING, r"Waiting for connections"),
+            (SESSION_CONNECTION_ACCEPTED, r"Connection accepted for session \[?([^\]\s]+)\]?"),
+            (SESSION_EXITED, r"Exiting session with sessionId: (\S+?)\.?$"),
+        )
+        for kind, pattern in patterns:
+            match = re.search(pattern, line)
+            if match:
+                if kind == SESSION_PORT_OPENED:
+                    return cls(kind, tunnel, instance_id, match.group(2), f"local port {match.group(1)}")
+                return cls(kind, tunnel, instance_id, match.group(1) if match.groups() else None)
+        return cls(SESSION_OUTPUT, tunnel, instance_id, detail=line)
+
+    def to_dict(self) -> dict:
+        return {
+            'time': datetime.datetime.fromtimestamp(self.time).isoformat(timespec='milliseconds'),
+            'kind': self.kind,
+            'tunnel': self.tunnel,
+            'instance_id': self.instance_id,
+            'session_id': self.session_id,
+            'detail': self.detail,
+        }
+
+class Tunnel:
+    """One forwarded port on one instance, as tracked by the TunnelSupervisor."""
+
+    def __init__(self, name: str, instance_id: str, remote_port: str, requested_port: int, probe: str = None,
+                 probe_command: str = None, check_listening: bool = False):
+        self.name = name
+        self.instance_id = instance_id
+        self.remote_port = remote_port
+        self.probe = probe
+        self.probe_command = probe_command
+        self.check_listening = check_listening
+        self.requested_port = requested_port
+        self.local_port = requested_port
+        # The port the session listens on; a different one when a MeteredProxy holds local_port
+        self.forward_port = requested_port
+        self.proxy = None
+        self.state = 'pending'
+        self.session_id = None
+        self.handle = None
+        self.ready = None
+        self.started_at = None
+        self.ready_at = None
+        self.error = None
+        self.created_at = time.monotonic()
+        self.app_seen_up = False
+        self.attempt = 0
+        self.lost_at = None
+        self.reconnects = 0
+        self.reconnect_latencies = deque(maxlen=50)
+        self.adopted = False
+        self.cli_connections = 0
+        # App readiness: every configured check has to pass once ('http', 'listening', 'command')
+        self.app_checks = {check: None for check, wanted in (('http', probe), ('listening', check_listening),
+                                                             ('command', probe_command)) if wanted}
+        self.app_state = 'waiting' if self.app_checks else None
+        self.app_ready_at = None
+        self.app_span = (tracer.start('app_ready', tunnel=name, instance_id=instance_id, checks=list(self.app_checks))
+                         if self.app_checks else None)
+
+    @classmethod
+    def from_mapping(cls, mapping: dict, instance_id: str, requested_port: int) -> 'Tunnel':
+        return cls(mapping['name'], instance_id, mapping['remote_port'], requested_port, mapping.get('probe'),
+                   mapping.get('probe_command'), mapping.get('check_listening', False))
+
+    def stats(self) -> dict:
+        stats = {
+            'name': self.name,
+            'instance_id': self.instance_id,
+            'remote_port': self.remote_port,
+            'local_port': self.local_port,
+            'state': self.state,
+            'session_id': self.session_id,
+            'adopted': self.adopted,
+            'pid': getattr(self.handle, 'pid', None),
+            'startup_seconds': round(self.ready_at - self.started_at, 2) if self.ready_at else None,
+            'error': self.error,
+            'app_state': self.app_state,
+            'app_ready_at': (datetime.datetime.fromtimestamp(self.app_ready_at).isoformat(timespec='seconds')
+                             if self.app_ready_at else None),
+            'reconnects': self.reconnects,
+            'reconnects_per_hour': round(self.reconnects * 3600 / max(time.monotonic() - self.created_at, 1), 2),
+            'last_reconnect_seconds': round(self.reconnect_latencies[-1], 2) if self.reconnect_latencies else None,
+            'mean_reconnect_seconds': (round(sum(self.reconnect_latencies) / len(self.reconnect_latencies), 2)
+                                       if self.reconnect_latencies else None),
+        }
+        if isinstance(self.handle, SsmPortForwarder):
+            stats.update(connections=self.handle.connection_count, bytes_sent=self.handle.bytes_sent,
+                         bytes_received=self.handle.bytes_received)
+        else:
+            # The CLI reports accepted connections but not throughput
+            stats.update(connections=self.cli_connections, bytes_sent=None, bytes_received=None)
+        if self.proxy is not None:
+            # Only the traffic that passed through the proxy; the supervisor's own probes bypass it
+            stats.update(self.proxy.stats())
+        return stats
+
+class TunnelSupervisor:
+    """
+    Runs every port forward for every instance from one asyncio event loop.
+
+    Native tunnels are SsmPortForwarder instances; CLI tunnels are `aws ssm start-session`
+    processes whose pipes are read asynchronously on the same loop. Either way no thread is
+    created per tunnel. The public methods are safe to call from any other thread.
+
+    Each ready tunnel is probed every few seconds: the local port must accept connections and,
+    if the port has a `probe` path, the remote app must answer HTTP once it has been seen up.
+    A tunnel that exits or fails its probes is re-established on its own with jittered
+    exponential backoff, leaving the instance, the shell and the other tunnels untouched.
+
+    A local port that another run of this script recorded as its tunnel to the same instance, for
+    example one opened from another terminal, is adopted instead while that session is live: it
+    is only probed, and a tunnel of our own replaces it if it stops responding. Only sessions
+    started here are terminated on stop.
+    """
+
+    def __init__(self, ssm, aws_region: str, mappings: list, backend: str = None):
+        self.ssm = ssm
+        self.aws_region = aws_region
+        self.mappings = mappings
+        self.backend = backend or PORT_FORWARDING_BACKEND
+        self.loop = get_forwarding_loop()
+        self.tunnels = []
+        self._tasks = []
+        self._stopping = False
+        self.owned_session_ids = set()
+        self.events = deque(maxlen=SESSION_EVENT_BUFFER)
+        self.probe_interval = float(tunnel_health_config.get('probe_interval', 5))
+        self.failure_threshold = int(tunnel_health_config.get('failure_threshold', 2))
+        self.max_backoff = float(tunnel_health_config.get('max_backoff', 30))
+        self.app_initial_interval = float(app_readiness_config.get('initial_interval', 0.5))
+        self.app_max_interval = float(app_readiness_config.get('max_interval', 5))
+        self.app_ssm_interval = float(app_readiness_config.get('ssm_interval', 10))
+        self.app_timeout = float(app_readiness_config.get('timeout', 1800))
+        self.metered = bool(metering_config) and metering_config.get('enabled', True) is not False
+
+    def add_instance(self, instance_id: str, index: int = 0, adoptable: dict = None) -> list:
+        """
+        Start forwarding every configured port for `instance_id`, shifted by its fleet index.
+
+        `adoptable` maps (remote port, local port) pairs to the live session of a tunnel another run
+        recorded (see find_adoptable_tunnels); those local ports are adopted rather than forwarded
+        again while they accept connections.
+        """
+        tunnels = [
+            Tunnel.from_mapping(mapping, instance_id, int(fleet_local_port(mapping['local_port'], index)))
+            for mapping in self.mappings
+        ]
+        asyncio.run_coroutine_threadsafe(self._start(tunnels, adoptable or {}), self.loop).result()
+        return tunnels
+
+    def replace_instance(self, instance_id: str, replacement_id: str, timeout: float = 30) -> list:
+        """
+        Move every tunnel of `instance_id` to `replacement_id`, keeping their local ports.
+
+        The old tunnels are closed first so that their ports are free; the new ones are given up
+        to `timeout` seconds to become ready before this returns.
+        """
+        return asyncio.run_coroutine_threadsafe(self._replace_instance(instance_id, replacement_id, timeout),
+                                                self.loop).result()
+
+    def remove_instance(self, instance_id: str) -> list:
+        """Close every tunnel of `instance_id`, for example because it was stopped. Returns the closed tunnels."""
+        return asyncio.run_coroutine_threadsafe(self._remove_instance(instance_id), self.loop).result()
+
+    def wait_ready(self, timeout: float) -> bool:
+        """Block until every tunnel is ready or `timeout` seconds have passed."""
+        async def _wait():
+            futures = [tunnel.ready for tunnel in self.tunnels]
+            done, _ = await asyncio.wait(futures, timeout=timeout)
+            return len(done) == len(futures) and all(not future.exception() for future in done)
+        return asyncio.run_coroutine_threadsafe(_wait(), self.loop).result()
+
+    def status(self) -> list:
+        return asyncio.run_coroutine_threadsafe(self._status(), self.loop).result()
+
+    def recent_events(self, limit: int = 50) -> list:
+        """The last `limit` session events, oldest first."""
+        async def _recent():
+            return [event.to_dict() for event in list(self.events)[-limit:]]
+        return asyncio.run_coroutine_threadsafe(_recent(), self.loop).result()
+
+    def stop(self, timeout: float = 10) -> None:
+        try:
+            asyncio.run_coroutine_threadsafe(self._stop(), self.loop).result(timeout=timeout)
+        except Exception as e:
+            logging.error(f"Error stopping port forwarding tunnels: {e}")
+
+    def log_status(self) -> None:
+        for stats in self.status():
+            logging.info(
+                f"Tunnel {stats['name']} {stats['instance_id']}:{stats['remote_port']} -> 127.0.0.1:{stats['local_port']} "
+                f"is {stats['state']}" + (f", {stats['bytes_sent']} bytes sent, {stats['bytes_received']} bytes received"
+                                          if stats['bytes_sent'] is not None else "")
+                + (f", {stats['reconnects']} reconnect(s), mean {stats['mean_reconnect_seconds']}s"
+                   if stats['reconnects'] else "")
+            )
+
+    async def _status(self) -> list:
+        return [tunnel.stats() for tunnel in self.tunnels]
 
-    # Check if AWS CLI is installed
-    if not shutil.which("aws"):
-        logging.error("AWS CLI is not installed or not found in PATH.")
-        return False
+    async def _start(self, tunnels: list, adoptable: dict = None) -> None:
+        adoptable = adoptable or {}
+        for tunnel in tunnels:
+            tunnel.ready = self.loop.create_future()
+            session_id = adoptable.get((tunnel.remote_port, tunnel.requested_port))
+            if session_id and await probe_tcp(tunnel.requested_port):
+                tunnel.adopted = True
+                tunnel.session_id = session_id
+                tunnel.local_port = tunnel.requested_port
+                tunnel.state = 'adopted'
+                tunnel.ready.set_result(True)
+                logging.info(f"{tunnel.name}: adopted the existing tunnel to {tunnel.instance_id} on "
+                             f"http://127.0.0.1:{tunnel.local_port}")
+            else:
+                tunnel.local_port = self._claim_local_port(tunnel)
+                await self._open_proxy(tunnel)
+            self.tunnels.append(tunnel)
+            self._tasks.append(asyncio.create_task(self._run(tunnel)))
 
-    # Use the AWS CLI 'aws ssm start-session' command to start an interactive shell session
-    start_session_command = [
-        "aws",
-        "ssm",
-        "start-session",
-        "--target",
-        instance_id,
-        "--region",
-        aws_region
-    ]
+    async def _remove_instance(self, instance_id: str) -> list:
+        removing = [(tunnel, task) for tunnel, task in zip(self.tunnels, self._tasks) if tunnel.instance_id == instance_id]
+        for _, task in removing:
+            task.cancel()
+        await asyncio.gather(*[task for _, task in removing], return_exceptions=True)
+        for tunnel, task in removing:
+            self.tunnels.remove(tunnel)
+            self._tasks.remove(task)
+            if tunnel.app_span:
+                tunnel.app_span.end('cancelled')
+        return [tunnel for tunnel, _ in removing]
 
-    logging.info(f"Running command: {' '.join(start_session_command)}")
+    async def _replace_instance(self, instance_id: str, replacement_id: str, timeout: float) -> list:
+        tunnels = [Tunnel(tunnel.name, replacement_id, tunnel.remote_port, tunnel.local_port, tunnel.probe,
+                          tunnel.probe_command, tunnel.check_listening)
+                   for tunnel in await self._remove_instance(instance_id)]
+        await self._start(tunnels)
+        if tunnels:
+            await asyncio.wait([tunnel.ready for tunnel in tunnels], timeout=timeout)
+        logging.info(f"Moved {len(tunnels)} tunnel(s) from {instance_id} to {replacement_id}.")
+        return tunnels
 
-    try:
-        logging.info("About to start the SSM session...")
-        result = subprocess.run(start_session_command, stderr=subprocess.PIPE, check=True)
-        logging.info("SSM session started.")
-        
-        if result.returncode != 0:
-            logging.error(f"Failed to start SSM session: {result.stderr}")
-            return False
+    def _claim_local_port(self, tunnel: Tunnel) -> int:
+        """The requested local port, or the next free one if another program or tunnel holds it."""
+        claimed = {other.local_port for other in self.tunnels}
+        for port in range(tunnel.requested_port, tunnel.requested_port + 100):
+            if port not in claimed and is_local_port_free(port):
+                if port != tunnel.requested_port:
+                    logging.warning(f"Local port {tunnel.requested_port} is in use; forwarding {tunnel.name} "
+                                    f"on {tunnel.instance_id} to port {port} instead.")
+                return port
+        raise OSError(f"No free local port near {tunnel.requested_port} for {tunnel.name}")
 
-        logging.info(f"SSM session started successfully.")
-        return True
+    async def _open_proxy(self, tunnel: Tunnel) -> None:
+        """With metering on, put a MeteredProxy on the tunnel's local port and move its session to a free port behind it."""
+        tunnel.forward_port = tunnel.local_port
+        if not self.metered:
+            return
+        forward_port = find_free_port()
+        try:
+            tunnel.proxy = await MeteredProxy(tunnel.local_port, forward_port).start()
+        except OSError as e:
+            logging.warning(f"Could not start the metering proxy for {tunnel.name} on port {tunnel.local_port} ({e}); "
+                            f"forwarding it unmetered.")
+            return
+        tunnel.forward_port = forward_port
 
-    except subprocess.TimeoutExpired:
-        logging.error("SSM session command timed out.")
-        return False
+    async def _run(self, tunnel: Tunnel) -> None:
+        """Keep `tunnel` up until the supervisor stops, re-establishing it whenever it dies."""
+        # App readiness is checked across reconnects and stops with the tunnel
+        app_task = asyncio.create_task(self._watch_app(tunnel)) if tunnel.app_checks else None
+        try:
+            if tunnel.adopted:
+                await self._probe(tunnel)
+                logging.warning(f"Adopted tunnel {tunnel.name} on {tunnel.instance_id} stopped responding "
+                                f"({tunnel.error}); starting a new one.")
+                tunnel.adopted = False
+                tunnel.lost_at = time.monotonic()
+                await self._open_proxy(tunnel)
+            while not self._stopping:
+                tunnel.state = 'reconnecting' if tunnel.lost_at else 'starting'
+                tunnel.started_at = time.monotonic()
+                run_task = asyncio.create_task(self._run_once(tunnel))
+                probe_task = asyncio.create_task(self._probe(tunnel))
+                try:
+                    await asyncio.wait({run_task, probe_task}, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    for task in (run_task, probe_task):
+                        task.cancel()
+                    await asyncio.gather(run_task, probe_task, return_exceptions=True)
+                    await self._close_handle(tunnel)
+                if self._stopping:
+                    break
 
-    except subprocess.CalledProcessError as e:
-        logging.error(f"An error occurred while starting the SSM session: {e}")
-        return False
+                tunnel.state = 'down'
+                tunnel.lost_at = tunnel.lost_at or time.monotonic()
+                if not tunnel.ready.done():
+                    # Let wait_ready() return early; reconnecting carries on in the background
+                    tunnel.ready.set_exception(ConnectionError(tunnel.error or "Tunnel closed before it was ready"))
+                    tunnel.ready.exception()
+                tunnel.attempt += 1
+                # Full jitter keeps tunnels that died together from reconnecting in lockstep
+                delay = random.uniform(0, min(self.max_backoff, 2 ** (tunnel.attempt - 1)))
+                logging.warning(f"Tunnel {tunnel.name} on {tunnel.instance_id} is down ({tunnel.error or 'closed'}); "
+                                f"reconnecting in {delay:.1f}s (attempt {tunnel.attempt}).")
+                await asyncio.sleep(delay)
+        finally:
+            tunnel.state = 'closed'
+            if app_task is not None:
+                app_task.cancel()
+            if tunnel.proxy is not None:
+                await tunnel.proxy.close()
 
-    except Exception as e:
-        logging.error(f"An unexpected error occurred: {e}")
-        return False
-        
-def ensure_ssm_session(ssm, instance_id: str, aws_region: str) -> bool:
-    existing_sessions = check_existing_ssm(ssm, instance_id, aws_region)
-    
-    if existing_sessions['shell_sessions']:
-        logging.info(f"Terminating active SSM shell session for instance {instance_id}...")
-        for session in existing_sessions['shell_sessions']:
-            ssm.terminate_session(SessionId=session['SessionId'])
-        time.sleep(2)
-
-    shell_session_started = start_ssm_shell_session(ssm, instance_id, aws_region)
-    logging.info(f"SSM shell session started: {shell_session_started}")
-    if not shell_session_started:
-        return False
+    async def _run_once(self, tunnel: Tunnel) -> None:
+        try:
+            if self.backend == 'native':
+                try:
+                    await self._run_native(tunnel)
+                except NativeForwardingUnavailable as e:
+                    # The Session Manager plugin supports everything the agent can ask for
+                    logging.warning(f"Cannot forward {tunnel.name} on {tunnel.instance_id} natively ({e}); "
+                                    f"using aws ssm start-session instead.")
+                    self.backend = 'cli'
+                    await self._close_handle(tunnel)
+                    await self._run_cli(tunnel)
+            else:
+                await self._run_cli(tunnel)
+            tunnel.error = "session closed"
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            tunnel.error = str(e)
+            logging.error(f"Port forwarding for {tunnel.name} on {tunnel.instance_id} failed: {e}")
 
-    if existing_sessions['port_forwarding_sessions']:
-        logging.info(f"Terminating active SSM port forwarding session for instance {instance_id}...")
-        for session in existing_sessions['port_forwarding_sessions']:
-            ssm.terminate_session(SessionId=session['SessionId'])
-        time.sleep(2)
+    async def _probe(self, tunnel: Tunnel) -> None:
+        """Return once the tunnel has failed `failure_threshold` probes in a row."""
+        failures = 0
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            if tunnel.state not in ('ready', 'adopted'):
+                continue
+            healthy, reason = await self._probe_once(tunnel)
+            failures = 0 if healthy else failures + 1
+            if failures >= self.failure_threshold:
+                tunnel.error = reason
+                return
 
-    port_forwarding_session_started = start_ssm_port_forwarding_session(ssm, instance_id, aws_region, REMOTE_PORT_NUMBER, LOCAL_PORT_NUMBER)
-    logging.info(f"SSM port forwarding session started: {port_forwarding_session_started}")
+    async def _probe_once(self, tunnel: Tunnel) -> tuple:
+        if isinstance(tunnel.handle, SsmPortForwarder) and tunnel.handle.closed.done():
+            return False, "data channel closed"
+        if not await probe_tcp(tunnel.forward_port):
+            return False, f"local port {tunnel.forward_port} is not accepting connections"
+        # Only an app that answered before counts; one that is still loading is not a dead tunnel
+        if tunnel.probe and tunnel.app_seen_up and await probe_http(tunnel.forward_port, tunnel.probe) is None:
+            return False, f"remote app stopped answering on {tunnel.probe}"
+        return True, None
 
-    return port_forwarding_session_started
+    async def _watch_app(self, tunnel: Tunnel) -> None:
+        """
+        Check the app behind `tunnel` until every configured check has passed once, then report it ready.
 
-def is_ssm_agent_configured(ssm, instance_id: str) -> bool:
-    try:
-        response = ssm.describe_instance_information(
-            InstanceInformationFilterList=[{'key': 'InstanceIds', 'valueSet': [instance_id]}]
-        )
-        return bool(response['InstanceInformationList'])
-    except ClientError as e:
-        logging.error(f"ClientError occurred while checking SSM agent configuration: {e}")
-        raise
+        The HTTP probe goes through the tunnel at intervals that start short and grow while the app is
+        still loading; the checks run on the instance over SSM are spaced by `ssm_interval`.
+        """
+        started = time.monotonic()
+        interval = self.app_initial_interval
+        next_ssm_check = started
+        while any(passed is None for passed in tunnel.app_checks.values()):
+            if time.monotonic() - started > self.app_timeout:
+                tunnel.app_state = 'timeout'
+                tunnel.app_span.end('timeout')
+                logging.warning(f"{tunnel.name} on {tunnel.instance_id}: app not ready after {self.app_timeout:.0f}s "
+                                f"({', '.join(check for check, passed in tunnel.app_checks.items() if passed is None)} pending).")
+                return
+            await asyncio.sleep(interval)
+            interval = min(self.app_max_interval, interval * 1.5)
+            if tunnel.app_checks.get('http') is None and tunnel.state in ('ready', 'adopted'):
+                status = await probe_http(tunnel.forward_port, tunnel.probe)
+                # Anything below 500 means the server is up; 502/503 usually mean it is still loading
+                if status is not None and status < 500:
+                    tunnel.app_checks['http'] = time.time()
+                    tunnel.app_seen_up = True
+            if time.monotonic() >= next_ssm_check and any(
+                    tunnel.app_checks.get(check) is None for check in ('listening', 'command') if check in tunnel.app_checks):
+                next_ssm_check = time.monotonic() + self.app_ssm_interval
+                await self._check_app_on_instance(tunnel)
+        if not tunnel.app_checks:
+            tunnel.app_state = 'unknown'
+            tunnel.app_span.end('skipped')
+            return
+        tunnel.app_state = 'ready'
+        tunnel.app_ready_at = max(tunnel.app_checks.values())
+        tunnel.app_span.end()
+        logging.info(f"{tunnel.name} on {tunnel.instance_id}: app ready at "
+                     f"{datetime.datetime.fromtimestamp(tunnel.app_ready_at).strftime('%H:%M:%S')} "
+                     f"({time.monotonic() - started:.1f}s after the tunnel started), http://127.0.0.1:{tunnel.local_port}")
 
-def start_ssm_shell_session(instance_id: str, aws_region: str) -> subprocess.Popen:
-    logging.info("Attempting to start an SSM shell session...")
-    shell_session_command = [
-        "aws", "ssm", "start-session",
-        "--target", instance_id,
-        "--region", aws_region
-    ]
+    async def _check_app_on_instance(self, tunnel: Tunnel) -> None:
+        """Run the pending SSM checks: a process listening on the remote port, and the custom probe command."""
+        commands = {}
+        if tunnel.app_checks.get('listening', 0) is None:
+            commands['listening'] = [f"ss -Hltnp 'sport = :{tunnel.remote_port}'"]
+        if tunnel.app_checks.get('command', 0) is None:
+            commands['command'] = [tunnel.probe_command]
+        for check, check_commands in commands.items():
+            try:
+                result = await self.loop.run_in_executor(None, run_ssm_command, self.ssm, tunnel.instance_id, check_commands)
+            except ClientError as e:
+                # Without ssm:SendCommand the check can never pass; readiness rests on the other checks
+                logging.warning(f"{tunnel.name} on {tunnel.instance_id}: cannot run the '{check}' check over SSM ({e}); skipping it.")
+                del tunnel.app_checks[check]
+                continue
+            if result['status'] == 'Success' and (check != 'listening' or result['stdout'].strip()):
+                tunnel.app_checks[check] = time.time()
+                if check == 'listening':
+                    logging.info(f"{tunnel.name} on {tunnel.instance_id}: listening on port {tunnel.remote_port}: "
+                                 f"{result['stdout'].strip().splitlines()[0]}")
 
-    try:
-        process = subprocess.Popen(shell_session_command)
-        logging.info(f"SSM session started successfully.")
-        return process
-    except Exception as e:
-        logging.error(f"An unexpected error occurred: {e}")
-        return None
+    async def _close_handle(self, tunnel: Tunnel) -> None:
+        if isinstance(tunnel.handle, SsmPortForwarder):
+            await tunnel.handle.close()
+        elif tunnel.handle is not None and tunnel.handle.returncode is None:
+            tunnel.handle.terminate()
+            try:
+                await asyncio.wait_for(tunnel.handle.wait(), 5)
+            except asyncio.TimeoutError:
+                tunnel.handle.kill()
 
+    def _record(self, tunnel: Tunnel, event: SessionEvent) -> None:
+        """Keep `event` in the ring buffer. Raw output is only buffered; lifecycle events are also logged."""
+        event.session_id = event.session_id or tunnel.session_id
+        self.events.append(event)
+        if event.kind == SESSION_STARTED:
+            logging.info(f"Port forwarding session {event.session_id} has started for {tunnel.name} on {tunnel.instance_id}.")
+        elif event.kind == SESSION_EXITED:
+            logging.info(f"Port forwarding session {event.session_id or tunnel.session_id} for {tunnel.name} "
+                         f"on {tunnel.instance_id} exited" + (f" ({event.detail})." if event.detail else "."))
 
-def handle_output(process, ready_event):
-    try:
+    def _recent_output(self, tunnel: Tunnel, lines: int = 5) -> str:
+        output = [event.detail for event in self.events
+                  if event.kind == SESSION_OUTPUT and event.tunnel == tunnel.name and event.instance_id == tunnel.instance_id]
+        return " | ".join(output[-lines:])
+
+    def _mark_ready(self, tunnel: Tunnel) -> None:
+        tunnel.state = 'ready'
+        tunnel.ready_at = time.monotonic()
+        tunnel.attempt = 0
+        tunnel.error = None
+        if tunnel.lost_at is not None:
+            latency = tunnel.ready_at - tunnel.lost_at
+            tunnel.reconnects += 1
+            tunnel.reconnect_latencies.append(latency)
+            tunnel.lost_at = None
+            logging.info(f"Tunnel {tunnel.name} on {tunnel.instance_id} reconnected after {latency:.1f}s "
+                         f"({tunnel.reconnects} reconnect(s) so far).")
+        if not tunnel.ready.done():
+            tunnel.ready.set_result(True)
+        logging.info(f"{tunnel.name}: {tunnel.instance_id} port {tunnel.remote_port} is available at "
+                     f"http://127.0.0.1:{tunnel.local_port}")
+
+    async def _run_native(self, tunnel: Tunnel) -> None:
+        forwarder = SsmPortForwarder(self.ssm, tunnel.instance_id, tunnel.remote_port, tunnel.forward_port)
+        tunnel.handle = forwarder
+        await forwarder.start()
+        tunnel.session_id = forwarder.session_id
+        self.owned_session_ids.add(forwarder.session_id)
+        self._record(tunnel, SessionEvent(SESSION_STARTED, tunnel.name, tunnel.instance_id, forwarder.session_id))
+        # Shielded: cancelling this task must not cancel the forwarder's futures, or close() would skip its clean-up
+        await asyncio.shield(forwarder.ready)
+        self._record(tunnel, SessionEvent(SESSION_PORT_OPENED, tunnel.name, tunnel.instance_id, forwarder.session_id,
+                                          f"local port {tunnel.forward_port}"))
+        self._mark_ready(tunnel)
+        try:
+            await asyncio.shield(forwarder.closed)
+        finally:
+            self._record(tunnel, SessionEvent(SESSION_EXITED, tunnel.name, tunnel.instance_id, forwarder.session_id,
+                                              f"{forwarder.connection_count} connection(s)"))
+
+    async def _run_cli(self, tunnel: Tunnel) -> None:
+        if not shutil.which("aws"):
+            raise RuntimeError("AWS CLI is not installed or not found in PATH.")
+        process = await asyncio.create_subprocess_exec(
+            "aws", "ssm", "start-session",
+            "--target", tunnel.instance_id,
+            "--region", self.aws_region,
+            "--document-name", "AWS-StartPortForwardingSession",
+            "--parameters", f"portNumber={tunnel.remote_port},localPortNumber={tunnel.forward_port}",
+            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+        tunnel.handle = process
+        # Both pipes are drained so a chatty stderr can never block the session
+        await asyncio.gather(
+            self._read_cli_output(tunnel, process.stdout),
+            self._read_cli_output(tunnel, process.stderr),
+        )
+        returncode = await process.wait()
+        self._record(tunnel, SessionEvent(SESSION_EXITED, tunnel.name, tunnel.instance_id, tunnel.session_id,
+                                          f"status {returncode}"))
+        if returncode:
+            recent = self._recent_output(tunnel)
+            raise RuntimeError(f"aws ssm start-session exited with status {returncode}" + (f": {recent}" if recent else ""))
+
+    async def _read_cli_output(self, tunnel: Tunnel, stream: asyncio.StreamReader) -> None:
         while True:
-            output = process.stdout.readline().decode().strip()
-            if output == '' and process.poll() is not None:
-                break
-            if output:
-                if "Waiting for connections..." in output:
-                    logging.info("Port forwarding session is ready.")
-                    ready_event.set()
-                elif "Starting session with SessionId:" in output:
-                    session_id = output.split(":")[1].strip()
-                    logging.info(f"Port forwarding session {session_id} has started.")
-                elif "Port opened for sessionId" in output:
-                    port, session_id = output.split("opened for sessionId")
-                    logging.info(f"Port {port.strip()} opened for session {session_id.strip()}.")
-                elif "Exiting session with sessionId:" in output:
-                    session_id = output.split(":")[1].strip()
-                    logging.info(f"Port forwarding session {session_id} has ended.")
-                else:
-                    logging.info(f"Port forwarding session output: {output}")
-    except Exception as e:
-        logging.error(f"An error occurred while handling the process output: {e}")
-        logging.error("Terminating the port forwarding session due to the error.")
-        process.terminate()
+            line = await stream.readline()
+            if not line:
+                return
+            output = line.decode(errors='replace').strip()
+            if not output:
+                continue
+            event = SessionEvent.parse(output, tunnel.name, tunnel.instance_id)
+            if event.kind == SESSION_EXITED:
+                continue  # Recorded with the exit status once the process has gone
+            self._record(tunnel, event)
+            if event.kind == SESSION_STARTED:
+                tunnel.session_id = event.session_id
+                self.owned_session_ids.add(tunnel.session_id)
+            elif event.kind == SESSION_WAITING:
+                self._mark_ready(tunnel)
+            elif event.kind == SESSION_CONNECTION_ACCEPTED:
+                tunnel.cli_connections += 1
+
+    async def _stop(self) -> None:
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        # Native tunnels end their own sessions; make sure CLI ones did too, and touch nothing else
+        cli_session_ids = self.owned_session_ids - {
+            tunnel.handle.session_id for tunnel in self.tunnels if isinstance(tunnel.handle, SsmPortForwarder)
+        }
+        for session_id in cli_session_ids:
+            await self.loop.run_in_executor(None, terminate_ssm_session, self.ssm, session_id)
+        logging.info("SSM port forwarding sessions started by this run terminated.")
 
-def start_ssm_port_forwarding_session(instance_id: str, aws_region: str, remote_port: str, local_port: str) -> subprocess.Popen:
-    logging.info("Attempting to start an SSM port forwarding session in the background...")
-    port_forwarding_command = [
-        "aws", "ssm", "start-session",
-        "--target", instance_id,
-        "--region", aws_region,
-        "--document-name", "AWS-StartPortForwardingSession",
-        "--parameters", f"portNumber={remote_port},localPortNumber={local_port}"
-    ]
-    try:
-        process = subprocess.Popen(port_forwarding_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        # Start a new thread to handle the process's output
-        threading.Thread(target=handle_output, args=(process, ready_event)).start()
-        return process
-    except subprocess.SubprocessError as e:
-        logging.error(f"An error occurred while starting the SSM port forwarding session: {e}")
-        return None
-    except Exception as e:
-        logging.error(f"An unexpected error occurred while starting the SSM port forwarding session: {e}")
-        return None
-    
 def terminate_ssm_session(ssm, session_id: str) -> None:
     try:
         ssm.terminate_session(SessionId=session_id)
@@ -356,75 +3288,76 @@ def terminate_ssm_session(ssm, session_id: str) -> None:
     except ClientError as e:
         logging.error(f"Error terminating SSM session {session_id}: {e}")
 
-def terminate_port_forwarding_session(port_forwarding_process, ssm, instance_id):
-    try:
-        # Terminate the port forwarding session
-        port_forwarding_process.terminate()
-        port_forwarding_process.wait(timeout=5)
-        logging.info("SSM port forwarding session terminated successfully.")
-    except subprocess.TimeoutExpired:
-        logging.error("Port forwarding session did not terminate in a timely manner.")
-    except Exception as e:
-        logging.error(f"An unexpected error occurred: {e}")
-    finally:
-        try:
-            logging.info("Terminating SSM sessions...")
-            response = ssm.describe_sessions(
-                State='Active', Filters=[{'key': 'Target', 'value': instance_id}]
-            )
-            sessions = response.get('Sessions', [])
-            for session in sessions:
-                ssm.terminate_session(SessionId=session['SessionId'])
-                logging.info(f"Terminated SSM session {session['SessionId']}")
-        except Exception as e:
-            logging.error(f"Failed to terminate SSM sessions: {e}")
-
-        logging.info("Script execution finished.")
+_aws_session = None
 
-def get_aws_session() -> boto3.Session:
-    if not is_connected():
-        logging.error("No internet connection. Please check your connection and try again.")
-        return None
+def get_aws_session():
+    """The process-wide boto3 session, created on first use. boto3 is only imported here."""
+    global _aws_session
+    if _aws_session is not None:
+        return _aws_session
 
-    try:
+    with tracer.span('credential_check') as span:
+        import boto3
+        import_botocore_exceptions()
         session = boto3.Session()
-    except NoCredentialsError:
-        logging.error("AWS is not configured. Please enter your AWS credentials.")
-        return None
+        # boto3 only resolves credentials on the first call, so look them up now to fail early
+        if session.get_credentials() is None:
+            logging.error("AWS is not configured. Please enter your AWS credentials.")
+            span.end('error', error="no credentials")
+            return None
+    tracer.instrument(session)
+    api_calls.install(session)
 
     logging.info("AWS credentials are configured, proceeding.")
+    _aws_session = session
     return session
 
+@functools.lru_cache(maxsize=None)
 def get_ec2_resources(session, aws_region):
-    # Create a Config object with custom settings
-    custom_config = botocore.config.Config(
-        read_timeout=900,
-        connect_timeout=900,
-        retries={'max_attempts': 0}
-    )
+    """The EC2 and SSM clients for `aws_region`, created once per session and reused by every caller."""
+    # Adaptive retries and short timeouts; see ApiCallLayer
+    client_config = api_calls.client_config()
+
+    ec2_client = session.client('ec2', region_name=aws_region, config=client_config)
+    ssm = session.client('ssm', region_name=aws_region, config=client_config)
 
-    ec2_resource = session.resource('ec2', region_name=aws_region, config=custom_config)
-    ec2_client = session.client('ec2', region_name=aws_region, config=custom_config)
-    ssm = session.client('ssm', region_name=aws_region, config=custom_config)
+    return ec2_client, ssm
 
-    return ec2_resource, ec2_client, ssm
+@functools.lru_cache(maxsize=None)
+def get_caller_arn(session, aws_region) -> str:
+    """The ARN of the identity `session` acts as, which is also the Owner of the SSM sessions it starts."""
+    sts = session.client('sts', region_name=aws_region, config=api_calls.client_config())
+    return sts.get_caller_identity()['Arn']
 
-def get_instance(ec2_resource, ec2_client, aws_tag_value):
-    existing_instance_id = get_instance_id_by_tag(ec2_resource, aws_tag_key, aws_tag_value)
-    if existing_instance_id:
+def get_instance(ec2_client, ssm, aws_tag_value, state_store: StateStore):
+    with tracer.span('tag_lookup'):
+        existing_instances = rank_for_resume(
+            find_tagged_instances(ec2_client, state_store, aws_tag_key, aws_tag_value), state_store)
+    if existing_instances:
+        existing_instance_id = existing_instances[0]['InstanceId']
         logging.info(f"An instance with tag value '{aws_tag_value}' exists. Instance ID: {existing_instance_id}")
         try:
-            start_instance_if_stopped(ec2_resource, ec2_client, existing_instance_id)
+            if resume_instance(ec2_client, ssm, existing_instances[0], state_store) is None:
+                return None
+            instance_id = existing_instance_id
+        except InstanceStillStopping as e:
+            # Stuck stopping: a new instance is quicker than waiting on EC2
+            logging.warning(f"Could not resume: {e}. Launching a new instance instead.")
+            existing_instances = []
         except ClientError as e:
             if 'UnauthorizedOperation' in str(e):
                 logging.error("You do not have the necessary permissions to start instances. Please check your IAM policies.")
             else:
                 logging.error(f"Failed to start instance: {e}")
             return None
-        instance_id = existing_instance_id
-    else:
+    if not existing_instances:
         try:
-            instance_id = run_instance(ec2_client)  # Only pass ec2_client
+            started = time.monotonic()
+            with tracer.span('cold_launch'):
+                instance_id = run_instance(ec2_client, ssm)
+            if instance_id:
+                record_bring_up(state_store, 'cold', time.monotonic() - started, [instance_id])
+                remember_instances(state_store, describe_instances_by_id(ec2_client, [instance_id]))
         except ClientError as e:
             if 'UnauthorizedOperation' in str(e):
                 logging.error("You do not have the necessary permissions to create instances. Please check your IAM policies.")
@@ -433,37 +3366,150 @@ def get_instance(ec2_resource, ec2_client, aws_tag_value):
             return None
     return instance_id
 
-def start_ssm_sessions(ssm, instance_id, aws_region):
-    port_forwarding_process = None  # Initialize the variable at the start of the function
-
-    # Start the SSM port forwarding session in the background
-    if REMOTE_PORT_NUMBER and LOCAL_PORT_NUMBER:
-        if port_forwarding_process is not None:  # Check if the variable is not None before using it
-            terminate_port_forwarding_session(port_forwarding_process, ssm, instance_id)
-        logging.info("About to start the SSM port forwarding session...")
-        # Start a new port forwarding session       
-        port_forwarding_process = start_ssm_port_forwarding_session(ssm, instance_id, aws_region, REMOTE_PORT_NUMBER, LOCAL_PORT_NUMBER)
-        if port_forwarding_process is None:
-            logging.error("Unable to start the SSM port forwarding session. Exiting.")
-            return None, None
-        else:
-            logging.info("SSM port forwarding session started successfully.")
-        # Give the port forwarding session a moment to start
-        time.sleep(3)
+def get_fleet(ec2_client, ssm, fleet_size: int, state_store: StateStore) -> list:
+    """
+    Bring up `fleet_size` tagged instances, reusing existing ones and launching the rest in one request.
+
+    Stopped instances are started and all instances are waited on concurrently, so bringing up
+    a fleet takes about as long as bringing up its slowest member.
+    """
+    with tracer.span('tag_lookup'):
+        instances = rank_for_resume(
+            find_tagged_instances(ec2_client, state_store, aws_tag_key, aws_tag_value), state_store)[:fleet_size]
+    instance_ids = [instance['InstanceId'] for instance in instances]
+    if instance_ids:
+        logging.info(f"Reusing {len(instance_ids)} existing instance(s): {', '.join(instance_ids)}")
+    missing = fleet_size - len(instance_ids)
+
+    with ThreadPoolExecutor(max_workers=fleet_size + 1) as pool:
+        futures = {
+            instance['InstanceId']: pool.submit(resume_instance, ec2_client, ssm, instance, state_store)
+            for instance in instances
+        }
+        # New instances are launched alongside the restarts and come back already ready
+        launch_future = None
+        if missing > 0:
+            logging.info(f"Launching {missing} new instance(s) for the fleet...")
+            launch_future = pool.submit(launch_fleet_instances, ec2_client, ssm, missing, state_store)
+        ready_ids = []
+        for instance_id, future in futures.items():
+            try:
+                if future.result() is not None:
+                    ready_ids.append(instance_id)
+            except (ClientError, InstanceStillStopping) as e:
+                logging.error(f"Failed to start instance {instance_id}: {e}")
+        if launch_future is not None:
+            try:
+                ready_ids.extend(launch_future.result() or [])
+            except ClientError as e:
+                if 'UnauthorizedOperation' in str(e):
+                    logging.error("You do not have the necessary permissions to create instances. Please check your IAM policies.")
+                else:
+                    logging.error(f"Failed to create fleet instances: {e}")
+
+    logging.info(f"{len(ready_ids)} of {fleet_size} fleet instance(s) are ready.")
+    if ready_ids:
+        remember_instances(state_store, describe_instances_by_id(ec2_client, ready_ids))
+    return ready_ids
+
+def launch_fleet_instances(ec2_client, ssm, count: int, state_store: StateStore) -> list:
+    started = time.monotonic()
+    with tracer.span('cold_launch', instance_count=count):
+        instance_ids = launch_with_placement(ec2_client, ssm, count)
+    if instance_ids:
+        record_bring_up(state_store, 'cold', time.monotonic() - started, instance_ids)
+        start_warm_up(ssm, instance_ids)
+    return instance_ids
+
+def fleet_local_port(local_port: str, index: int) -> str:
+    """Local port for the `index`-th fleet instance; each instance gets its own block of FLEET_PORT_STRIDE ports."""
+    return str(int(local_port) + index * FLEET_PORT_STRIDE)
+
+def is_process_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # Running, as another user
+    return True
+
+def find_adoptable_tunnels(recorded: list, live_sessions: list, instance_id: str) -> dict:
+    """
+    The tunnels to `instance_id` that another run recorded in the state cache and still serves.
+
+    A record only counts while its session is among `live_sessions`, was opened by the same AWS
+    identity as this run and, for a CLI tunnel, its process is still running. Any other listener
+    on a configured port is left alone; the tunnel is opened on the next free port instead.
+
+    Returns:
+        dict: The session ID of each adoptable tunnel, keyed by (remote port, local port).
+    """
+    live = {session['SessionId']: session for session in live_sessions}
+    candidates = [record for record in recorded
+                  if record.get('instance_id') == instance_id and record.get('session_id') in live]
+    if not candidates:
+        return {}
+    try:
+        caller_arn = get_caller_arn(get_aws_session(), aws_region)
+    except ClientError as e:
+        logging.warning(f"Could not look up the caller identity ({e}); not adopting existing tunnels.")
+        return {}
+    adoptable = {}
+    for record in candidates:
+        if live[record['session_id']].get('Owner') != caller_arn:
+            continue
+        if record.get('pid') and not is_process_running(record['pid']):
+            continue
+        adoptable[(str(record['remote_port']), int(record['local_port']))] = record['session_id']
+    return adoptable
+
+def start_tunnels(ssm, instance_ids: list, aws_region: str, state_store: StateStore = None):
+    """
+    Forward the configured ports for every instance. Returns the TunnelSupervisor, or None if no ports are configured.
+
+    With `state_store`, tunnels recorded there by another run that are still live are adopted.
+    """
+    mappings = get_port_mappings()
+    if not mappings:
+        return None
+
+    logging.info(f"Starting {len(mappings) * len(instance_ids)} port forwarding tunnel(s)...")
+    span = tracer.start('tunnel_ready', tunnels=len(mappings) * len(instance_ids))
+    supervisor = TunnelSupervisor(ssm, aws_region, mappings)
+    with ThreadPoolExecutor(max_workers=len(instance_ids)) as pool:
+        existing = list(pool.map(lambda instance_id: ensure_ssm_session(ssm, instance_id, aws_region), instance_ids))
+    recorded = (state_store.get('tunnels') or []) if state_store else []
+    for index, instance_id in enumerate(instance_ids):
+        adoptable = find_adoptable_tunnels(recorded, existing[index]['port_forwarding_sessions'], instance_id)
+        supervisor.add_instance(instance_id, index, adoptable=adoptable)
+    # Wait for the tunnels to report they are listening rather than sleeping a fixed time
+    if supervisor.wait_ready(timeout=30):
+        span.end()
+    else:
+        logging.warning("Not every port forwarding tunnel reported readiness within 30 seconds.")
+        span.end('timeout')
+    supervisor.log_status()
+    return supervisor
+
+def start_ssm_sessions(ssm, instance_ids: list, aws_region: str, state_store: StateStore = None):
+    """Forward the configured ports for every instance, then open the shell on the first one."""
+    supervisor = start_tunnels(ssm, instance_ids, aws_region, state_store)
 
     # Start the SSM shell session
     logging.info("About to start the SSM shell session...")
-    shell_session_process = start_ssm_shell_session(ssm, instance_id, aws_region)
+    shell_session_process = start_ssm_shell_session(instance_ids[0], aws_region)
     if shell_session_process is None:
         logging.error("Unable to start the SSM shell session. Exiting.")
-        return None, None
+        return None, supervisor
 
-    return shell_session_process, port_forwarding_process
+    return shell_session_process, supervisor
 
-def cleanup(port_forwarding_process, shell_session_process, ssm, instance_id):
+def cleanup(supervisor, shell_session_process, ssm, instance_id):
     try:
-        if port_forwarding_process:
-            terminate_port_forwarding_session(port_forwarding_process, ssm, instance_id)
+        if supervisor:
+            supervisor.log_status()
+            supervisor.stop()
     except Exception as e:
         logging.error(f"Error terminating port forwarding session: {e}")
     try:
@@ -472,73 +3518,144 @@ def cleanup(port_forwarding_process, shell_session_process, ssm, instance_id):
     except Exception as e:
         logging.error(f"Error terminating shell session: {e}")
     finally:
-        if instance_id:
-            try:
-                logging.info("Terminating SSM sessions...")
-                response = ssm.describe_sessions(
-                    State='Active', Filters=[{'key': 'Target', 'value': instance_id}]
-                )
-                sessions = response.get('Sessions', [])
-                for session in sessions:
-                    ssm.terminate_session(SessionId=session['SessionId'])
-                    logging.info(f"Terminated SSM session {session['SessionId']}")
-            except Exception as e:
-                logging.error(f"Failed to terminate SSM sessions: {e}")
-
+        # Sessions opened by other terminals or teammates are deliberately left running
         logging.info("Script execution finished.")
 
 def main() -> None:
-    # Initialize the shell and port forwarding processes to None
+    # Initialize the shell session process and the tunnel supervisor to None
     shell_session_process = None
-    port_forwarding_process = None
+    supervisor = None
+    watcher = None
+    idle_monitor = None
     instance_id = None  # Initialize instance_id to None
+    instance_ids = []
+    ssm = None
+    state_store = StateStore(os.path.join(CACHE_DIR, 'state.json'), STATE_PROFILE)
+    connect_span = tracer.start('time_to_connect', fleet_size=aws_fleet_size)
 
     try:
         session = get_aws_session()
         if session is None:
             return
         
-        ec2_resource, ec2_client, ssm = get_ec2_resources(session, aws_region)
+        ec2_client, ssm = get_ec2_resources(session, aws_region)
         
-        instance_id = get_instance(ec2_resource, ec2_client, aws_tag_value)
-        if instance_id is None:
-            logging.error("Failed to get instance. Exiting.")
-            return
+        if aws_fleet_size > 1:
+            instance_ids = get_fleet(ec2_client, ssm, aws_fleet_size, state_store)
+            if not instance_ids:
+                logging.error("Failed to bring up the fleet. Exiting.")
+                return
+            instance_id = instance_ids[0]
+        else:
+            instance_id = get_instance(ec2_client, ssm, aws_tag_value, state_store)
+            if instance_id is None:
+                logging.error("Failed to get instance. Exiting.")
+                return
+            instance_ids = [instance_id]
 
         # Start the SSM sessions
         logging.info("Starting SSM sessions")
-        shell_session_process, port_forwarding_process = start_ssm_sessions(ssm, instance_id, aws_region)
+        shell_session_process, supervisor = start_ssm_sessions(ssm, instance_ids, aws_region, state_store)
+        connect_span.end('ok' if shell_session_process else 'error')
+        tracer.write_prometheus()
+        if supervisor:
+            state_store.put('tunnels', [
+                {key: stats[key] for key in ('name', 'instance_id', 'remote_port', 'local_port', 'session_id', 'pid')}
+                for stats in supervisor.status()
+            ])
         if shell_session_process is None:
             return
+        start_bootstrap_report_watch(ssm, instance_ids)
+        watcher = start_interruption_watcher(ec2_client, ssm, state_store, instance_ids, supervisor)
+
+        def end_shell_if_stopped(stopped_id: str) -> None:
+            # The shell would otherwise hang on the stopped instance until its session times out
+            if stopped_id == instance_id and shell_session_process:
+                shell_session_process.terminate()
 
-        # Wait for the shell session to finish
-        shell_session_process.wait()
+        idle_monitor = start_idle_monitor(ec2_client, supervisor, end_shell_if_stopped)
+
+        # Wait for the shell session to finish; if it dropped because the instance was interrupted,
+        # reopen it on the replacement once that is ready
+        while True:
+            shell_session_process.wait()
+            replacement_id = watcher.wait_for_replacement(instance_id) if watcher else None
+            if replacement_id is None:
+                break
+            logging.info(f"Reopening the SSM shell session on replacement instance {replacement_id}...")
+            instance_id = replacement_id
+            shell_session_process = start_ssm_shell_session(instance_id, aws_region)
+            if shell_session_process is None:
+                break
+        if watcher:
+            watcher.stop()
+            instance_ids = [watcher.current_instance(instance_id) for instance_id in instance_ids]
+        if idle_monitor:
+            idle_monitor.stop()
+            instance_ids = [instance_id for instance_id in instance_ids if instance_id not in idle_monitor.stopped]
+            if not instance_ids:
+                logging.info("The instance(s) were stopped after being idle; nothing left to do.")
+                return
         
-        # Ask the user whether to terminate the EC2 instance, default is no
-        terminate = input("Do you want to terminate the EC2 instance? (yes/no, default is no): ")
-        if terminate.lower() == 'yes':
-            ec2_client.terminate_instances(InstanceIds=[instance_id])
-            logging.info(f"Instance {instance_id} is being terminated.")
+        # lifecycle.on_exit decides what happens to the instance(s); without it the user is asked, default is keep
+        plural = 's' if len(instance_ids) > 1 else ''
+        action = lifecycle_config.get('on_exit', 'ask')
+        # Instances of one-time spot requests can only be left running or terminated
+        stoppable = stoppable_instances(ec2_client, instance_ids) if action in ('ask', 'stop', 'hibernate') else []
+        if action == 'ask':
+            choices = 'keep/stop/hibernate/terminate' if stoppable else 'keep/terminate'
+            answer = input(f"What should happen to the EC2 instance{plural}? "
+                           f"({choices}, default is keep): ").strip().lower()
+            # 'yes' and 'no' still answer the old "terminate?" question
+            action = {'yes': 'terminate', 'no': 'keep', '': 'keep'}.get(answer, answer)
+        if action == 'terminate':
+            terminate_instances(ec2_client, instance_ids)
 
-            # Wait for the instance to be terminated
+            # Wait for the instances to be terminated
             waiter = ec2_client.get_waiter('instance_terminated')
-            waiter.wait(InstanceIds=[instance_id])
+            waiter.wait(InstanceIds=instance_ids)
 
-            # Verify the instance is terminated
-            response = ec2_client.describe_instances(InstanceIds=[instance_id])
-            if response['Reservations'][0]['Instances'][0]['State']['Name'] == 'terminated':
-                logging.info(f"Instance {instance_id} has been terminated.")
-            else:
-                logging.error(f"Failed to terminate instance {instance_id}.")
+            state_store.delete('instance_ids', *[f"instance:{instance_id}" for instance_id in instance_ids])
+
+            # Verify the instances are terminated
+            response = ec2_client.describe_instances(InstanceIds=instance_ids)
+            for reservation in response['Reservations']:
+                for instance in reservation['Instances']:
+                    if instance['State']['Name'] == 'terminated':
+                        logging.info(f"Instance {instance['InstanceId']} has been terminated.")
+                    else:
+                        logging.error(f"Failed to terminate instance {instance['InstanceId']}.")
+        elif action in ('stop', 'hibernate'):
+            unstoppable = [instance_id for instance_id in instance_ids if instance_id not in stoppable]
+            if unstoppable:
+                logging.warning(f"Instance(s) {', '.join(unstoppable)} come from a one-time spot request and cannot be "
+                                f"stopped; leaving them running. Terminate them with lifecycle.on_exit: terminate "
+                                f"or from the EC2 console.")
+            if stoppable:
+                try:
+                    stop_instances(ec2_client, stoppable, hibernate=action == 'hibernate')
+                except ClientError as e:
+                    logging.error(f"Could not stop instance(s) {', '.join(stoppable)} ({e}); leaving them running.")
+            if lifecycle_config.get('warm_pool_size') is not None:
+                trim_warm_pool(ec2_client, state_store, int(lifecycle_config['warm_pool_size']))
         else:
+            if action != 'keep':
+                logging.warning(f"Unknown choice '{action}'; leaving the instance{plural} running.")
             logging.info("Instance termination skipped.")
 
     # If the script is interrupted, log the interruption and clean up
     except KeyboardInterrupt:
         logging.info("Script interrupted by user. Cleaning up...")
-        cleanup(port_forwarding_process, shell_session_process, ssm, instance_id)
+        cleanup(supervisor, shell_session_process, ssm, instance_id)
         raise SystemExit("Script interrupted by user") from None
     
+    # Connectivity is only checked once AWS could not be reached, to explain why
+    except EndpointConnectionError as e:
+        if is_connected():
+            logging.error(f"Could not reach AWS: {e}")
+        else:
+            logging.error("No internet connection. Please check your connection and try again.")
+
     # If an unexpected error occurs, log the error
     except Exception as e:
         logging.error(f"An unexpected error occurred in main: {e}")
@@ -546,7 +3663,682 @@ def main() -> None:
         
     # Regardless of how the script exits, clean up the resources
     finally:
-        cleanup(port_forwarding_process, shell_session_process, ssm, instance_id)
+        if watcher:
+            watcher.stop()
+        if idle_monitor:
+            idle_monitor.stop()
+        cleanup(supervisor, shell_session_process, ssm, instance_id)
+        if supervisor:
+            state_store.delete('tunnels')
+        tracer.close()
+
+# Syncing local model directories to the instances, staged through S3
+
+# Written into every synced remote directory, in `sha256sum` format
+SYNC_MANIFEST_NAME = '.start-ec2-manifest.sha256'
+
+@functools.lru_cache(maxsize=None)
+def get_s3_client(session, aws_region, endpoint_url: str = None):
+    """The S3 client used to stage sync uploads; `endpoint_url` points it at MinIO or another stand-in."""
+    return session.client('s3', region_name=aws_region, endpoint_url=endpoint_url)
+
+def load_hash_cache() -> dict:
+    try:
+        with open(os.path.join(CACHE_DIR, 'file-hashes.json'), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def save_hash_cache(cache: dict) -> None:
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(os.path.join(CACHE_DIR, 'file-hashes.json'), 'w') as f:
+            json.dump(cache, f)
+    except OSError as e:
+        logging.warning(f"Could not write the file hash cache: {e}")
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(8 * 1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def build_local_manifest(local_dir: str, hash_cache: dict, workers: int = 4) -> tuple:
+    """
+    The SHA-256 and size of every file under `local_dir`, keyed by '/'-separated relative path.
+
+    Files whose size and modification time match their entry in `hash_cache` are not read
+    again; the others are hashed `workers` at a time. Returns the manifest and the number of
+    bytes that had to be hashed.
+    """
+    files = {}
+    for root, directories, names in os.walk(local_dir, followlinks=True):
+        directories[:] = [name for name in directories if not name.startswith('.')]
+        for name in names:
+            if name.startswith('.'):
+                continue
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            files[os.path.relpath(path, local_dir).replace(os.sep, '/')] = (path, stat.st_size, stat.st_mtime_ns)
+    stale = [(path, size, mtime) for path, size, mtime in files.values() if hash_cache.get(path, [])[:2] != [size, mtime]]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for (path, size, mtime), digest in zip(stale, pool.map(hash_file, [path for path, _, _ in stale])):
+            hash_cache[path] = [size, mtime, digest]
+    manifest = {relative_path: {'sha256': hash_cache[path][2], 'size': size}
+                for relative_path, (path, size, _) in files.items()}
+    return manifest, sum(size for _, size, _ in stale)
+
+def sync_file_key(prefix: str, instance_id: str, remote_dir: str, name: str) -> str:
+    """S3 key of a file list exchanged with `instance_id` about `remote_dir`, kept next to the staged objects."""
+    return f"{prefix}manifests/{instance_id}/{hashlib.sha256(remote_dir.encode()).hexdigest()[:16]}/{name}"
+
+def remote_s3_cp(endpoint_url: str = None) -> str:
+    """The `aws s3 cp` command line for scripts run on the instance, which set $REGION."""
+    endpoint = f" --endpoint-url {shlex.quote(endpoint_url)}" if endpoint_url else ""
+    return f'aws s3 cp --quiet --region "$REGION"{endpoint}'
+
+def read_remote_manifest(ssm, s3, instance_id: str, remote_dir: str, bucket: str, prefix: str,
+                         local_manifest: dict, endpoint_url: str = None) -> dict:
+    """
+    SHA-256 of the files in `remote_dir` on the instance, keyed by relative path.
+
+    This is the manifest the last sync left there. A directory that was never synced, such as
+    one baked into the AMI, is hashed on the instance instead, but only for files whose path
+    and size match a local file. Both lists travel through the staging bucket rather than the
+    command and its output, which SSM limits in size.
+    """
+    sizes_key = sync_file_key(prefix, instance_id, remote_dir, 'local-sizes.tsv')
+    manifest_key = sync_file_key(prefix, instance_id, remote_dir, 'remote.sha256')
+    s3.put_object(Bucket=bucket, Key=sizes_key,
+                  Body="".join(f"{entry['size']}\t{path}\n" for path, entry in local_manifest.items()).encode())
+    copy = remote_s3_cp(endpoint_url)
+    manifest_url = shlex.quote(f"s3://{bucket}/{manifest_key}")
+    script = [
+        f"ROOT={shlex.quote(remote_dir)}",
+        f"REGION={shlex.quote(aws_region)}",
+        f'if [ -f "$ROOT/{SYNC_MANIFEST_NAME}" ]; then exec {copy} "$ROOT/{SYNC_MANIFEST_NAME}" {manifest_url}; fi',
+        'SIZES=$(mktemp) && trap \'rm -f "$SIZES"\' EXIT',
+        f'{copy} {shlex.quote(f"s3://{bucket}/{sizes_key}")} "$SIZES" || exit 1',
+        "(",
+        '    cd "$ROOT" 2>/dev/null || exit 0',
+        "    while IFS=$'\\t' read -r size path; do",
+        '        if [ -f "$path" ] && [ "$(stat -c %s "$path")" = "$size" ]; then printf \'%s\\n\' "$path"; fi',
+        "    done < \"$SIZES\" | xargs -r -d '\\n' -P 4 sha256sum",
+        f") | {copy} - {manifest_url}",
+    ]
+    result = run_ssm_command(ssm, instance_id, script, timeout=1800)
+    if result['status'] != 'Success':
+        raise RuntimeError(f"reading {remote_dir} on {instance_id} failed ({result['status']}): {result['stderr'].strip()}")
+    files = {}
+    for line in s3.get_object(Bucket=bucket, Key=manifest_key)['Body'].read().decode().splitlines():
+        digest, _, path = line.partition('  ')
+        if len(digest) == 64 and path:
+            files[path] = digest
+    return files
+
+def stage_files(s3, bucket: str, prefix: str, files: dict, chunk_size: int, concurrency: int) -> int:
+    """
+    Upload `files` (path keyed by SHA-256) to S3 under content-addressed keys, in parallel multipart uploads.
+
+    Objects already staged by an earlier sync, for this or another instance, are not uploaded
+    again. Returns the number of bytes uploaded.
+    """
+    from boto3.s3.transfer import TransferConfig
+    transfer_config = TransferConfig(multipart_threshold=chunk_size, multipart_chunksize=chunk_size,
+                                     max_concurrency=concurrency)
+
+    def upload(digest: str, path: str) -> int:
+        key = f"{prefix}sha256/{digest}"
+        try:
+            s3.head_object(Bucket=bucket, Key=key)
+            return 0
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey', 'NotFound'):
+                raise
+        s3.upload_file(path, bucket, key, Config=transfer_config)
+        return os.path.getsize(path)
+
+    # A few files at a time, each split into `concurrency` parallel parts
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        return sum(pool.map(upload, files.keys(), files.values()))
+
+def pull_files(ssm, s3, instance_id: str, remote_dir: str, bucket: str, prefix: str, changed: dict,
+               remote_files: dict, parallelism: int = 4, endpoint_url: str = None) -> None:
+    """
+    Have the instance download `changed` files (SHA-256 keyed by relative path) from S3, then record its new manifest.
+
+    The list of files to fetch and the new manifest are staged in the bucket, so the command
+    only carries their keys.
+    """
+    pull_key = sync_file_key(prefix, instance_id, remote_dir, 'pull.txt')
+    manifest_key = sync_file_key(prefix, instance_id, remote_dir, 'manifest.sha256')
+    s3.put_object(Bucket=bucket, Key=pull_key, Body="".join(
+        f"s3://{bucket}/{prefix}sha256/{digest}\n{path}\n" for path, digest in changed.items()).encode())
+    s3.put_object(Bucket=bucket, Key=manifest_key, Body="".join(
+        f"{digest}  {path}\n" for path, digest in sorted({**remote_files, **changed}.items())).encode())
+    copy = remote_s3_cp(endpoint_url)
+    script = [
+        "set -o pipefail",
+        f"ROOT={shlex.quote(remote_dir)}",
+        f"REGION={shlex.quote(aws_region)}",
+        'mkdir -p "$ROOT"',
+        "fetch() {",
+        '    mkdir -p "$(dirname "$ROOT/$2")" &&',
+        f'    {copy} "$1" "$ROOT/$2.part" &&',
+        '    mv "$ROOT/$2.part" "$ROOT/$2" && chown --reference="$ROOT" "$ROOT/$2"',
+        "}",
+        "export -f fetch",
+        "export ROOT REGION",
+        f"{copy} {shlex.quote(f's3://{bucket}/{pull_key}')} - |",
+        f"    xargs -d '\\n' -n 2 -P {int(parallelism)} bash -c 'fetch \"$1\" \"$2\"' _ || exit 1",
+        f'{copy} {shlex.quote(f"s3://{bucket}/{manifest_key}")} "$ROOT/{SYNC_MANIFEST_NAME}"',
+    ]
+    result = run_ssm_command(ssm, instance_id, script, timeout=6 * 3600)
+    if result['status'] != 'Success':
+        raise RuntimeError(f"copying into {remote_dir} on {instance_id} failed ({result['status']}): {result['stderr'].strip()}")
+
+def megabytes_per_second(size: int, seconds: float) -> float:
+    return round(size / 1e6 / seconds, 1) if seconds > 0 else None
+
+def sync_directories(session, ssm, instance_ids: list, dry_run: bool = False) -> list:
+    """
+    Copy new and changed files of every `sync` directory in config.yaml to the instances.
+
+    Local files are compared by content hash with the manifest each instance holds, which is
+    cached in the state store after every sync. Changed files are staged once in the S3 bucket
+    and pulled by every instance over SSM; the instances' role must be able to read the bucket
+    and write the file lists under `prefix`manifests/.
+    Files deleted locally are left on the instances. Returns a report per directory with the
+    bytes moved and the throughput of each step.
+    """
+    bucket = sync_config['bucket']
+    prefix = sync_config.get('prefix', 'start-ec2/')
+    endpoint_url = sync_config.get('endpoint_url')
+    chunk_size = int(float(sync_config.get('chunk_size_mb', 64)) * 1024 * 1024)
+    concurrency = int(sync_config.get('concurrency', 8))
+    s3 = get_s3_client(session, aws_region, endpoint_url)
+    state_store = StateStore(os.path.join(CACHE_DIR, 'state.json'), STATE_PROFILE)
+    hash_cache = load_hash_cache()
+    report = []
+
+    for directory in sync_config.get('directories') or []:
+        local_dir = os.path.expanduser(directory['local'])
+        remote_dir = directory['remote']
+        entry = {'local': local_dir, 'remote': remote_dir, 'instances': {}}
+        started = time.monotonic()
+        with tracer.span('sync_hash', directory=local_dir) as span:
+            local_manifest, entry['hashed_bytes'] = build_local_manifest(local_dir, hash_cache)
+            span.end(files=len(local_manifest), hashed_bytes=entry['hashed_bytes'])
+        save_hash_cache(hash_cache)
+        entry['files'] = len(local_manifest)
+        entry['hash_seconds'] = round(time.monotonic() - started, 2)
+        entry['hash_mb_per_second'] = megabytes_per_second(entry['hashed_bytes'], time.monotonic() - started)
+
+        plans = {}
+        for instance_id in instance_ids:
+            remote_files = state_store.get(f"sync_manifest:{instance_id}:{remote_dir}")
+            if remote_files is None:
+                remote_files = read_remote_manifest(ssm, s3, instance_id, remote_dir, bucket, prefix,
+                                                    local_manifest, endpoint_url)
+            changed = {path: file['sha256'] for path, file in local_manifest.items()
+                       if remote_files.get(path) != file['sha256']}
+            plans[instance_id] = (changed, remote_files)
+            entry['instances'][instance_id] = {
+                'changed_files': len(changed),
+                'changed_bytes': sum(local_manifest[path]['size'] for path in changed),
+            }
+        to_stage = {digest: os.path.join(local_dir, path)
+                    for changed, _ in plans.values() for path, digest in changed.items()}
+        if dry_run or not to_stage:
+            report.append(entry)
+            continue
+
+        started = time.monotonic()
+        with tracer.span('sync_stage', directory=local_dir, files=len(to_stage)) as span:
+            entry['staged_bytes'] = stage_files(s3, bucket, prefix, to_stage, chunk_size, concurrency)
+            span.end(staged_bytes=entry['staged_bytes'])
+        entry['stage_seconds'] = round(time.monotonic() - started, 2)
+        entry['stage_mb_per_second'] = megabytes_per_second(entry['staged_bytes'], time.monotonic() - started)
+
+        def pull(instance_id: str) -> None:
+            changed, remote_files = plans[instance_id]
+            if not changed:
+                return
+            pulled = time.monotonic()
+            with tracer.span('sync_pull', instance_id=instance_id, directory=remote_dir, files=len(changed)):
+                pull_files(ssm, s3, instance_id, remote_dir, bucket, prefix, changed, remote_files,
+                           int(sync_config.get('instance_parallelism', 4)), endpoint_url)
+            seconds = time.monotonic() - pulled
+            entry['instances'][instance_id].update(
+                pull_seconds=round(seconds, 2),
+                pull_mb_per_second=megabytes_per_second(entry['instances'][instance_id]['changed_bytes'], seconds))
+            state_store.put(f"sync_manifest:{instance_id}:{remote_dir}", {**remote_files, **changed}, ttl=30 * 24 * 3600)
+
+        with ThreadPoolExecutor(max_workers=len(instance_ids)) as pool:
+            list(pool.map(pull, instance_ids))
+        report.append(entry)
+    return report
+
+def print_sync_report(report: list, dry_run: bool = False) -> None:
+    for entry in report:
+        print(f"{entry['local']} -> {entry['remote']}: {entry['files']} file(s), "
+              f"{entry['hashed_bytes'] / 1e6:.1f} MB hashed in {entry['hash_seconds']}s"
+              + (f" ({entry['hash_mb_per_second']} MB/s)" if entry['hash_mb_per_second'] else ""))
+        if entry.get('staged_bytes') is not None:
+            print(f"  staged {entry['staged_bytes'] / 1e6:.1f} MB to S3 in {entry['stage_seconds']}s"
+                  + (f" ({entry['stage_mb_per_second']} MB/s)" if entry['stage_mb_per_second'] else ""))
+        for instance_id, instance in entry['instances'].items():
+            line = f"  {instance_id}: {instance['changed_files']} changed file(s), {instance['changed_bytes'] / 1e6:.1f} MB"
+            if dry_run:
+                line += " to copy"
+            elif instance.get('pull_seconds') is not None:
+                line += (f" copied in {instance['pull_seconds']}s"
+                         + (f" ({instance['pull_mb_per_second']} MB/s)" if instance['pull_mb_per_second'] else ""))
+            print(line)
+
+def run_sync(dry_run: bool = False) -> int:
+    """The `sync` command: copy the configured directories to every running instance of this profile."""
+    if not sync_config.get('bucket') or not sync_config.get('directories'):
+        print("Configure sync: bucket and directories in config.yaml first.")
+        return 1
+    session = get_aws_session()
+    if session is None:
+        return 1
+    ec2_client, ssm = get_ec2_resources(session, aws_region)
+    state_store = StateStore(os.path.join(CACHE_DIR, 'state.json'), STATE_PROFILE)
+    instance_ids = [instance['InstanceId'] for instance in
+                    find_tagged_instances(ec2_client, state_store, aws_tag_key, aws_tag_value)
+                    if instance['State']['Name'] == 'running']
+    if not instance_ids:
+        print("No running instance to sync to.")
+        return 1
+    try:
+        report = sync_directories(session, ssm, instance_ids, dry_run)
+    except (ClientError, RuntimeError, OSError) as e:
+        print(f"sync failed: {e}")
+        return 1
+    print_sync_report(report, dry_run)
+    return 0
+
+# Resident daemon and its local control socket
+
+def daemon_socket_path() -> str:
+    return os.path.join(CACHE_DIR, f"daemon-{re.sub(r'[^A-Za-z0-9_.-]', '_', STATE_PROFILE)}.sock")
+
+class StartEc2Daemon:
+    """
+    Keeps warm AWS clients, the instance state and the tunnel supervisor between CLI commands.
+
+    Requests arrive over a Unix domain socket as one JSON object per line and are answered the
+    same way, so `status`, `ports` and repeated `connect` calls skip boto3 start-up entirely.
+    """
+
+    def __init__(self, session):
+        self.ec2_client, self.ssm = get_ec2_resources(session, aws_region)
+        self.state_store = StateStore(os.path.join(CACHE_DIR, 'state.json'), STATE_PROFILE)
+        self.supervisor = None
+        self.watcher = None
+        self.idle_monitor = None
+        self.instance_ids = []
+        self.started_at = time.time()
+        self.server = None
+        self._connect_lock = threading.Lock()
+
+    def handle(self, request: dict) -> dict:
+        commands = {
+            'connect': self.connect,
+            'status': self.status,
+            'ports': self.ports,
+            'events': self.events,
+            'stop': self.stop,
+        }
+        command = request.get('command')
+        if command not in commands:
+            raise ValueError(f"Unknown command '{command}'")
+        return commands[command]()
+
+    def connect(self) -> dict:
+        with self._connect_lock:
+            self._follow_replacements()
+            if self.instance_ids and self.supervisor:
+                states = {instance['InstanceId']: instance['State']['Name']
+                          for instance in describe_instances_by_id(self.ec2_client, self.instance_ids)}
+                if all(states.get(instance_id) == 'running' for instance_id in self.instance_ids):
+                    return self.status()
+                logging.info("Instances changed state since the last connect; bringing them up again.")
+                self._stop_watching()
+                self.supervisor.stop()
+                self.supervisor = None
+
+            tracer.new_run()
+            with tracer.span('time_to_connect', fleet_size=aws_fleet_size):
+                if aws_fleet_size > 1:
+                    instance_ids = get_fleet(self.ec2_client, self.ssm, aws_fleet_size, self.state_store)
+                else:
+                    instance_id = get_instance(self.ec2_client, self.ssm, aws_tag_value, self.state_store)
+                    instance_ids = [instance_id] if instance_id else []
+                if not instance_ids:
+                    raise RuntimeError("Failed to get instance.")
+                self.instance_ids = instance_ids
+                self.supervisor = start_tunnels(self.ssm, instance_ids, aws_region, self.state_store)
+            tracer.write_prometheus()
+            start_bootstrap_report_watch(self.ssm, self.instance_ids)
+            self.watcher = start_interruption_watcher(self.ec2_client, self.ssm, self.state_store, self.instance_ids,
+                                                      self.supervisor)
+            self.idle_monitor = start_idle_monitor(self.ec2_client, self.supervisor)
+            if self.supervisor:
+                self.state_store.put('tunnels', [
+                    {key: stats[key] for key in ('name', 'instance_id', 'remote_port', 'local_port', 'session_id', 'pid')}
+                    for stats in self.supervisor.status()
+                ])
+            return self.status()
+
+    def _follow_replacements(self) -> None:
+        if self.watcher:
+            self.instance_ids = [self.watcher.current_instance(instance_id) for instance_id in self.instance_ids]
+
+    def _stop_watching(self) -> None:
+        if self.watcher:
+            self.watcher.stop()
+            self.watcher = None
+        if self.idle_monitor:
+            self.idle_monitor.stop()
+            self.idle_monitor = None
+
+    def status(self) -> dict:
+        self._follow_replacements()
+        instance_ids = self.instance_ids or self.state_store.get('instance_ids') or []
+        readiness = describe_readiness_of_instances(self.ec2_client, instance_ids) if instance_ids else {}
+        instances = [dict(instance_id=instance_id, **readiness.get(instance_id, {})) for instance_id in instance_ids]
+        return {
+            'profile': STATE_PROFILE,
+            'daemon_uptime': round(time.time() - self.started_at),
+            'instances': instances,
+            'tunnels': self.supervisor.status() if self.supervisor else [],
+            'bring_up': summarize_bring_up(self.state_store.get('bring_up_history') or []),
+            'warm_up': collect_warm_up_progress(self.state_store, instance_ids),
+            'interruptions': ({instance_id: {'reason': reason, 'replacement': self.watcher.replacements.get(instance_id)}
+                               for instance_id, reason in self.watcher.notices.items()} if self.watcher else {}),
+            'idle': self.idle_monitor.status() if self.idle_monitor else None,
+            'api_calls': api_calls.stats(),
+        }
+
+    def ports(self) -> dict:
+        return {'tunnels': self.supervisor.status() if self.supervisor else []}
+
+    def events(self) -> dict:
+        return {'events': self.supervisor.recent_events(100) if self.supervisor else []}
+
+    def stop(self) -> dict:
+        """Close the tunnels and shut the daemon down. Instances are left running."""
+        with self._connect_lock:
+            self._follow_replacements()
+            self._stop_watching()
+            if self.supervisor:
+                self.supervisor.stop()
+                self.supervisor = None
+                self.state_store.delete('tunnels')
+        if self.server is not None:
+            # shutdown() waits for serve_forever() to return, so it cannot run on this request's thread
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+        return {'stopped': True, 'instances': self.instance_ids}
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return  # A liveness probe from is_daemon_running()
+        try:
+            response = {'ok': True, 'result': self.server.controller.handle(json.loads(line))}
+        except Exception as e:
+            logging.error(f"Daemon request failed: {e}")
+            response = {'ok': False, 'error': str(e)}
+        try:
+            self.wfile.write((json.dumps(response, default=str) + "\n").encode())
+        except BrokenPipeError:
+            logging.info("Daemon client disconnected before the reply was sent.")
+
+def run_daemon() -> None:
+    path = daemon_socket_path()
+    if is_daemon_running():
+        logging.error(f"A daemon is already listening on {path}.")
+        return
+    session = get_aws_session()
+    if session is None:
+        return
+    controller = StartEc2Daemon(session)
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    if os.path.exists(path):
+        os.unlink(path)  # Left behind by a daemon that did not shut down cleanly
+    server = socketserver.ThreadingUnixStreamServer(path, DaemonRequestHandler)
+    os.chmod(path, 0o600)
+    server.daemon_threads = True
+    server.controller = controller
+    controller.server = server
+    logging.info(f"Daemon listening on {path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Daemon interrupted by user. Cleaning up...")
+        controller.stop()
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.unlink(path)
+        logging.info("Daemon stopped.")
+
+def send_daemon_request(command: str, timeout: float = None) -> dict:
+    """Send one command to the daemon and return its result. Raises RuntimeError if it failed."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(daemon_socket_path())
+        client.sendall((json.dumps({'command': command}) + "\n").encode())
+        with client.makefile('rb') as reply:
+            response = json.loads(reply.readline())
+    if not response.get('ok'):
+        raise RuntimeError(response.get('error'))
+    return response['result']
+
+def is_daemon_running() -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(daemon_socket_path())
+            return True
+        except OSError:
+            return False
+
+def spawn_daemon(timeout: float = 30) -> bool:
+    """Start the daemon in the background and wait until its socket accepts connections."""
+    logging.info("Starting the start-ec2 daemon in the background...")
+    subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--config', config_path, 'daemon'],
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if is_daemon_running():
+            return True
+        time.sleep(0.1)
+    logging.error("The daemon did not start; see start-ec2.log.")
+    return False
+
+def print_tunnels(tunnels: list) -> None:
+    for tunnel in tunnels:
+        traffic = f", {tunnel['bytes_sent']}B out / {tunnel['bytes_received']}B in" if tunnel.get('bytes_sent') is not None else ""
+        if tunnel.get('requests') is not None:
+            traffic += f", {tunnel['requests']} request(s), idle {tunnel['idle_seconds']}s"
+            if tunnel.get('latency_ms_p50') is not None:
+                traffic += f", latency p50 {tunnel['latency_ms_p50']}ms p95 {tunnel['latency_ms_p95']}ms"
+        app = ""
+        if tunnel.get('app_state') == 'ready':
+            app = f", app ready at {tunnel['app_ready_at']}"
+        elif tunnel.get('app_state'):
+            app = f", app {tunnel['app_state']}"
+        print(f"  {tunnel['name']:<12} {tunnel['instance_id']}:{tunnel['remote_port']} -> "
+              f"http://127.0.0.1:{tunnel['local_port']}  [{tunnel['state']}{traffic}{app}]")
+
+def print_status(status: dict) -> None:
+    print(f"Profile {status['profile']} " + (f"(daemon up {status['daemon_uptime']}s)" if status.get('daemon_uptime') is not None
+                                            else "(no daemon; instances and tunnels as last recorded)"))
+    for instance in status['instances']:
+        print(f"  {instance['instance_id']}: {instance.get('state', 'unknown')}, "
+              f"instance status {instance.get('instance_status', '-')}, system status {instance.get('system_status', '-')}")
+    if not status['instances']:
+        print("  No known instance.")
+    print_tunnels(status['tunnels'])
+    if status.get('bring_up'):
+        print("  Bring-up until SSM online: " + ", ".join(
+            f"{kind.replace('_', ' ')} median {stats['median_seconds']}s ({stats['runs']} run(s))"
+            for kind, stats in sorted(status['bring_up'].items())))
+    for instance_id, progress in (status.get('warm_up') or {}).items():
+        print(f"  Warm-up of {instance_id}: {progress['percent']}% of {progress['total'] / 1e9:.2f} GB read, "
+              f"{progress['mb_per_second']} MB/s" + (", finished" if progress['finished'] is not None else ""))
+    for instance_id, interruption in (status.get('interruptions') or {}).items():
+        print(f"  Interrupted {instance_id} ({interruption['reason']}), "
+              + (f"replaced by {interruption['replacement']}" if interruption['replacement'] else "no replacement yet"))
+    if status.get('api_calls', {}).get('calls'):
+        calls = status['api_calls']
+        slowest = max(calls['operations'].items(), key=lambda item: item[1]['max_seconds'])
+        merged = sum(entry['lookups'] - entry['calls'] for entry in calls['batching'].values())
+        print(f"  AWS API: {calls['calls']} call(s), {calls['throttles']} throttled attempt(s), {calls['retries']} retries, "
+              f"{calls['errors']} error(s), {calls['rate_limit_wait_seconds']}s rate limited, {merged} lookup(s) batched; "
+              f"slowest {slowest[0]} {slowest[1]['max_seconds']}s (mean {slowest[1]['mean_seconds']}s)")
+    if status.get('idle'):
+        idle = status['idle']
+        print(f"  Idle {'hibernate' if idle['action'] == 'hibernate' else 'stop'} after {idle['idle_minutes']:g} minute(s)"
+              + "".join(f", {instance_id} idle {seconds}s" for instance_id, seconds in sorted(idle['idle_seconds'].items())))
+        for instance_id, at in sorted(idle['stopped'].items()):
+            print(f"  {instance_id} was {'hibernated' if idle['action'] == 'hibernate' else 'stopped'} for being idle at {at}")
+
+def local_status(refresh: bool = False) -> dict:
+    """
+    Status without a daemon, from the state cache alone so that boto3 is never imported.
+
+    With `refresh` the instances' states and status checks are looked up with one describe call.
+    """
+    state_store = StateStore(os.path.join(CACHE_DIR, 'state.json'), STATE_PROFILE)
+    instance_ids = state_store.get('instance_ids') or []
+    readiness = {}
+    if refresh and instance_ids:
+        session = get_aws_session()
+        if session is not None:
+            ec2_client, _ = get_ec2_resources(session, aws_region)
+            readiness = describe_readiness_of_instances(ec2_client, instance_ids)
+    else:
+        for instance_id in instance_ids:
+            cached = state_store.get(f"instance:{instance_id}")
+            if cached:
+                readiness[instance_id] = {'state': f"{cached['state']} (cached)"}
+    return {
+        'profile': STATE_PROFILE,
+        'daemon_uptime': None,
+        'instances': [dict(instance_id=instance_id, **readiness.get(instance_id, {})) for instance_id in instance_ids],
+        'tunnels': [dict(tunnel, state='recorded') for tunnel in state_store.get('tunnels') or []],
+        'bring_up': summarize_bring_up(state_store.get('bring_up_history') or []),
+        'warm_up': collect_warm_up_progress(state_store, instance_ids),
+    }
+
+def show_bootstrap(print_script: bool = False) -> int:
+    """Print the generated bootstrap script, or the bootstrap report of every known instance."""
+    if print_script:
+        script = get_user_data()
+        if not script:
+            print("Neither bootstrap nor user_data is configured.")
+            return 1
+        print(script, end="" if script.endswith("\n") else "\n")
+        return 0
+    instance_ids = StateStore(os.path.join(CACHE_DIR, 'state.json'), STATE_PROFILE).get('instance_ids') or []
+    if not instance_ids:
+        print("No known instance.")
+        return 1
+    session = get_aws_session()
+    if session is None:
+        return 1
+    _, ssm = get_ec2_resources(session, aws_region)
+    try:
+        for instance_id in instance_ids:
+            print_bootstrap_report(instance_id, fetch_bootstrap_report(ssm, instance_id))
+    except ClientError as e:
+        print(f"Could not read the bootstrap report: {e}")
+        return 1
+    return 0
+
+def run_command(command: str, shell: bool = False, refresh: bool = False) -> int:
+    """Run a thin CLI command against the daemon, starting it first for `connect`."""
+    if not is_daemon_running():
+        if command == 'status':
+            try:
+                print_status(local_status(refresh))
+            except ClientError as e:
+                print(f"status failed: {e}")
+                return 1
+            return 0
+        if command != 'connect':
+            print("The start-ec2 daemon is not running. Start it with 'start-ec2.py daemon' or 'start-ec2.py connect'.")
+            return 1
+        if not spawn_daemon():
+            return 1
+    try:
+        result = send_daemon_request(command)
+    except (OSError, RuntimeError) as e:
+        print(f"{command} failed: {e}")
+        return 1
+
+    if command in ('connect', 'status'):
+        print_status(result)
+    elif command == 'ports':
+        print_tunnels(result['tunnels'])
+    elif command == 'events':
+        for event in result['events']:
+            print(f"{event['time']} {event['tunnel']:<12} {event['instance_id']} {event['kind']:<24} "
+                  f"{event['session_id'] or ''} {event['detail'] or ''}".rstrip())
+    elif command == 'stop':
+        print("Tunnels closed and daemon stopped; instances were left running.")
+
+    if command == 'connect' and shell and result['instances']:
+        shell_session_process = start_ssm_shell_session(result['instances'][0]['instance_id'], aws_region)
+        if shell_session_process is not None:
+            shell_session_process.wait()
+    return 0
+
+def cli(argv: list = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Start and connect to an EC2 spot instance over AWS SSM. Without a command, "
+                    "runs the interactive flow in this process."
+    )
+    subcommands = parser.add_subparsers(dest='command')
+    subcommands.add_parser('daemon', help="run the background daemon in the foreground")
+    connect = subcommands.add_parser('connect', help="bring up the instance and tunnels via the daemon")
+    connect.add_argument('--shell', action='store_true', help="open an SSM shell once connected")
+    status = subcommands.add_parser('status', help="show instance and tunnel status, from the daemon if it is running")
+    status.add_argument('--refresh', action='store_true',
+                        help="without a daemon, look the instances up in AWS instead of showing the cached state")
+    subcommands.add_parser('ports', help="list forwarded ports and their traffic")
+    subcommands.add_parser('events', help="show the daemon's recent port forwarding session events")
+    subcommands.add_parser('stop', help="close the daemon's tunnels and stop the daemon")
+    bootstrap = subcommands.add_parser('bootstrap', help="show the per-repo timings of the instances' bootstrap")
+    bootstrap.add_argument('--script', action='store_true', help="print the generated bootstrap script instead")
+    sync = subcommands.add_parser('sync', help="copy new and changed files of the sync directories to the instances")
+    sync.add_argument('--dry-run', action='store_true', help="only report what would be copied")
+    parser.add_argument('--config', default='config.yaml', help="configuration file (default: config.yaml)")
+    args = parser.parse_args(argv)
+
+    setup_logging()
+    load_config(args.config)
+
+    if args.command is None:
+        main()
+    elif args.command == 'daemon':
+        run_daemon()
+    elif args.command == 'bootstrap':
+        raise SystemExit(show_bootstrap(args.script))
+    elif args.command == 'sync':
+        raise SystemExit(run_sync(args.dry_run))
+    else:
+        raise SystemExit(run_command(args.command, getattr(args, 'shell', False), getattr(args, 'refresh', False)))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    cli()
\ No newline at end of file